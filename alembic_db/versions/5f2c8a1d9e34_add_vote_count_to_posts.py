@@ -0,0 +1,33 @@
+"""add vote_count to posts
+
+Revision ID: 5f2c8a1d9e34
+Revises: bcd964afd7ef
+Create Date: 2026-10-18 09:12:40.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2c8a1d9e34'
+down_revision = 'bcd964afd7ef'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts',
+                  sa.Column('vote_count', sa.Integer(),
+                            server_default='0', nullable=False))
+    # backfill the counter from the votes that already exist
+    op.execute('''
+    UPDATE posts
+    SET vote_count = counts.votes
+    FROM (SELECT post_id, COUNT(*) AS votes FROM votes GROUP BY post_id) AS counts
+    WHERE posts.id = counts.post_id;
+    ''')
+
+
+def downgrade():
+    op.drop_column('posts', 'vote_count')
@@ -0,0 +1,39 @@
+"""add posts search indexes
+
+Revision ID: a91e47c3b208
+Revises: 5f2c8a1d9e34
+Create Date: 2026-10-18 10:03:17.552981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91e47c3b208'
+down_revision = '5f2c8a1d9e34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pg_trgm provides the trigram operator class used to index LIKE '%...%' searches
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    op.add_column('posts',
+                  sa.Column('search_vector', postgresql.TSVECTOR(),
+                            sa.Computed(
+                                "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                                "setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+                                persisted=True)))
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'],
+                    postgresql_using='gin')
+    op.create_index('ix_posts_title_trgm', 'posts', ['title'],
+                    postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_posts_title_trgm', table_name='posts')
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
@@ -0,0 +1,40 @@
+"""add post and vote indexes
+
+Revision ID: c3d81f5a6b72
+Revises: a91e47c3b208
+Create Date: 2026-10-18 13:21:05.284630
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d81f5a6b72'
+down_revision = 'a91e47c3b208'
+branch_labels = None
+depends_on = None
+
+
+# votes(post_id): the primary key (user_id, post_id) can't be searched by post_id alone
+# posts(user_id): posts by author and the ON DELETE CASCADE from users
+# posts(created_at, id): the ORDER BY and keyset cursor of GET /posts
+INDEXES = (
+    ('ix_votes_post_id', 'votes', ['post_id']),
+    ('ix_posts_user_id', 'posts', ['user_id']),
+    ('ix_posts_created_at_id', 'posts', ['created_at', 'id']),
+)
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY doesn't lock the table against writes, but it can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,47 @@
+"""add trending posts and author index
+
+Revision ID: e7b05c92d4a1
+Revises: c3d81f5a6b72
+Create Date: 2026-10-18 14:02:48.901733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b05c92d4a1'
+down_revision = 'c3d81f5a6b72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trending_posts',
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('votes', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.TIMESTAMP(
+                        timezone=True), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['post_id'], ['posts.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('post_id')
+                    )
+    # the trending table starts empty. run `python -m app.trending` to fill it from the existing votes
+
+    # newest-first posts of one author, created without locking posts against writes.
+    # it starts with user_id, so it also serves the ON DELETE CASCADE from users and ix_posts_user_id
+    # is only extra work on every insert
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_user_id_created_at_id', 'posts',
+                        ['user_id', 'created_at', 'id'], postgresql_concurrently=True)
+        op.drop_index('ix_posts_user_id', table_name='posts',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_user_id', 'posts', ['user_id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_posts_user_id_created_at_id',
+                      table_name='posts', postgresql_concurrently=True)
+    op.drop_table('trending_posts')
@@ -0,0 +1,162 @@
+"""partition posts and votes
+
+Revision ID: f4a2d6b18c35
+Revises: e7b05c92d4a1
+Create Date: 2026-10-18 16:21:07.512394
+
+"""
+from datetime import datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a2d6b18c35'
+down_revision = 'e7b05c92d4a1'
+branch_labels = None
+depends_on = None
+
+# votes are spread over this many hash partitions of post_id. changing it later means rewriting the table
+VOTE_PARTITIONS = 8
+# monthly posts partitions created ahead of time. after this `python -m app.partitions` keeps them coming
+MONTHS_AHEAD = 3
+
+SEARCH_VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                 "setweight(to_tsvector('english', coalesce(content, '')), 'B')")
+
+POST_COLUMNS = 'id, title, content, published, created_at, user_id, vote_count'
+
+
+def post_columns():
+    return [
+        sa.Column('id', sa.Integer(), server_default=sa.text(
+            "nextval('posts_id_seq')"), nullable=False),
+        sa.Column('title', sa.String(), nullable=False),
+        sa.Column('content', sa.String(), nullable=False),
+        sa.Column('published', sa.Boolean(),
+                  server_default='TRUE', nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(timezone=True),
+                  server_default=sa.text('now()'), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('vote_count', sa.Integer(),
+                  server_default='0', nullable=False),
+        sa.Column('search_vector', postgresql.TSVECTOR(),
+                  sa.Computed(SEARCH_VECTOR, persisted=True)),
+    ]
+
+
+def add_months(month: datetime, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+# one partition per calendar month (UTC), from the oldest post up to MONTHS_AHEAD months from now
+def create_month_partitions(conn):
+    oldest = conn.execute(sa.text('SELECT min(created_at) FROM posts_unpartitioned')).scalar()
+    now = datetime.now(timezone.utc)
+    month = (oldest or now).astimezone(timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+    last = add_months(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), MONTHS_AHEAD)
+    while month <= last:
+        op.execute(f"CREATE TABLE posts_p{month:%Y%m} PARTITION OF posts "
+                   f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')")
+        month = add_months(month, 1)
+    # catches posts outside every month partition (e.g. created_at set far in the future)
+    op.execute('CREATE TABLE posts_default PARTITION OF posts DEFAULT')
+
+
+def create_post_constraints(primary_key):
+    op.create_primary_key('posts_pkey', 'posts', primary_key)
+    op.create_foreign_key('posts_user_id_fkey', 'posts', 'users',
+                          ['user_id'], ['id'], ondelete='CASCADE')
+    op.create_index('ix_posts_user_id_created_at_id', 'posts', ['user_id', 'created_at', 'id'])
+    op.create_index('ix_posts_created_at_id', 'posts', ['created_at', 'id'])
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'],
+                    postgresql_using='gin')
+    op.create_index('ix_posts_title_trgm', 'posts', ['title'],
+                    postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def create_vote_constraints():
+    op.create_primary_key('votes_pkey', 'votes', ['user_id', 'post_id'])
+    op.create_foreign_key('votes_user_id_fkey', 'votes', 'users',
+                          ['user_id'], ['id'], ondelete='CASCADE')
+    op.create_index('ix_votes_post_id', 'votes', ['post_id'])
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    # a foreign key can only point at a unique key, and every unique key of a partitioned table has to include
+    # the partition key. posts.id alone can't be unique anymore, so votes and trending_posts lose their foreign
+    # keys to posts. the trigger at the end keeps deleting a post's votes (what ON DELETE CASCADE did)
+    op.drop_constraint('votes_post_id_fkey', 'votes', type_='foreignkey')
+    op.drop_constraint('trending_posts_post_id_fkey', 'trending_posts', type_='foreignkey')
+
+    # <-- posts: range partitions by month of created_at -->
+    # the rows are copied into the new table, so the ids (and the sequence) stay the same.
+    # constraints and indexes are added after the copy, which is faster and frees their names first
+    op.rename_table('posts', 'posts_unpartitioned')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY NONE')
+    op.create_table('posts', *post_columns(), postgresql_partition_by='RANGE (created_at)')
+    create_month_partitions(conn)
+    op.execute(f'INSERT INTO posts ({POST_COLUMNS}) SELECT {POST_COLUMNS} FROM posts_unpartitioned')
+    op.drop_table('posts_unpartitioned')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY posts.id')
+    # the primary key has to include created_at. ix_posts_id keeps lookups by id alone on an index
+    create_post_constraints(['id', 'created_at'])
+    op.create_index('ix_posts_id', 'posts', ['id'])
+
+    # <-- votes: hash partitions by post_id -->
+    # all votes of a post are in one partition, so counting or deleting them touches a single small table
+    op.rename_table('votes', 'votes_unpartitioned')
+    op.create_table('votes',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    postgresql_partition_by='HASH (post_id)')
+    for remainder in range(VOTE_PARTITIONS):
+        op.execute(f'CREATE TABLE votes_p{remainder} PARTITION OF votes '
+                   f'FOR VALUES WITH (MODULUS {VOTE_PARTITIONS}, REMAINDER {remainder})')
+    op.execute('INSERT INTO votes (user_id, post_id) SELECT user_id, post_id FROM votes_unpartitioned')
+    op.drop_table('votes_unpartitioned')
+    create_vote_constraints()
+
+    op.execute('''
+        CREATE FUNCTION delete_post_votes() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM votes WHERE post_id = OLD.id;
+            DELETE FROM trending_posts WHERE post_id = OLD.id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql''')
+    op.execute('CREATE TRIGGER posts_delete_votes AFTER DELETE ON posts '
+               'FOR EACH ROW EXECUTE FUNCTION delete_post_votes()')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER posts_delete_votes ON posts')
+    op.execute('DROP FUNCTION delete_post_votes()')
+
+    op.rename_table('votes', 'votes_partitioned')
+    op.create_table('votes',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('post_id', sa.Integer(), nullable=False))
+    op.execute('INSERT INTO votes (user_id, post_id) SELECT user_id, post_id FROM votes_partitioned')
+    op.drop_table('votes_partitioned')
+    create_vote_constraints()
+
+    # archived partitions (see app/partitions.py) are not part of posts anymore and are not copied back
+    op.rename_table('posts', 'posts_partitioned')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY NONE')
+    op.create_table('posts', *post_columns())
+    op.execute(f'INSERT INTO posts ({POST_COLUMNS}) SELECT {POST_COLUMNS} FROM posts_partitioned')
+    op.drop_table('posts_partitioned')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY posts.id')
+    create_post_constraints(['id'])
+
+    op.create_foreign_key('votes_post_id_fkey', 'votes', 'posts',
+                          ['post_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('trending_posts_post_id_fkey', 'trending_posts', 'posts',
+                          ['post_id'], ['id'], ondelete='CASCADE')
@@ -0,0 +1,170 @@
+# negotiated response compression (COMPRESSION_ENABLED).
+#
+# a page of 50 posts repeats the full author of every post, so the JSON compresses very well. the client
+# lists what it can decode in Accept-Encoding and the first of COMPRESSION_ENCODINGS it accepts is used.
+# brotli and zstd need their optional packages (brotli, zstandard) and are skipped without them.
+# cached responses (response_cache.py) store their compressed bodies next to the plain one, so hot pages
+# are compressed once when they are cached instead of on every request. everything else is compressed by
+# CompressionMiddleware on the way out
+import gzip
+from typing import Optional
+from .config import settings
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional
+    zstandard = None
+
+
+def _gzip(body: bytes):
+    # mtime=0 keeps the output the same for the same body
+    return gzip.compress(body, compresslevel=settings.compression_gzip_level, mtime=0)
+
+
+def _brotli(body: bytes):
+    return brotli.compress(body, quality=settings.compression_brotli_level)
+
+
+def _zstd(body: bytes):
+    return zstandard.ZstdCompressor(level=settings.compression_zstd_level).compress(body)
+
+
+COMPRESSORS = {'gzip': _gzip}
+if brotli is not None:
+    COMPRESSORS['br'] = _brotli
+if zstandard is not None:
+    COMPRESSORS['zstd'] = _zstd
+
+# the encodings this server uses, in order of preference
+ENCODINGS = [encoding for encoding in settings.compression_encodings
+             if encoding in COMPRESSORS] if settings.compression_enabled else []
+
+# only text formats are worth compressing. images and the like are compressed already
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+# picks the encoding for a response from the request's Accept-Encoding header, or None to send it as is.
+# "gzip, br;q=0.9" -> both accepted, the client prefers gzip. the client's q values win and our own
+# preference breaks ties
+def negotiate(accept_encoding: Optional[str]):
+    if not ENCODINGS or not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str):
+    return COMPRESSORS[encoding](body)
+
+
+# {encoding: compressed body} of every encoding in use. empty for bodies below the threshold
+def compress_all(body: bytes):
+    if len(body) < settings.compression_min_size:
+        return {}
+    return {encoding: compress(body, encoding) for encoding in ENCODINGS}
+
+
+# the ETag of a compressed body has to differ from the plain one (they are different bytes).
+# the encoding is appended inside the quotes: "abc" -> "abc-gzip"
+def encoded_etag(etag: str, encoding: str):
+    return etag[:-1] + f'-{encoding}"'
+
+
+def strip_etag_encoding(etag: str):
+    for encoding in COMPRESSORS:
+        suffix = f'-{encoding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def _header(headers, name: bytes):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+# compresses responses that aren't compressed yet. only whole bodies are handled: streamed responses
+# (the export endpoints) are passed through, since compressing them would mean buffering the whole stream
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        accept_encoding = _header(scope['headers'], b'accept-encoding')
+        encoding = negotiate(accept_encoding)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message['type'] == 'http.response.start':
+                headers = message.get('headers', [])
+                content_type = _header(headers, b'content-type') or ''
+                if _header(headers, b'content-encoding') or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    # held back until the body is known, its length and encoding headers may change
+                    start_message = message
+                return
+
+            if passthrough or message['type'] != 'http.response.body':
+                return await send(message)
+
+            body = message.get('body', b'')
+            if start_message is None:
+                return await send(message)
+            if message.get('more_body', False):
+                # a streamed body: send it as it comes
+                await send(start_message)
+                start_message = None
+                passthrough = True
+                return await send(message)
+
+            headers = [(key, value) for key, value in start_message.get('headers', [])
+                       if key.lower() not in (b'content-length', b'etag')]
+            etag = _header(start_message.get('headers', []), b'etag')
+            if len(body) >= settings.compression_min_size:
+                body = compress(body, encoding)
+                headers.append((b'content-encoding', encoding.encode()))
+                if etag:
+                    etag = encoded_etag(etag, encoding)
+            if etag:
+                headers.append((b'etag', etag.encode('latin-1')))
+            headers.append((b'content-length', str(len(body)).encode()))
+            headers.append((b'vary', b'Accept-Encoding'))
+            await send({**start_message, 'headers': headers})
+            start_message = None
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_compressed)
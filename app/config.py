@@ -1,3 +1,4 @@
+from typing import Dict, List, Optional
 from pydantic import BaseSettings
 
 
@@ -11,6 +12,155 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     token_expire_minutes: int
+    # HS256/384/512 sign with secret_key. ES256/384/512 and RS256/384/512 sign with jwt_private_key_file (PEM)
+    # so other services can verify tokens with the public keys served at /.well-known/jwks.json
+    jwt_private_key_file: Optional[str] = None
+    # id of the signing key, sent as the token's kid header
+    jwt_key_id: str = 'default'
+    # public keys (kid -> PEM file) still accepted after a rotation, until the tokens they signed expire
+    jwt_public_key_files: Dict[str, str] = {}
+    # verified tokens are remembered (by their sha256) so repeated requests skip the signature check.
+    # entries never outlive the token's exp. a ttl or size of 0 turns the cache off
+    token_cache_size: int = 10000
+    token_cache_ttl_seconds: float = 300
+    # users loaded by get_current_user are kept in memory for this long (0 disables the cache)
+    user_cache_ttl_seconds: int = 60
+    user_cache_size: int = 1024
+    # bcrypt runs in a separate pool of processes so it doesn't hold up request threads (0 runs it inline)
+    password_hash_workers: int = 2
+    # calls allowed to wait for a free hashing worker before new ones are turned away with a 503
+    password_hash_queue_limit: int = 32
+    password_hash_timeout_seconds: float = 5
+    # response cache for post reads: 'memory', 'redis' (shared, uses redis_url) or 'none'. a memory cache is only
+    # invalidated in the worker that made the change, so with several workers the others serve stale posts
+    # until response_cache_ttl_seconds runs out. use redis when that matters
+    response_cache_backend: str = 'memory'
+    response_cache_ttl_seconds: int = 30
+    response_cache_size: int = 1024
+    redis_url: str = 'redis://localhost:6379/0'
+    # 'fast' builds post read responses straight from row tuples with orjson, 'pydantic' validates ORM objects
+    serialization_mode: str = 'pydantic'
+    # gzip/brotli/zstd response compression, negotiated with Accept-Encoding (see compression.py)
+    compression_enabled: bool = False
+    # server preference order. br and zstd are used only when the brotli / zstandard packages are installed
+    compression_encodings: List[str] = ['zstd', 'br', 'gzip']
+    # smaller bodies are sent as they are, the compression headers would eat most of the savings
+    compression_min_size: int = 1024
+    compression_gzip_level: int = 6
+    compression_brotli_level: int = 4
+    compression_zstd_level: int = 3
+    # store compressed bodies in the response cache so cached pages aren't compressed on every hit
+    compression_precompress: bool = True
+    # rows fetched from the server side cursor per round trip by the /export streams
+    export_batch_size: int = 1000
+    # per request timing middleware (Server-Timing header and /metrics)
+    profiling_enabled: bool = False
+    # requests slower than this are logged with their SQL statements
+    profiling_slow_request_ms: int = 500
+    # fraction of requests run under the sampling profiler (needs pyinstrument). profiles are only kept for slow requests
+    profiler_sample_rate: float = 0.0
+    # keep a precomputed table of the most voted posts of the last trending_window_hours, updated on every vote.
+    # when off, GET /posts/trending ranks the posts of the window on each request
+    trending_enabled: bool = False
+    trending_window_hours: int = 24
+    # how many posts the trending table keeps
+    trending_capacity: int = 500
+    # token bucket rate limits. each client refills at rate tokens per second up to burst tokens,
+    # and every request costs 1 token unless rate_limit_route_costs says otherwise
+    rate_limit_enabled: bool = False
+    # 'memory' (per worker) or 'redis' (shared by every worker, uses redis_url)
+    rate_limit_backend: str = 'memory'
+    rate_limit_user_rate: float = 10
+    rate_limit_user_burst: int = 40
+    rate_limit_ip_rate: float = 20
+    rate_limit_ip_burst: int = 80
+    # behind a load balancer every request comes from the balancer's address. set this to the header it
+    # writes the client address into (usually x-forwarded-for) so each client gets its own ip bucket
+    rate_limit_forwarded_for_header: Optional[str] = None
+    # addresses or networks (10.0.0.0/8) of the proxies allowed to set that header. empty trusts every peer,
+    # which is only safe when the app can't be reached except through the proxies
+    rate_limit_trusted_proxies: List[str] = []
+    # "METHOD /path" -> tokens. the bcrypt routes cost the most
+    rate_limit_route_costs: Dict[str, int] = {
+        'POST /login': 10,
+        'POST /users': 10,
+        'POST /vote': 2,
+        'POST /vote/batch': 10,
+    }
+    # requests allowed in flight per worker before new ones get a 503.
+    # unset uses db_pool_size + db_max_overflow so requests are shed before they queue on the pool, 0 turns it off
+    max_concurrent_requests: Optional[int] = None
+    # write-behind votes: POST /vote/ goes into an in-process buffer that is written in one batch when it
+    # holds vote_buffer_max_size votes or its oldest vote is vote_buffer_flush_ms old
+    vote_buffer_enabled: bool = False
+    vote_buffer_max_size: int = 500
+    vote_buffer_flush_ms: int = 50
+    # 'group_commit': the request waits for the batch to commit, so an answered vote is never lost.
+    # 'async': the request gets a 202 right away. faster, but buffered votes are lost if the process dies
+    # and votes on missing posts are dropped silently
+    vote_buffer_durability: str = 'group_commit'
+    # buffered votes allowed before new ones get a 503 (async durability only)
+    vote_buffer_max_pending: int = 10000
+    # partition maintenance (python -m app.partitions): monthly posts partitions created ahead of time
+    partition_months_ahead: int = 3
+    # posts partitions older than this many months are detached and moved to partition_archive_schema
+    # together with their votes (by --archive). lookups by post id search every partition, so this bounds their
+    # cost (python -m bench.statements --partitions). 0 keeps every partition
+    partition_retention_months: int = 24
+    partition_archive_schema: str = 'archive'
+    # production server (python -m app.server, gunicorn with uvicorn workers).
+    # PORT is the variable platforms like heroku set
+    port: int = 5000
+    server_host: str = '0.0.0.0'
+    # worker processes. unset uses one per CPU core available to this process.
+    # every worker has its own connection pool, so the database sees workers * (db_pool_size + db_max_overflow)
+    server_workers: Optional[int] = None
+    # import the app once in the master before forking, so workers start faster and share memory
+    server_preload: bool = True
+    # how long idle keep-alive connections are held open
+    server_keepalive_seconds: int = 5
+    # connections waiting to be accepted before the OS refuses new ones
+    server_backlog: int = 2048
+    # a worker that doesn't report back for this long is restarted
+    server_timeout_seconds: int = 30
+    # on SIGTERM, /health/ready reports 503 for this long while requests are still served, so load balancers
+    # stop sending traffic before the worker stops accepting connections
+    server_drain_seconds: float = 0
+    # time in-flight requests get to finish after the worker stops accepting connections
+    server_graceful_timeout_seconds: int = 30
+    # restart a worker after this many requests (0 never), to contain slow leaks
+    server_max_requests: int = 0
+    server_max_requests_jitter: int = 0
+    # time the readiness probe's SELECT 1 may take
+    health_check_timeout_seconds: float = 2
+    # read replicas for GET routes, as a JSON list of postgresql:// urls. empty sends everything to the primary
+    db_replica_urls: List[str] = []
+    # 'round_robin' or 'least_connections'
+    db_replica_balancing: str = 'round_robin'
+    # after a user writes, their reads go to the primary for this long so they see their own changes
+    read_your_writes_seconds: float = 5
+    # 'memory' (per worker) or 'redis' (shared, uses redis_url) store for the read-your-writes window
+    read_your_writes_backend: str = 'memory'
+    # how often an unhealthy replica is tried again
+    replica_retry_seconds: float = 10
+    # run the routes as async handlers on an asyncpg engine instead of sync handlers in the threadpool
+    db_async: bool = False
+    # connection pool settings (per worker process). the defaults match sqlalchemy's own defaults
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: int = 30
+    # close connections older than this many seconds (-1 never recycles)
+    db_pool_recycle: int = -1
+    # test each connection with a cheap query before handing it out
+    db_pool_pre_ping: bool = False
+    # postgres cancels any statement running longer than this many milliseconds (0 disables the limit)
+    db_statement_timeout_ms: int = 0
+    # compiled SQL strings sqlalchemy keeps per engine, so repeated statements skip compilation. 0 turns it off
+    db_compiled_cache_size: int = 500
+    # server side prepared statements asyncpg keeps per connection (DB_ASYNC only, psycopg2 has no prepared
+    # statements). a cached statement is parsed once per connection instead of on every execution.
+    # set to 0 behind pgbouncer in transaction pooling mode, where a connection's prepared statements aren't kept
+    db_prepared_statement_cache_size: int = 100
 
     class Config:
         env_file = '.env'
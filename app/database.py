@@ -1,20 +1,99 @@
+from fastapi import Request
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from .config import settings
+from .metrics import PoolMetrics
 
 # <user name>:<password>@url/<server name>
 SQLALCHEMY_DATABASE_URL = f'postgresql://{settings.db_username}:{settings.db_password}@{settings.db_hostname}/{settings.db_name}'
+
+# pool and statement cache options shared by the sync and async engines (and the replicas)
+POOL_OPTIONS = {
+    'pool_size': settings.db_pool_size,
+    'max_overflow': settings.db_max_overflow,
+    'pool_timeout': settings.db_pool_timeout,
+    'pool_recycle': settings.db_pool_recycle,
+    'pool_pre_ping': settings.db_pool_pre_ping,
+    'query_cache_size': settings.db_compiled_cache_size,
+}
+
+# statement_timeout is set for every connection (primary and replicas): through the libpq options parameter for
+# psycopg2, and through server_settings for asyncpg, which takes postgres settings that way
+CONNECT_ARGS = {'options': f'-c statement_timeout={settings.db_statement_timeout_ms}'}
+ASYNC_CONNECT_ARGS = {'server_settings': {'statement_timeout': str(settings.db_statement_timeout_ms)}}
+
+# asyncpg prepares every statement it runs. with a cache the prepared statement is reused on the same
+# connection, so postgres skips parsing (and after a few runs planning) for the hot queries
+ASYNC_URL_QUERY = f'?prepared_statement_cache_size={settings.db_prepared_statement_cache_size}'
+
+# pool_metrics collects checkout/wait/churn numbers for whichever engine is serving requests
+pool_metrics = PoolMetrics()
+
 # the engine is responsible for establishing the database connection
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=QueuePool if settings.db_async else pool_metrics.pool_class(
+        QueuePool),
+    connect_args=CONNECT_ARGS,
+    **POOL_OPTIONS)
 # creating the base classes for session and data model
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False lets routes return objects they loaded or wrote (RETURNING) after committing
+# without the session reloading every attribute with another SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False,
+                            expire_on_commit=False, bind=engine)
+
+if not settings.db_async:
+    pool_metrics.attach(engine)
 
 
 # Dependency function
 # this function creates a new local session for each database connection request
-def get_db():
+def get_db(request: Request):
     db = SessionLocal()
+    # lets replicas.py see who committed through this session (read-your-writes)
+    db.info['authorization'] = request.headers.get('authorization')
     try:
         yield db
     finally:
         db.close()
+
+
+# async database stack (enabled with DB_ASYNC=true). the asyncpg driver is only imported when it's turned on
+if settings.db_async:
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    ASYNC_SQLALCHEMY_DATABASE_URL = f'postgresql+asyncpg://{settings.db_username}:{settings.db_password}@{settings.db_hostname}/{settings.db_name}' + ASYNC_URL_QUERY
+    async_engine = create_async_engine(
+        ASYNC_SQLALCHEMY_DATABASE_URL,
+        poolclass=pool_metrics.pool_class(AsyncAdaptedQueuePool),
+        connect_args=ASYNC_CONNECT_ARGS,
+        **POOL_OPTIONS)
+    # expire_on_commit=False keeps loaded attributes usable after commit. in async code an expired attribute
+    # would need another round trip to the database, which can't happen implicitly
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession,
+                                     autocommit=False, autoflush=False, expire_on_commit=False)
+    # pool events are registered on the sync engine that the async engine wraps
+    pool_metrics.attach(async_engine.sync_engine)
+
+
+# async version of get_db. the session is closed when the request is finished
+async def get_async_db(request: Request):
+    async with AsyncSessionLocal() as db:
+        db.info['authorization'] = request.headers.get('authorization')
+        yield db
+
+
+# closes every pooled connection (primary and replicas). called when the app shuts down
+async def dispose_engines():
+    from . import replicas
+
+    engine.dispose()
+    if settings.db_async:
+        await async_engine.dispose()
+    for replica in replicas.replicas:
+        if settings.db_async:
+            await replica.engine.dispose()
+        else:
+            replica.engine.dispose()
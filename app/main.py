@@ -1,8 +1,17 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from .config import settings
 from .database import engine
 from .models import Base
-from .routers import post, user, auth, vote
+from . import utils, database, profiling, rate_limit, replicas, vote_buffer, compression
+
+# the sync and async routers serve the same routes. which ones are used is picked by the DB_ASYNC setting
+if settings.db_async:
+    from .routers import (async_post as post, async_user as user, async_auth as auth, async_vote as vote,
+                          async_export as export)
+else:
+    from .routers import post, user, auth, vote, export
+from .routers import metrics, keys, health
 
 
 # creating database models for ORM
@@ -18,15 +27,50 @@ app.add_middleware(
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    # browsers only let javascript read headers that are explicitly exposed
+    expose_headers=['X-Next-Cursor', 'Server-Timing']
 )
 
+# optional rate limiting and load shedding. added before the profiling middleware so rejected requests
+# still show up in the request metrics
+if settings.rate_limit_enabled:
+    app.add_middleware(rate_limit.RateLimitMiddleware)
+
+# optional response compression. inside the profiling middleware so its cost shows up in the request times
+if settings.compression_enabled:
+    app.add_middleware(compression.CompressionMiddleware)
+
+# optional per request timing: Server-Timing headers, request metrics on /metrics and slow request logs.
+# added last so it's the outermost middleware and its total includes everything else
+if settings.profiling_enabled:
+    profiling.instrument_engine(
+        database.async_engine.sync_engine if settings.db_async else engine, database.pool_metrics)
+    # reads served by a replica count towards the request's db time like the primary's
+    for replica in replicas.replicas:
+        profiling.instrument_engine(replica.sync_engine, replica.pool_metrics)
+    app.add_middleware(profiling.ProfilingMiddleware)
+
 
 # router objects allow us to break the code for different routes to other files
 app.include_router(post.router)
 app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(export.router)
+app.include_router(metrics.router)
+app.include_router(keys.router)
+app.include_router(health.router)
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    health.draining.set()
+    utils.shutdown_hash_pool()
+    # write the buffered votes before the process exits (this waits for the last flush)
+    vote_buffer.vote_buffer.close()
+    # close the pooled connections now instead of leaving them for the database to time out
+    await database.dispose_engines()
 
 
 @app.get('/', tags=['Root'])
@@ -0,0 +1,177 @@
+import threading
+import time
+from sqlalchemy import event, exc
+
+
+# connection pool metrics collected from sqlalchemy pool events.
+# these are the numbers needed to size pool_size/max_overflow against postgres max_connections:
+# how many connections are in use, how long requests wait for one and how often connections are opened and closed
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.engine = None
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.connections_invalidated = 0
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        # functions called with the wait time of every checkout (used by the request profiler)
+        self.wait_listeners = []
+
+    # returns a subclass of the given pool class that times how long each checkout waits for a connection.
+    # sqlalchemy has no event for "started waiting", so the wait is measured around the pool's own _do_get
+    def pool_class(self, base):
+        metrics = self
+
+        class TimedPool(base):
+            def _do_get(self):
+                start = time.perf_counter()
+                timed_out = False
+                try:
+                    return super()._do_get()
+                except exc.TimeoutError:
+                    timed_out = True
+                    raise
+                finally:
+                    metrics.record_wait(time.perf_counter() - start, timed_out)
+
+        TimedPool.__name__ = f'Timed{base.__name__}'
+        return TimedPool
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.checkout_timeouts += 1
+            else:
+                self.checkouts += 1
+            self.checkout_wait_total += seconds
+            self.checkout_wait_max = max(self.checkout_wait_max, seconds)
+        for listener in self.wait_listeners:
+            listener(seconds)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connections_opened += 1
+
+    def _on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connections_closed += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.connections_invalidated += 1
+
+    # listens to the pool events of a (sync) engine. for an async engine pass async_engine.sync_engine
+    def attach(self, engine):
+        self.engine = engine
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'close', self._on_close)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def snapshot(self):
+        pool = self.engine.pool
+        with self._lock:
+            waits = self.checkouts + self.checkout_timeouts
+            return {
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                # overflow() is negative while the pool hasn't opened all of its pool_size connections yet
+                'overflow': max(pool.overflow(), 0),
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'checkout_wait_avg_ms': (self.checkout_wait_total / waits * 1000) if waits else 0.0,
+                'checkout_wait_max_ms': self.checkout_wait_max * 1000,
+                'connections_opened': self.connections_opened,
+                'connections_closed': self.connections_closed,
+                'connections_invalidated': self.connections_invalidated,
+            }
+
+
+# timings for password hashing calls sent to the hashing process pool.
+# queue time is how long a call waited for a free worker, run time is the bcrypt work itself
+class HashMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_time_total = 0.0
+        self.run_time_total = 0.0
+        self.run_time_max = 0.0
+
+    def record_call(self, queue_time: float, run_time: float):
+        with self._lock:
+            self.calls += 1
+            self.queue_time_total += queue_time
+            self.run_time_total += run_time
+            self.run_time_max = max(self.run_time_max, run_time)
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'queue_time_avg_ms': (self.queue_time_total / self.calls * 1000) if self.calls else 0.0,
+                'run_time_avg_ms': (self.run_time_total / self.calls * 1000) if self.calls else 0.0,
+                'run_time_max_ms': self.run_time_max * 1000,
+            }
+
+
+# counters for the write-behind vote buffer (vote_buffer.py)
+class VoteBufferMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.depth = 0
+        self.buffered = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_votes = 0
+        self.flush_time_total = 0.0
+        self.flush_time_max = 0.0
+
+    def set_depth(self, depth: int):
+        with self._lock:
+            self.depth = depth
+
+    def record_buffered(self):
+        with self._lock:
+            self.buffered += 1
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_flush(self, votes: int, seconds: float, failed: bool = False):
+        with self._lock:
+            self.flushes += 1
+            self.failed_flushes += failed
+            self.flushed_votes += votes
+            self.flush_time_total += seconds
+            self.flush_time_max = max(self.flush_time_max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'depth': self.depth,
+                'buffered': self.buffered,
+                'rejected': self.rejected,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'flushed_votes': self.flushed_votes,
+                'votes_per_flush_avg': (self.flushed_votes / self.flushes) if self.flushes else 0.0,
+                'flush_time_avg_ms': (self.flush_time_total / self.flushes * 1000) if self.flushes else 0.0,
+                'flush_time_max_ms': self.flush_time_max * 1000,
+            }
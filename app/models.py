@@ -1,29 +1,59 @@
 # models dictate data types and structure of thr tables in the database
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.sql.sqltypes import TIMESTAMP
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, String, Boolean, Computed, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 
 
 Base = declarative_base()
 
 
+# posts is partitioned by month of created_at (see app/partitions.py), so the primary key has to include
+# created_at. the ORM still identifies a post by its id alone
 class Post(Base):
     __tablename__ = 'posts'
 
-    id = Column(Integer, primary_key=True, nullable=False)
+    # sqlalchemy only autoincrements a single column primary key by itself. autoincrement=True keeps id a
+    # SERIAL (posts_id_seq, the sequence the migration uses) and lets inserts leave it to the database
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     published = Column(Boolean, server_default='TRUE', nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True),
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True,
                         nullable=False, server_default=text('now()'))
     user_id = Column(Integer, ForeignKey('users.id',
                                          ondelete='CASCADE'), nullable=False)
+    # number of rows in votes for this post. kept up to date by the vote route so reads don't have to count
+    vote_count = Column(Integer, server_default='0', nullable=False)
+    # generated by postgres from title and content (title words weighted higher) and used for full-text search.
+    # Computed tells sqlalchemy never to write to this column. it's only searched, never shown, so deferred
+    # keeps it out of every select(Post), otherwise each post read would carry a copy of its content as a tsvector
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+        persisted=True)))
 
     user = relationship('User')
 
+    __table_args__ = (
+        # lookups by id alone (GET /posts/{id}) can't be pruned to one partition, this index is searched in each
+        Index('ix_posts_id', id),
+        # serves the newest-first posts of one author (GET /posts/me and /posts/user/{user_id}) and, through its
+        # leading user_id, the ON DELETE CASCADE from users
+        Index('ix_posts_user_id_created_at_id', user_id, created_at, id),
+        # serves the newest-first ordering and keyset cursor of GET /posts
+        Index('ix_posts_created_at_id', created_at, id),
+        # by name, the attribute is the deferred property and not the column
+        Index('ix_posts_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_posts_title_trgm', title, postgresql_using='gin',
+              postgresql_ops={'title': 'gin_trgm_ops'}),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+    __mapper_args__ = {'primary_key': [id]}
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -40,5 +70,24 @@ class Vote(Base):
 
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'),
                      primary_key=True)
-    post_id = Column(Integer, ForeignKey('posts.id', ondelete='CASCADE'),
-                     primary_key=True)
+    # no foreign key: posts.id is not unique on its own in the partitioned posts table.
+    # a trigger on posts deletes the votes of deleted posts instead
+    post_id = Column(Integer, primary_key=True)
+
+    # the primary key starts with user_id, so lookups by post_id need their own index
+    __table_args__ = (
+        Index('ix_votes_post_id', post_id),
+        {'postgresql_partition_by': 'HASH (post_id)'},
+    )
+
+
+# the most voted posts created within the trending window. kept up to date by the vote routes
+# (see trending.py) so GET /posts/trending never has to rank every post of the window
+class TrendingPost(Base):
+    __tablename__ = 'trending_posts'
+
+    # removed by the same trigger as the votes when its post is deleted
+    post_id = Column(Integer, primary_key=True)
+    votes = Column(Integer, nullable=False)
+    # copied from the post so posts that left the window can be dropped without a join
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
@@ -1,9 +1,15 @@
+import hashlib
+import time
 from fastapi import Depends, status, HTTPException
-from jose import jwt, JWTError
+from jose import JWTError
 from datetime import datetime, timedelta
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import event, lambda_stmt
 from sqlalchemy.orm import Session
-from . import schemas, database, models, config
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from . import schemas, database, models, config, token_keys
+from .cache import TTLCache
 
 
 # oauth2_scheme in this case is used as a dependency that checks the request headers for
@@ -18,6 +24,14 @@ SECRET_KEY = config.settings.secret_key
 ALGORITHM = config.settings.algorithm
 TOKEN_EXPIRE_MINUTES = config.settings.token_expire_minutes
 
+# users looked up by get_current_user, keyed by id
+user_cache = TTLCache(maxsize=config.settings.user_cache_size,
+                      ttl=config.settings.user_cache_ttl_seconds)
+
+# verified tokens, keyed by the sha256 of the token so the tokens themselves aren't kept in memory
+token_cache = TTLCache(maxsize=config.settings.token_cache_size,
+                       ttl=config.settings.token_cache_ttl_seconds)
+
 
 def create_access_token(payload: dict):
     # copy the data so we do not modify the original
@@ -29,16 +43,22 @@ def create_access_token(payload: dict):
     # add the expiration to our raw token
     data_to_encode.update({'exp': expire})
 
-    token = jwt.encode(data_to_encode, SECRET_KEY,
-                       algorithm=ALGORITHM)
+    # signed with SECRET_KEY or the private key, depending on ALGORITHM (see token_keys.py)
+    token = token_keys.encode(data_to_encode)
 
     return token
 
 
+# the same token is sent with every request until it expires, so once its signature has been checked
+# the TokenData is cached. the entry expires with the token (or sooner, after token_cache_ttl_seconds)
 def verify_acces_token(token: str, creds_exception):
+    cache_key = hashlib.sha256(token.encode()).digest()
+    token_data = token_cache.get(cache_key)
+    if token_data is not None:
+        return token_data
+
     try:
-        payload = jwt.decode(token, SECRET_KEY,
-                             algorithms=[ALGORITHM])
+        payload = token_keys.decode(token)
         user_id = payload.get('user_id')
 
         if not user_id:
@@ -48,17 +68,93 @@ def verify_acces_token(token: str, creds_exception):
     except JWTError:
         raise creds_exception
 
+    token_cache.set(cache_key, token_data,
+                    min(token_cache.ttl, payload.get('exp', 0) - time.time()))
     return token_data
 
 
+# the user id of a valid token, or None. used where a bad token should just be ignored (rate limiting)
+def user_id_from_token(token: str):
+    try:
+        return int(verify_acces_token(token, creds_exception=ValueError()).user_id)
+    except ValueError:
+        return None
+
+
+def credentials_exception():
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                         detail='Could not validate credentials.',
+                         headers={'WWW-Authenticate': 'Bearer'})
+
+
+# fast path for routes that only need the id of the logged in user.
+# the signature of the token proves who the user is, so no database session or query is needed.
+# (a user deleted after the token was issued is still accepted until the token expires)
+async def get_current_principal(token: str = Depends(oauth2_scheme)):
+    token_data = verify_acces_token(
+        token, creds_exception=credentials_exception())
+
+    return schemas.Principal(id=token_data.user_id)
+
+
+# <-- Hot path statements -->
+# lambda_stmt builds a statement once per call site. later calls skip building and compiling it and
+# only pull the new parameter out of the lambda's closure, so the statement is found in sqlalchemy's
+# compiled cache (and asyncpg's prepared statement cache) without any python query construction
+
+
+def user_by_id_statement(user_id: int):
+    return lambda_stmt(lambda: select(models.User).where(models.User.id == user_id))
+
+
+def user_by_email_statement(email: str):
+    return lambda_stmt(lambda: select(models.User).where(models.User.email == email))
+
+
+# for routes that need the full user row. recently used users are served from user_cache
 def get_current_user(token: str = Depends(oauth2_scheme),
                      db: Session = Depends(database.get_db)):
 
-    token_data = verify_acces_token(token, creds_exception=HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                                                         detail='Could not validate credentials.',
-                                                                         headers={'WWW-Authenticate': 'Bearer'}))
-    user_query = db.query(models.User).filter(
-        models.User.id == token_data.user_id)
-    user = user_query.first()
+    token_data = verify_acces_token(
+        token, creds_exception=credentials_exception())
+    user_id = int(token_data.user_id)
 
+    user = user_cache.get(user_id)
+    if user is None:
+        user = db.execute(user_by_id_statement(user_id)).scalars().first()
+        if user:
+            user_cache.set(user_id, user)
+
+    # the token is valid but its user was deleted
+    if user is None:
+        raise credentials_exception()
     return user
+
+
+# async version of get_current_user used by the async routers
+async def get_current_user_async(token: str = Depends(oauth2_scheme),
+                                 db: AsyncSession = Depends(database.get_async_db)):
+
+    token_data = verify_acces_token(
+        token, creds_exception=credentials_exception())
+    # asyncpg doesn't convert strings to integers for us so the id from the token is converted here
+    user_id = int(token_data.user_id)
+
+    user = user_cache.get(user_id)
+    if user is None:
+        result = await db.execute(user_by_id_statement(user_id))
+        user = result.scalars().first()
+        if user:
+            user_cache.set(user_id, user)
+
+    if user is None:
+        raise credentials_exception()
+    return user
+
+
+# drop a user from the cache whenever the ORM updates or deletes it so stale rows are never served.
+# (bulk query.update()/delete() calls don't fire these events and have to call user_cache.delete() themselves)
+@event.listens_for(models.User, 'after_update')
+@event.listens_for(models.User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.delete(target.id)
@@ -0,0 +1,24 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import status, HTTPException
+
+
+# cursors are opaque to the client. they are just the (created_at, id) of the last post on a page
+# serialized to json and base64 encoded so the client can pass it back to get the next page.
+# because (created_at, id) is unique and the posts are always sorted by it, the database can jump
+# straight to the next page with a WHERE clause instead of scanning and discarding an OFFSET prefix
+def encode_cursor(created_at: datetime, id: int):
+    raw = json.dumps([created_at.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        # add back the padding we stripped when encoding
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Invalid pagination cursor.')
@@ -0,0 +1,150 @@
+# maintenance of the partitioned posts table (migration f4a2d6b18c35).
+#
+# posts has one partition per calendar month (UTC) of created_at, named posts_pYYYYMM, and a posts_default
+# partition for anything outside them. votes is hash partitioned by post_id and needs no maintenance.
+#
+#   python -m app.partitions             creates the partitions for the next PARTITION_MONTHS_AHEAD months
+#   python -m app.partitions --archive   also archives partitions older than PARTITION_RETENTION_MONTHS
+#
+# run it from a scheduler (e.g. daily). archiving detaches a month from posts and moves it, with its votes,
+# to PARTITION_ARCHIVE_SCHEMA (or drops both with --drop). archived posts are gone from the api but can be
+# queried or dumped from the archive schema.
+# only statements with a created_at range (keyset cursors, trending, exports) skip partitions. everything
+# that looks a post up by id alone (GET/PUT/DELETE /posts/{id}, votes) probes ix_posts_id in every partition,
+# so its cost grows with the number of months kept: keep PARTITION_RETENTION_MONTHS bounded and run --archive.
+# python -m bench.statements --partitions measures it
+import argparse
+import logging
+import re
+from datetime import datetime, timezone
+from sqlalchemy import text
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(r'^posts_p(\d{4})(\d{2})$')
+
+
+def month_start(moment: datetime):
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime):
+    return f'posts_p{month:%Y%m}'
+
+
+# {month: partition name} of the monthly partitions attached to posts
+def month_partitions(conn):
+    names = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'posts'::regclass")).scalars()
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)] = name
+    return partitions
+
+
+# creates the partition of one month. posts of that month that already landed in posts_default are moved
+# into it (postgres refuses to create the partition while the default partition holds rows that belong to it)
+def create_partition(conn, month: datetime):
+    name, start, end = partition_name(month), month.isoformat(), add_months(month, 1).isoformat()
+    in_default = conn.execute(text(
+        'SELECT EXISTS (SELECT 1 FROM posts_default WHERE created_at >= :start AND created_at < :end)'),
+        {'start': start, 'end': end}).scalar()
+
+    if not in_default:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF posts FOR VALUES FROM ('{start}') TO ('{end}')"))
+        return
+
+    columns = 'id, title, content, published, created_at, user_id, vote_count'
+    conn.execute(text('ALTER TABLE posts DETACH PARTITION posts_default'))
+    conn.execute(text(f"CREATE TABLE {name} PARTITION OF posts FOR VALUES FROM ('{start}') TO ('{end}')"))
+    conn.execute(text(
+        f'INSERT INTO posts ({columns}) SELECT {columns} FROM posts_default '
+        'WHERE created_at >= :start AND created_at < :end'), {'start': start, 'end': end})
+    conn.execute(text('DELETE FROM posts_default WHERE created_at >= :start AND created_at < :end'),
+                 {'start': start, 'end': end})
+    conn.execute(text('ALTER TABLE posts ATTACH PARTITION posts_default DEFAULT'))
+
+
+def create_future_partitions(engine, months_ahead: int):
+    current = month_start(datetime.now(timezone.utc))
+    created = []
+    with engine.connect() as conn:
+        existing = month_partitions(conn)
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if month in existing:
+            continue
+        # one transaction per partition, so a failure leaves the ones before it in place
+        with engine.begin() as conn:
+            create_partition(conn, month)
+        created.append(partition_name(month))
+    return created
+
+
+# detaches a month and moves it out of the api's way together with its votes and trending rows
+def archive_partition(conn, name: str, schema: str, drop: bool):
+    conn.execute(text(f'ALTER TABLE posts DETACH PARTITION {name}'))
+    if not drop:
+        conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS {schema}'))
+        conn.execute(text(
+            f'CREATE TABLE {schema}.{name}_votes AS '
+            f'SELECT votes.* FROM votes JOIN {name} ON {name}.id = votes.post_id'))
+    # the delete trigger doesn't fire for a detached partition, so its votes are removed here
+    conn.execute(text(f'DELETE FROM votes USING {name} WHERE votes.post_id = {name}.id'))
+    conn.execute(text(f'DELETE FROM trending_posts USING {name} WHERE trending_posts.post_id = {name}.id'))
+    if drop:
+        conn.execute(text(f'DROP TABLE {name}'))
+    else:
+        conn.execute(text(f'ALTER TABLE {name} SET SCHEMA {schema}'))
+
+
+def archive_old_partitions(engine, retention_months: int, schema: str, drop: bool = False):
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -retention_months)
+    archived = []
+    with engine.connect() as conn:
+        existing = month_partitions(conn)
+    for month, name in sorted(existing.items()):
+        # only whole months that ended before the cutoff
+        if add_months(month, 1) > cutoff:
+            continue
+        with engine.begin() as conn:
+            archive_partition(conn, name, schema, drop)
+        archived.append(name)
+    return archived
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create and archive posts partitions.')
+    parser.add_argument('--months-ahead', type=int, default=settings.partition_months_ahead)
+    parser.add_argument('--archive', action='store_true',
+                        help='archive partitions older than --retention-months')
+    parser.add_argument('--retention-months', type=int, default=settings.partition_retention_months)
+    parser.add_argument('--drop', action='store_true',
+                        help='drop old partitions and their votes instead of archiving them')
+    args = parser.parse_args(argv)
+
+    from .database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    for name in create_future_partitions(engine, args.months_ahead):
+        logger.info('created partition %s', name)
+    if args.archive:
+        for name in archive_old_partitions(engine, args.retention_months,
+                                           settings.partition_archive_schema, args.drop):
+            logger.info('%s partition %s', 'dropped' if args.drop else 'archived', name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
+from starlette.routing import Match
+from .config import settings
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # the sampling profiler is optional
+    Profiler = None
+
+
+logger = logging.getLogger('app.profiling')
+
+# keep at most this many statement texts per request
+MAX_STATEMENTS = 50
+# histogram buckets for request durations in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# timings collected for one request. sync routes run in the threadpool with a copy of the request's context,
+# and since the copy points to the same RequestStats object the database events can add to it from there
+class RequestStats:
+    def __init__(self):
+        self.db_time = 0.0
+        self.statement_count = 0
+        self.statements = []
+        self.pool_wait = 0.0
+        self.serialization_time = 0.0
+
+
+current_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    'current_stats', default=None)
+
+
+# <-- Database instrumentation -->
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    stats = current_stats.get()
+    if stats is not None:
+        stats.db_time += elapsed
+        stats.statement_count += 1
+        if len(stats.statements) < MAX_STATEMENTS:
+            stats.statements.append(statement)
+
+
+def _record_pool_wait(seconds: float):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+
+# times every SQL statement of the engine (pass async_engine.sync_engine for the async engine)
+def instrument_engine(engine, pool_metrics):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    pool_metrics.wait_listeners.append(_record_pool_wait)
+
+
+# routes wrap their own serialization in this so it shows up separately from the handler time
+class timed_serialization:
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        stats = current_stats.get()
+        if stats is not None:
+            stats.serialization_time += time.perf_counter() - self.start
+
+
+# <-- Metrics -->
+
+
+# request counts and latency histograms per route template, rendered in the prometheus text format
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.db_time = {}
+        self.statements = {}
+
+    def record(self, method: str, route: str, status_code: int, duration: float, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            count_key = (method, route, status_code)
+            self.requests[count_key] = self.requests.get(count_key, 0) + 1
+            buckets, total, count = self.durations.get(
+                key, ([0] * len(DURATION_BUCKETS), 0.0, 0))
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self.durations[key] = (buckets, total + duration, count + 1)
+            self.db_time[key] = self.db_time.get(key, 0.0) + stats.db_time
+            self.statements[key] = self.statements.get(
+                key, 0) + stats.statement_count
+
+    def render(self):
+        lines = ['# TYPE http_requests_total counter']
+        with self._lock:
+            for (method, route, code), count in sorted(self.requests.items()):
+                lines.append(
+                    f'http_requests_total{{method="{method}",route="{route}",status="{code}"}} {count}')
+
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for (method, route), (buckets, total, count) in sorted(self.durations.items()):
+                labels = f'method="{method}",route="{route}"'
+                for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(
+                        f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(
+                    f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(
+                    f'http_request_duration_seconds_sum{{{labels}}} {total}')
+                lines.append(
+                    f'http_request_duration_seconds_count{{{labels}}} {count}')
+
+            lines.append('# TYPE http_request_db_seconds_total counter')
+            for (method, route), total in sorted(self.db_time.items()):
+                lines.append(
+                    f'http_request_db_seconds_total{{method="{method}",route="{route}"}} {total}')
+
+            lines.append('# TYPE http_request_db_statements_total counter')
+            for (method, route), total in sorted(self.statements.items()):
+                lines.append(
+                    f'http_request_db_statements_total{{method="{method}",route="{route}"}} {total}')
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+
+# renders a snapshot dict (like PoolMetrics.snapshot()) as prometheus gauges
+def render_gauges(prefix: str, snapshot: dict):
+    lines = []
+    for name, value in snapshot.items():
+        lines.append(f'# TYPE {prefix}_{name} gauge')
+        lines.append(f'{prefix}_{name} {value}')
+    return lines
+
+
+# the same gauges for several instances told apart by a label, e.g. {'db-2:5432': snapshot} with label='replica'
+def render_labeled_gauges(prefix: str, label: str, snapshots: dict):
+    lines = []
+    names = next(iter(snapshots.values())).keys() if snapshots else []
+    for name in names:
+        lines.append(f'# TYPE {prefix}_{name} gauge')
+        for instance, snapshot in snapshots.items():
+            lines.append(f'{prefix}_{name}{{{label}="{instance}"}} {snapshot[name]}')
+    return lines
+
+
+# <-- Middleware -->
+
+
+# plain ASGI middleware (no BaseHTTPMiddleware) so it adds almost nothing to each request.
+# it times the request, adds a Server-Timing header that browsers show in their dev tools, records
+# the request in request_metrics and logs slow requests with their SQL
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def route_template(self, scope):
+        # the path with its parameters (/posts/{id}) so all posts share one set of metrics
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+
+        profiler = None
+        if Profiler is not None and settings.profiler_sample_rate and random.random() < settings.profiler_sample_rate:
+            profiler = Profiler(async_mode='enabled')
+            profiler.start()
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                total = (time.perf_counter() - start) * 1000
+                server_timing = (f'total;dur={total:.2f}, '
+                                 f'db;dur={stats.db_time * 1000:.2f};desc="{stats.statement_count} statements", '
+                                 f'pool;dur={stats.pool_wait * 1000:.2f}, '
+                                 f'ser;dur={stats.serialization_time * 1000:.2f}')
+                message.setdefault('headers', []).append(
+                    (b'server-timing', server_timing.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            duration = time.perf_counter() - start
+            current_stats.reset(token)
+            route = self.route_template(scope)
+            request_metrics.record(
+                scope['method'], route, status_code, duration, stats)
+
+            if profiler is not None:
+                profiler.stop()
+            if duration * 1000 >= settings.profiling_slow_request_ms:
+                logger.warning('slow request %s %s: %.1fms total, %.1fms db (%d statements), %.1fms pool wait\n%s',
+                               scope['method'], route, duration * 1000, stats.db_time * 1000,
+                               stats.statement_count, stats.pool_wait * 1000, '\n'.join(stats.statements))
+                if profiler is not None:
+                    logger.warning('profile of %s %s\n%s', scope['method'], route,
+                                   profiler.output_text(unicode=False))
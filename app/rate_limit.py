@@ -0,0 +1,192 @@
+import inspect
+import ipaddress
+import json
+import math
+import time
+from .cache import TTLCache
+from .config import settings
+from . import oauth2
+
+
+# <-- Token bucket stores -->
+# acquire(key, rate, burst, cost) takes cost tokens from the bucket called key and returns (allowed, retry_after).
+# a bucket starts full with burst tokens and refills at rate tokens per second
+
+
+# buckets kept in the worker process. each worker limits on its own, so the effective limit is
+# the configured one times the number of workers
+class MemoryBucketStore:
+    def __init__(self, maxsize: int = 100_000):
+        # a bucket that hasn't been touched for burst / rate seconds is full again, so it can be forgotten
+        self._buckets = TTLCache(maxsize=maxsize)
+
+    async def acquire(self, key: str, rate: float, burst: int, cost: int):
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+
+        allowed = tokens >= cost
+        retry_after = 0.0
+        if allowed:
+            tokens -= cost
+        else:
+            retry_after = (cost - tokens) / rate
+        self._buckets.set(key, (tokens, now), ttl=burst / rate + 1)
+        return allowed, retry_after
+
+
+# the same bucket kept in redis so every worker and server shares one limit.
+# the refill and take run in one lua script, so concurrent requests can't both spend the same tokens.
+# takes any redis-py compatible client (sync or redis.asyncio), so tests can pass a local fake
+class RedisBucketStore:
+    SCRIPT = '''
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(state[1]) or burst
+    local updated_at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+    local allowed = 0
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    else
+        retry_after = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(retry_after)}
+    '''
+
+    def __init__(self, client, prefix: str = 'rate-limit:'):
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str):
+        import redis.asyncio
+        return cls(redis.asyncio.Redis.from_url(url))
+
+    async def acquire(self, key: str, rate: float, burst: int, cost: int):
+        result = self.script(keys=[self.prefix + key],
+                             args=[rate, burst, cost, time.time()])
+        if inspect.isawaitable(result):
+            result = await result
+        allowed, retry_after = result
+        return bool(int(allowed)), float(retry_after)
+
+
+def make_store():
+    if settings.rate_limit_backend == 'redis':
+        return RedisBucketStore.from_url(settings.redis_url)
+    return MemoryBucketStore()
+
+
+# <-- Middleware -->
+
+
+def _normalize(route: str):
+    return route.rstrip('/') or '/'
+
+
+# rate limiting and load shedding in front of every route (plain ASGI middleware).
+# 1. more than max_concurrent_requests requests in flight: 503 with Retry-After, before the request can queue on the db pool
+# 2. the client IP's bucket and (when a valid token is sent) the user's bucket are charged the route's cost:
+#    429 with Retry-After when either is empty
+class RateLimitMiddleware:
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store if store is not None else make_store()
+        self.route_costs = {_normalize(route): cost
+                            for route, cost in settings.rate_limit_route_costs.items()}
+        self.max_concurrent = settings.max_concurrent_requests
+        if self.max_concurrent is None:
+            self.max_concurrent = settings.db_pool_size + settings.db_max_overflow
+        self.in_flight = 0
+        self.forwarded_for = (settings.rate_limit_forwarded_for_header or '').lower().encode('latin-1')
+        self.trusted_proxies = [ipaddress.ip_network(proxy, strict=False)
+                                for proxy in settings.rate_limit_trusted_proxies]
+
+    def trusted(self, address: str):
+        if not self.trusted_proxies:
+            return True
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    # the address the ip bucket is keyed on. a forwarded-for header lists the client and then every proxy
+    # in between, and only the entries our own proxies appended can be believed, so the right-most
+    # address that isn't one of them is the client
+    def client_ip(self, scope):
+        client = scope.get('client')
+        peer = client[0] if client else None
+        if not self.forwarded_for or peer is None or not self.trusted(peer):
+            return peer
+        for name, value in scope['headers']:
+            if name == self.forwarded_for:
+                hops = [hop.strip() for hop in value.decode('latin-1').split(',') if hop.strip()]
+                if not hops:
+                    return peer
+                # without a list of proxies only the entry the load balancer itself appended can be believed
+                if not self.trusted_proxies:
+                    return hops[-1]
+                for hop in reversed(hops):
+                    if not self.trusted(hop):
+                        return hop
+                return hops[0]
+        return peer
+
+    def cost(self, scope):
+        return self.route_costs.get(_normalize(f"{scope['method']} {scope['path']}"), 1)
+
+    def user_id(self, scope):
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                scheme, _, token = value.decode('latin-1').partition(' ')
+                if scheme.lower() == 'bearer' and token:
+                    return oauth2.user_id_from_token(token)
+        return None
+
+    async def reject(self, send, status_code: int, detail: str, retry_after: float):
+        body = json.dumps({'detail': detail}).encode()
+        await send({'type': 'http.response.start', 'status': status_code, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'retry-after', str(max(math.ceil(retry_after), 1)).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def __call__(self, scope, receive, send):
+        # health probes are never limited, a busy server must not look dead to its orchestrator
+        if scope['type'] != 'http' or scope['path'].startswith('/health/'):
+            return await self.app(scope, receive, send)
+
+        # the middleware runs on the event loop, so the counter doesn't need a lock. the request counts as in
+        # flight from here, before the bucket checks await, so requests waiting on the store can't all slip past the cap
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            return await self.reject(send, 503, 'Server is busy. Please try again shortly.', 1)
+        self.in_flight += 1
+        try:
+            cost = self.cost(scope)
+            client_ip = self.client_ip(scope)
+            if client_ip:
+                allowed, retry_after = await self.store.acquire(f'ip:{client_ip}', settings.rate_limit_ip_rate,
+                                                                settings.rate_limit_ip_burst, cost)
+                if not allowed:
+                    return await self.reject(send, 429, 'Too many requests.', retry_after)
+
+            user_id = self.user_id(scope)
+            if user_id is not None:
+                allowed, retry_after = await self.store.acquire(f'user:{user_id}', settings.rate_limit_user_rate,
+                                                                settings.rate_limit_user_burst, cost)
+                if not allowed:
+                    return await self.reject(send, 429, 'Too many requests.', retry_after)
+
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,186 @@
+# read replica routing for GET routes.
+#
+# get_read_db (and get_async_read_db) hand read-only routes a session on one of the replicas in
+# DB_REPLICA_URLS instead of the primary. a replica is picked round robin or by the fewest checked out
+# connections, replicas that fail are skipped until replica_retry_seconds have passed, and with no healthy
+# replica the primary is used.
+# replicas lag behind the primary a little, so after a user commits a write their reads stay on the
+# primary for read_your_writes_seconds
+import itertools
+import threading
+import time
+from fastapi import Request
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from . import database, oauth2
+from .config import settings
+from .metrics import PoolMetrics
+from .response_cache import MemoryBackend, RedisBackend
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        # host:port, the replica's label in /metrics (the url itself holds the password)
+        parsed = make_url(url)
+        self.name = f'{parsed.host}:{parsed.port or 5432}'
+        self.healthy = True
+        self.failed_at = 0.0
+        # the replica has its own pool, so its own pool metrics. the engines take the same options and
+        # statement_timeout as the primary's (see database.py)
+        self.pool_metrics = PoolMetrics()
+        if settings.db_async:
+            from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+            from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+            async_url = url.replace('postgresql://', 'postgresql+asyncpg://', 1) + database.ASYNC_URL_QUERY
+            self.engine = create_async_engine(async_url,
+                                              poolclass=self.pool_metrics.pool_class(AsyncAdaptedQueuePool),
+                                              connect_args=database.ASYNC_CONNECT_ARGS, **database.POOL_OPTIONS)
+            self.sessionmaker = sessionmaker(self.engine, class_=AsyncSession, autocommit=False,
+                                             autoflush=False, expire_on_commit=False)
+            self.sync_engine = self.engine.sync_engine
+        else:
+            self.engine = create_engine(url, poolclass=self.pool_metrics.pool_class(QueuePool),
+                                        connect_args=database.CONNECT_ARGS, **database.POOL_OPTIONS)
+            self.sessionmaker = sessionmaker(autocommit=False, autoflush=False,
+                                             expire_on_commit=False, bind=self.engine)
+            self.sync_engine = self.engine
+        self.pool_metrics.attach(self.sync_engine)
+        # a connection error on this replica takes it out of rotation
+        event.listen(self.sync_engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect or isinstance(context.original_exception, exc.OperationalError):
+            self.mark_failed()
+
+    def mark_failed(self):
+        self.healthy = False
+        self.failed_at = time.monotonic()
+
+    # an unhealthy replica gets another try once the retry interval has passed
+    def should_retry(self):
+        return not self.healthy and time.monotonic() - self.failed_at >= settings.replica_retry_seconds
+
+    def checked_out(self):
+        return self.sync_engine.pool.checkedout()
+
+
+replicas = [Replica(url) for url in settings.db_replica_urls]
+_round_robin = itertools.cycle(range(len(replicas))) if replicas else None
+_round_robin_lock = threading.Lock()
+
+
+# <-- Read-your-writes -->
+
+if settings.read_your_writes_backend == 'redis':
+    recent_writes = RedisBackend.from_url(settings.redis_url)
+else:
+    recent_writes = MemoryBackend(maxsize=100_000)
+
+
+def _user_id(authorization):
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return oauth2.user_id_from_token(token)
+
+
+# every committed session that came from get_db/get_async_db marks its user as a recent writer.
+# read sessions never commit, so only real writes count
+@event.listens_for(Session, 'after_commit')
+def mark_recent_write(session):
+    if not replicas or settings.read_your_writes_seconds <= 0:
+        return
+    user_id = _user_id(session.info.get('authorization'))
+    if user_id is not None:
+        recent_writes.set(f'recent-write:{user_id}', b'1',
+                          settings.read_your_writes_seconds)
+
+
+def wrote_recently(request: Request):
+    user_id = _user_id(request.headers.get('authorization'))
+    return user_id is not None and recent_writes.get(f'recent-write:{user_id}') is not None
+
+
+# <-- Picking a replica -->
+
+
+def candidates():
+    return [replica for replica in replicas if replica.healthy or replica.should_retry()]
+
+
+def pick(available):
+    if settings.db_replica_balancing == 'least_connections':
+        return min(available, key=lambda replica: replica.checked_out())
+    with _round_robin_lock:
+        for _ in range(len(replicas)):
+            replica = replicas[next(_round_robin)]
+            if replica in available:
+                return replica
+    return available[0]
+
+
+def choose_replica(request: Request):
+    if not replicas or wrote_recently(request):
+        return None
+    available = candidates()
+    return pick(available) if available else None
+
+
+# the engine a read should use, for code that manages its own connection (the export streams).
+# replicas waiting for a retry are skipped here, there is no session to fall back from
+def read_engine(request: Request):
+    replica = choose_replica(request)
+    if replica is not None and replica.healthy:
+        return replica.engine
+    return database.async_engine if settings.db_async else database.engine
+
+
+# Dependency function for read-only routes
+def get_read_db(request: Request):
+    replica = choose_replica(request)
+    if replica is not None and not replica.healthy:
+        # retrying a failed replica: make sure it answers before handing it to the route
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            replica.healthy = True
+        except exc.DBAPIError:
+            replica.mark_failed()
+            replica = None
+
+    if replica is None:
+        yield from database.get_db(request)
+        return
+
+    db = replica.sessionmaker()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# async version of get_read_db
+async def get_async_read_db(request: Request):
+    replica = choose_replica(request)
+    if replica is not None and not replica.healthy:
+        try:
+            async with replica.engine.connect() as conn:
+                await conn.execute(text('SELECT 1'))
+            replica.healthy = True
+        except exc.DBAPIError:
+            replica.mark_failed()
+            replica = None
+
+    if replica is None:
+        async for db in database.get_async_db(request):
+            yield db
+        return
+
+    async with replica.sessionmaker() as db:
+        yield db
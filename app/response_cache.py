@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import Optional
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from . import compression
+from .cache import TTLCache
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# <-- Backends -->
+# a backend stores bytes by key with a time to live, and keeps counters (used as cache generations).
+# anything with these six methods can be plugged into ResponseCache
+
+
+# cache inside the worker process. fastest, but every worker has its own copy and its own generations,
+# so a write only invalidates the cache of the worker that served it
+class MemoryBackend:
+    def __init__(self, maxsize: int = 1024, ttl: float = 30):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        return self._cache.get(key)
+
+    # set and add share the lock, so add can't overwrite a value set between its check and its write
+    def set(self, key: str, value: bytes, ttl: float):
+        with self._lock:
+            self._cache.set(key, value, ttl=ttl)
+
+    # sets the key only when it has no value, and returns whether it did
+    def add(self, key: str, value: bytes, ttl: float):
+        with self._lock:
+            if self._cache.get(key) is not None:
+                return False
+            self._cache.set(key, value, ttl=ttl)
+            return True
+
+    def delete(self, *keys: str):
+        for key in keys:
+            self._cache.delete(key)
+
+    def get_counter(self, key: str):
+        return self._counters.get(key, 0)
+
+    def incr(self, key: str):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+# cache shared by every worker (and server) through redis. takes any redis-py compatible client,
+# so tests can pass a local fake such as fakeredis.FakeRedis()
+class RedisBackend:
+    def __init__(self, client, prefix: str = 'response-cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str):
+        # redis is only needed when this backend is used
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.client.set(self.prefix + key, value, ex=max(int(ttl), 1))
+
+    def add(self, key: str, value: bytes, ttl: float):
+        return bool(self.client.set(self.prefix + key, value, ex=max(int(ttl), 1), nx=True))
+
+    def delete(self, *keys: str):
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+    def get_counter(self, key: str):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key: str):
+        return self.client.incr(self.prefix + key)
+
+
+# <-- Cached responses -->
+
+
+# an already serialized JSON body and its headers. the ETag is a hash of the body,
+# so a client that sends it back in If-None-Match gets an empty 304 when nothing changed.
+# encoded holds the same body compressed with each encoding in use (see compression.py)
+class CachedResponse:
+    def __init__(self, body: bytes, headers: Optional[dict] = None, encoded: Optional[dict] = None):
+        self.body = body
+        self.headers = dict(headers or {})
+        self.encoded = encoded or {}
+        if 'ETag' not in self.headers:
+            self.headers['ETag'] = '"' + \
+                hashlib.sha1(body).hexdigest()[:20] + '"'
+
+    # stored as one line of JSON headers followed by the body and then the compressed bodies.
+    # the sizes of the compressed bodies are kept with the headers under '_encoded'
+    def to_bytes(self):
+        headers = {**self.headers, '_encoded': {encoding: len(body) for encoding, body in self.encoded.items()}}
+        return json.dumps(headers).encode() + b'\n' + self.body + b''.join(self.encoded.values())
+
+    @classmethod
+    def from_bytes(cls, value: bytes):
+        headers, body = value.split(b'\n', 1)
+        headers = json.loads(headers)
+        sizes = headers.pop('_encoded', {})
+        end = len(body) - sum(sizes.values())
+        plain, encoded = body[:end], {}
+        for encoding, size in sizes.items():
+            encoded[encoding] = body[end:end + size]
+            end += size
+        return cls(plain, headers, encoded)
+
+    def not_modified(self, request: Request):
+        if_none_match = request.headers.get('if-none-match')
+        if not if_none_match:
+            return False
+        # the header may hold several etags, or weak ones (W/"..."), or the etag of a compressed body
+        tags = [compression.strip_etag_encoding(tag.strip().replace('W/', '', 1))
+                for tag in if_none_match.split(',')]
+        return '*' in tags or self.headers['ETag'] in tags
+
+    def to_response(self, request: Request):
+        encoding = compression.negotiate(request.headers.get('accept-encoding'))
+        headers = self.headers
+        if encoding in self.encoded:
+            headers = {**headers, 'ETag': compression.encoded_etag(headers['ETag'], encoding),
+                       'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+
+        if self.not_modified(request):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers={'ETag': headers['ETag']})
+        # served as stored, the compression middleware leaves responses with a Content-Encoding alone
+        return Response(content=self.encoded.get(encoding, self.body), media_type='application/json',
+                        headers=headers)
+
+
+# turns route results into JSON bytes the same way the response_model would
+def serialize(response_model, content):
+    return json.dumps(jsonable_encoder(parse_obj_as(response_model, content))).encode()
+
+
+# caches post responses by key.
+# list pages are cached under a generation number that every post write bumps, so all cached pages are dropped
+# at once without having to know which pages a post was on. a post detail is cached under that post's own
+# version, so a vote on one post doesn't drop the cached details of every other post.
+# a version is the generation the post was last written at, so versions only ever grow. a post without one
+# (never written, or its version was evicted or expired) is given the current generation, which is at least
+# as new as any version it had.
+# a read that started before a write can finish after it. set() notices the version moved on and doesn't
+# store that response, otherwise the old post would be served under the new version until the ttl ran out
+class ResponseCache:
+    POSTS_GENERATION = 'posts:generation'
+    # set for read_your_writes_seconds after a write when reads go to replicas, see set()
+    RECENT_WRITE = 'posts:recent-write'
+    # kept much longer than the responses, losing one only makes that post's cached detail miss once
+    POST_VERSION_TTL_SECONDS = 3600
+
+    def __init__(self, backend, ttl: float = 30):
+        self.backend = backend
+        self.ttl = ttl
+
+    # a cache that can't be reached must never fail a request: reads count as misses and writes are skipped.
+    # a skipped invalidation leaves older entries to expire with their ttl
+    def _backend(self, method: str, *args):
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception:
+            logger.warning('response cache %s failed', method, exc_info=True)
+            return None
+
+    def generation(self):
+        return self._backend('get_counter', self.POSTS_GENERATION)
+
+    def post_version(self, id: int):
+        version = self._backend('get', f'post-version:{id}')
+        if version is not None:
+            return int(version)
+        # recorded so the post keeps this version until it's written. add() never replaces a version that
+        # invalidate_posts set in the meantime, and if one was set set() sees it and skips the older read
+        generation = self.generation()
+        if generation is not None:
+            self._backend('add', f'post-version:{id}', str(generation).encode(), self.POST_VERSION_TTL_SECONDS)
+        return generation
+
+    def post_key(self, id: int):
+        return f'post:{self.post_version(id)}:{id}'
+
+    # scope separates lists that differ by more than the url (e.g. the user of /posts/me)
+    def posts_list_key(self, request: Request, scope=None):
+        generation = self.generation()
+        params = sorted(request.query_params.multi_items())
+        digest = hashlib.sha1(
+            repr((request.url.path, scope, params)).encode()).hexdigest()
+        return f'posts:{generation}:{digest}'
+
+    def get(self, key: str):
+        value = self._backend('get', key)
+        return CachedResponse.from_bytes(value) if value is not None else None
+
+    # returns the response either way, but only stores it when its post (or for a list, any post) wasn't
+    # written since the key was made
+    def set(self, key: str, body: bytes, headers: Optional[dict] = None):
+        # compressing once here saves compressing the page again for every request that hits the cache
+        encoded = compression.compress_all(body) if settings.compression_precompress else {}
+        cached = CachedResponse(body, headers, encoded)
+        # 'post:<version>:<id>' or 'posts:<generation>:<digest>'
+        kind, version, rest = key.split(':', 2)
+        ttl = self.ttl
+        if kind == 'post':
+            current = self.post_version(int(rest))
+            # the writer's own reads come to the cache too, so a detail that may be stale isn't stored at all
+            if self.replicas_may_lag(f'post-write:{rest}'):
+                return cached
+        else:
+            current = self.generation()
+            # a page may come from a replica that is behind any recent write. it's stored for no longer than
+            # replicas are allowed to lag, so it's never staler than reading the replica itself
+            if self.replicas_may_lag(self.RECENT_WRITE):
+                ttl = min(ttl, settings.read_your_writes_seconds)
+        if current is not None and version == str(current):
+            self._backend('set', key, cached.to_bytes(), ttl)
+        return cached
+
+    # a replica can still be behind a write after the version was bumped, and a read from it would be stored
+    # under the new version. read_your_writes_seconds is how long replicas are allowed to lag
+    def replicas_may_lag(self, marker: str):
+        return bool(settings.db_replica_urls) and self._backend('get', marker) is not None
+
+    # call after committing a change to these posts (or their votes)
+    def invalidate_posts(self, *ids: int):
+        generation = self._backend('incr', self.POSTS_GENERATION)
+        if generation is None:
+            return
+        lag = settings.read_your_writes_seconds if settings.db_replica_urls else 0
+        for id in ids:
+            self._backend('set', f'post-version:{id}', str(generation).encode(), self.POST_VERSION_TTL_SECONDS)
+            if lag > 0:
+                self._backend('set', f'post-write:{id}', b'1', lag)
+        if lag > 0:
+            self._backend('set', self.RECENT_WRITE, b'1', lag)
+
+
+def make_backend():
+    if settings.response_cache_backend == 'redis':
+        return RedisBackend.from_url(settings.redis_url)
+    # 'none' keeps the same code path but never stores anything
+    size = settings.response_cache_size if settings.response_cache_backend == 'memory' else 0
+    return MemoryBackend(maxsize=size, ttl=settings.response_cache_ttl_seconds)
+
+
+response_cache = ResponseCache(make_backend(),
+                               ttl=settings.response_cache_ttl_seconds)
@@ -0,0 +1,39 @@
+from .. import database, oauth2, schemas, utils
+from fastapi import APIRouter, Depends, status, HTTPException
+from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# async version of the login route in auth.py (used when DB_ASYNC=true)
+router = APIRouter(tags=['Authentication'])
+
+
+@router.post('/login', response_model=schemas.Token)
+async def login(user_creds: OAuth2PasswordRequestForm = Depends(),
+                db: AsyncSession = Depends(database.get_async_db)):
+
+    result = await db.execute(oauth2.user_by_email_statement(user_creds.username))
+    user = result.scalars().first()
+
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Invalid credentials.'
+        )
+
+    # verifying the hash is slow CPU work. running it in the hashing process pool keeps it from blocking the event loop
+    valid, new_hash = await utils.run_password_task_async(
+        utils.verify_and_update, user_creds.password, user.password)
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Invalid credentials.'
+        )
+
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
+
+    access_token = oauth2.create_access_token(payload={'user_id': user.id})
+
+    return {'access_token': access_token, 'token_type': 'bearer'}
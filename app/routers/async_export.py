@@ -0,0 +1,77 @@
+from .. import schemas, oauth2, pagination, replicas
+from ..config import settings
+from .export import (ExportFormat, SINCE_DESCRIPTION, VOTES_CSV_HEADER, export_filters, export_bound_statement,
+                     export_statement, votes_export_statement, validate_range, format_batch,
+                     format_votes_batch, csv_header, export_response)
+from fastapi import Depends, Request, APIRouter
+from typing import Optional
+from datetime import datetime
+
+
+# async version of the export in export.py (used when DB_ASYNC=true).
+# AsyncConnection.stream() reads through a server side cursor the same way stream_results does
+router = APIRouter(
+    prefix='/export',
+    tags=['Export']
+)
+
+
+@router.get('/posts', description=SINCE_DESCRIPTION)
+async def export_posts(request: Request,
+                       format: ExportFormat = ExportFormat.ndjson,
+                       created_after: Optional[datetime] = None,
+                       created_before: Optional[datetime] = None,
+                       user_id: Optional[int] = None,
+                       since: Optional[str] = None,
+                       current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    validate_range(created_after, created_before)
+    filters = export_filters(created_after, created_before, user_id, since)
+
+    conn = await replicas.read_engine(request).connect()
+    try:
+        bound = (await conn.execute(export_bound_statement(filters))).first()
+    except Exception:
+        await conn.close()
+        raise
+
+    if bound is None:
+        await conn.close()
+
+        async def empty():
+            if format == ExportFormat.csv:
+                yield csv_header()
+
+        return export_response(empty(), format, since, conn.close)
+
+    async def body():
+        try:
+            if format == ExportFormat.csv:
+                yield csv_header()
+            result = await conn.stream(export_statement(filters, bound))
+            async for rows in result.partitions(settings.export_batch_size):
+                yield format_batch(rows, format)
+        finally:
+            await conn.close()
+
+    return export_response(body(), format, pagination.encode_cursor(*bound), conn.close)
+
+
+@router.get('/votes')
+async def export_votes(request: Request,
+                       format: ExportFormat = ExportFormat.ndjson,
+                       user_id: Optional[int] = None,
+                       post_id: Optional[int] = None,
+                       current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    conn = await replicas.read_engine(request).connect()
+
+    async def body():
+        try:
+            if format == ExportFormat.csv:
+                yield csv_header(VOTES_CSV_HEADER)
+            result = await conn.stream(votes_export_statement(user_id, post_id))
+            async for rows in result.partitions(settings.export_batch_size):
+                yield format_votes_batch(rows, format)
+        finally:
+            await conn.close()
+
+    return export_response(body(), format, None, conn.close, filename='votes')
@@ -0,0 +1,162 @@
+from .. import models, schemas, database, oauth2, trending, replicas
+from ..response_cache import response_cache
+from .post import (post_votes_select, post_by_id_statement, posts_page_statement, cache_posts_page, serialize_post_votes,
+                   returning_post_with_user, owner_statement, write_error)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert, update, delete
+from fastapi import Request, Response, status, HTTPException, APIRouter
+from fastapi.params import Depends
+from typing import List, Optional
+
+
+# async versions of the routes in post.py (used when DB_ASYNC=true)
+# lazy loading can't run in async code, so every query that returns posts loads post.user up front.
+# the response cache calls are sync. that's free for the memory backend, the redis backend briefly blocks the loop
+router = APIRouter(
+    prefix='/posts',
+    tags=['Posts']
+)
+
+
+@router.get('/', response_model=List[schemas.PostVotesResponse])
+async def get_posts(request: Request,
+                    db: AsyncSession = Depends(replicas.get_async_read_db),
+                    limit: int = 50,
+                    skip: int = 0,
+                    search: Optional[str] = '',
+                    search_mode: schemas.SearchMode = schemas.SearchMode.title,
+                    cursor: Optional[str] = None):
+
+    return await posts_page_response(request, db, response_cache.posts_list_key(request),
+                                     limit, skip, search, search_mode, cursor)
+
+
+@router.get('/me', response_model=List[schemas.PostVotesResponse])
+async def get_my_posts(request: Request,
+                       db: AsyncSession = Depends(replicas.get_async_read_db),
+                       current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                       limit: int = 50,
+                       skip: int = 0,
+                       search: Optional[str] = '',
+                       search_mode: schemas.SearchMode = schemas.SearchMode.title,
+                       cursor: Optional[str] = None):
+
+    return await posts_page_response(request, db, response_cache.posts_list_key(request, current_user.id),
+                                     limit, skip, search, search_mode, cursor, user_id=current_user.id)
+
+
+@router.get('/user/{user_id}', response_model=List[schemas.PostVotesResponse])
+async def get_user_posts(user_id: int,
+                         request: Request,
+                         db: AsyncSession = Depends(replicas.get_async_read_db),
+                         limit: int = 50,
+                         skip: int = 0,
+                         search: Optional[str] = '',
+                         search_mode: schemas.SearchMode = schemas.SearchMode.title,
+                         cursor: Optional[str] = None):
+
+    return await posts_page_response(request, db, response_cache.posts_list_key(request),
+                                     limit, skip, search, search_mode, cursor, user_id=user_id)
+
+
+@router.get('/trending', response_model=List[schemas.PostVotesResponse])
+async def get_trending_posts(request: Request,
+                             db: AsyncSession = Depends(replicas.get_async_read_db),
+                             limit: int = 50,
+                             skip: int = 0):
+
+    cache_key = response_cache.posts_list_key(request)
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        result = await db.execute(trending.page_statement(
+            post_votes_select(), limit, skip))
+        cached = response_cache.set(
+            cache_key, serialize_post_votes(result.all()))
+
+    return cached.to_response(request)
+
+
+async def posts_page_response(request: Request, db: AsyncSession, cache_key: str,
+                              limit: int, skip: int, search: str, search_mode: schemas.SearchMode,
+                              cursor: Optional[str], user_id: Optional[int] = None):
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        result = await db.execute(posts_page_statement(
+            limit, skip, search, search_mode, cursor, user_id))
+        cached = cache_posts_page(
+            cache_key, result.all(), limit, search_mode)
+
+    return cached.to_response(request)
+
+
+# CREATE (requires login)
+@router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.PostResponse)
+async def create_post(post: schemas.PostCreate,
+                      db: AsyncSession = Depends(database.get_async_db),
+                      current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    result = await db.execute(returning_post_with_user(
+        insert(models.Post.__table__).values(user_id=current_user.id, **post.dict())))
+    new_post = result.scalars().first()
+    await db.commit()
+    response_cache.invalidate_posts()
+    return new_post
+
+
+# READ (requires login)
+@router.get('/{id}', response_model=schemas.PostVotesResponse,)
+async def get_post(id: int,
+                   request: Request,
+                   db: AsyncSession = Depends(replicas.get_async_read_db),
+                   current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    cache_key = response_cache.post_key(id)
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        result = await db.execute(post_by_id_statement(id))
+        post = result.first()
+        if not post:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Post with id {id} was not found.')
+        cached = response_cache.set(
+            cache_key, serialize_post_votes(post, many=False))
+
+    return cached.to_response(request)
+
+
+# DELETE (requires login)
+@router.delete('/{id}')
+async def delete_post(id: int,
+                      db: AsyncSession = Depends(database.get_async_db),
+                      current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    result = await db.execute(delete(models.Post.__table__).where(
+        models.Post.id == id, models.Post.user_id == current_user.id).returning(models.Post.id))
+    if not result.first():
+        owner = await db.execute(owner_statement(id))
+        raise write_error(id, owner.scalar(), 'delete')
+
+    await db.commit()
+    response_cache.invalidate_posts(id)
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+# UPDATE (requires login)
+@router.put('/{id}', status_code=status.HTTP_202_ACCEPTED, response_model=schemas.PostResponse)
+async def update_post(id: int,
+                      upd_post: schemas.PostCreate,
+                      db: AsyncSession = Depends(database.get_async_db),
+                      current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    result = await db.execute(returning_post_with_user(
+        update(models.Post.__table__).where(
+            models.Post.id == id, models.Post.user_id == current_user.id).values(**upd_post.dict())))
+    post = result.scalars().first()
+    if not post:
+        owner = await db.execute(owner_statement(id))
+        raise write_error(id, owner.scalar(), 'update')
+
+    await db.commit()
+    response_cache.invalidate_posts(id)
+    return post
@@ -0,0 +1,53 @@
+from .. import models, schemas, utils, database, oauth2, replicas
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import status, HTTPException, APIRouter
+from fastapi.params import Depends
+
+
+# async versions of the routes in user.py (used when DB_ASYNC=true)
+router = APIRouter(
+    prefix='/users',
+    tags=['Users']
+)
+
+
+# CREATE
+@router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
+async def create_user(user: schemas.UserCreate,
+                      db: AsyncSession = Depends(database.get_async_db),
+                      ):
+
+    result = await db.execute(oauth2.user_by_email_statement(user.email))
+    if result.scalars().first():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='Email already in use.')
+
+    # hashing is slow CPU work. running it in the hashing process pool keeps it from blocking the event loop
+    user.password = await utils.run_password_task_async(utils.hash, user.password)
+    new_user = models.User(**user.dict())
+    db.add(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+    return new_user
+
+
+# the logged in user. the full row comes from oauth2's user cache, so repeated calls skip the database
+@router.get('/me', response_model=schemas.UserOut)
+async def get_me(current_user: models.User = Depends(oauth2.get_current_user_async)):
+    return current_user
+
+
+# READ
+@router.get('/{id}', response_model=schemas.UserOut)
+async def get_user(id: int,
+                   db: AsyncSession = Depends(replicas.get_async_read_db),
+                   current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    result = await db.execute(oauth2.user_by_id_statement(id))
+    user = result.scalars().first()
+
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'User with ID {id} was not found.')
+
+    return user
@@ -0,0 +1,80 @@
+from .. import schemas, database, oauth2, trending, vote_buffer
+from ..config import settings
+from ..response_cache import response_cache
+from .vote import (post_exists_statement, vote_error, remove_vote_statement, vote_count_statement,
+                   split_vote_batch, existing_posts_statement, insert_votes_statement,
+                   delete_votes_statement, vote_counts_statement, vote_batch_results)
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import status, APIRouter
+from fastapi.params import Depends
+from typing import List
+
+
+# async version of the route in vote.py (used when DB_ASYNC=true)
+router = APIRouter(prefix='/vote',
+                   tags=['Vote'])
+
+
+# cast a vote
+@router.post('/', status_code=status.HTTP_201_CREATED)
+async def vote(vote: schemas.Vote,
+               db: AsyncSession = Depends(database.get_async_db),
+               current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    if settings.vote_buffer_enabled:
+        return await vote_buffer.submit_async(current_user.id, vote)
+
+    # the vote is only written when the post exists and the user hasn't voted yet (see vote in vote.py)
+    if vote.direction == 1:
+        result = await db.execute(insert_votes_statement(current_user.id, [vote.post_id]))
+        if not result.first():
+            await db.rollback()
+            result = await db.execute(post_exists_statement(vote.post_id))
+            raise vote_error(result.first(), vote, current_user.id)
+        await db.execute(vote_count_statement(vote.post_id, 1))
+        for statement in trending.refresh_statements([vote.post_id]):
+            await db.execute(statement)
+        await db.commit()
+        response_cache.invalidate_posts(vote.post_id)
+        return {'message': 'successfully add vote'}
+    else:
+        # only decrement when this DELETE removed the vote
+        result = await db.execute(remove_vote_statement(vote.post_id, current_user.id))
+        if not result.rowcount:
+            await db.rollback()
+            result = await db.execute(post_exists_statement(vote.post_id))
+            raise vote_error(result.first(), vote, current_user.id)
+        await db.execute(vote_count_statement(vote.post_id, -1))
+        for statement in trending.refresh_statements([vote.post_id]):
+            await db.execute(statement)
+        await db.commit()
+        response_cache.invalidate_posts(vote.post_id)
+        return {'message': 'successfully removed vote'}
+
+
+# cast many votes in one transaction (see vote_batch in vote.py)
+@router.post('/batch', response_model=List[schemas.VoteResult])
+async def vote_batch(batch: schemas.VoteBatch,
+                     db: AsyncSession = Depends(database.get_async_db),
+                     current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    add_ids, remove_ids = split_vote_batch(batch.votes)
+    existing = set((await db.execute(existing_posts_statement(
+        add_ids + remove_ids))).scalars())
+
+    added, removed = set(), set()
+    if add_ids:
+        added = set((await db.execute(insert_votes_statement(
+            current_user.id, add_ids))).scalars())
+    if remove_ids:
+        removed = set((await db.execute(delete_votes_statement(
+            current_user.id, remove_ids))).scalars())
+    if added or removed:
+        await db.execute(vote_counts_statement(added, removed))
+        for statement in trending.refresh_statements(added | removed):
+            await db.execute(statement)
+    await db.commit()
+    if added or removed:
+        response_cache.invalidate_posts(*(added | removed))
+
+    return vote_batch_results(batch.votes, current_user.id, existing, added, removed)
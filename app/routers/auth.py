@@ -1,4 +1,4 @@
-from .. import database, oauth2, schemas, models, utils
+from .. import database, oauth2, schemas, utils
 from fastapi import APIRouter, Depends, status, HTTPException
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
@@ -12,9 +12,8 @@ def login(user_creds: OAuth2PasswordRequestForm = Depends(),
           db: Session = Depends(database.get_db)):
     # the oauth2 password form is a dict with only 2 fields (username and password)
     # in our case email is the equivalent of username so we use that for comparison
-    user_query = db.query(models.User).filter(
-        models.User.email == user_creds.username)
-    user = user_query.first()
+    user = db.execute(oauth2.user_by_email_statement(
+        user_creds.username)).scalars().first()
 
     if not user:
         raise HTTPException(
@@ -22,12 +21,20 @@ def login(user_creds: OAuth2PasswordRequestForm = Depends(),
             detail='Invalid credentials.'
         )
 
-    if not utils.verify(user_creds.password, user.password):
+    # verify the password in the hashing process pool. new_hash is set when the stored hash
+    # uses outdated settings, so we can upgrade it now while we have the plain password
+    valid, new_hash = utils.run_password_task(
+        utils.verify_and_update, user_creds.password, user.password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail='Invalid credentials.'
         )
 
+    if new_hash:
+        user.password = new_hash
+        db.commit()
+
     access_token = oauth2.create_access_token(payload={'user_id': user.id})
 
     return {'access_token': access_token, 'token_type': 'bearer'}
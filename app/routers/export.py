@@ -0,0 +1,199 @@
+from .. import models, schemas, oauth2, pagination, fast_json, replicas
+from ..config import settings
+from fastapi import Depends, Request, status, HTTPException, APIRouter
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Optional
+from datetime import datetime
+from enum import Enum
+from sqlalchemy import select, tuple_
+import csv
+import io
+
+
+# bulk export of every post with its vote count, and of every vote, for analytics jobs.
+# instead of paging through GET /posts with limit/skip, the rows are read from a server side cursor
+# (stream_results) a batch at a time and written out as they arrive, so memory stays flat no matter how
+# many posts there are. rows are built from plain columns like the fast serialization path, without pydantic
+router = APIRouter(
+    prefix='/export',
+    tags=['Export']
+)
+
+
+class ExportFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: 'application/x-ndjson',
+    ExportFormat.csv: 'text/csv',
+}
+
+CSV_HEADER = ('id', 'title', 'content', 'published', 'created_at',
+              'user_id', 'user_email', 'user_created_at', 'votes')
+VOTES_CSV_HEADER = ('user_id', 'post_id')
+
+# since only follows (created_at, id), and posts don't record when they were last changed
+SINCE_DESCRIPTION = (
+    'Pass the X-Next-Cursor header of the previous export as since to only get the posts created after it. '
+    'Edits to older posts and changes to their vote counts are not included, run a full export (or one '
+    'limited with created_after) to pick those up, and use /export/votes for the votes themselves.')
+
+
+# the filters shared by the bound query and the export itself
+def export_filters(created_after: Optional[datetime], created_before: Optional[datetime],
+                   user_id: Optional[int], since: Optional[str]):
+    filters = []
+    if created_after is not None:
+        filters.append(models.Post.created_at >= created_after)
+    if created_before is not None:
+        filters.append(models.Post.created_at < created_before)
+    if user_id is not None:
+        filters.append(models.Post.user_id == user_id)
+    if since:
+        since_created_at, since_id = pagination.decode_cursor(since)
+        # created_at >= ... lets postgres prune the months before the cursor (see posts_page_statement)
+        filters.append(models.Post.created_at >= since_created_at)
+        filters.append(tuple_(models.Post.created_at, models.Post.id)
+                       > tuple_(since_created_at, since_id))
+    return filters
+
+
+# (created_at, id) of the newest post the export will include. it's looked up before streaming starts so
+# the cursor for the next incremental export can go in the response headers, and the export stops there
+# even if posts are created while it runs
+def export_bound_statement(filters):
+    return select(models.Post.created_at, models.Post.id).filter(*filters).order_by(
+        models.Post.created_at.desc(), models.Post.id.desc()).limit(1)
+
+
+# oldest first, so an export that is cut off can be resumed from the last row received
+def export_statement(filters, bound):
+    return fast_json.post_votes_select().filter(
+        *filters,
+        models.Post.created_at <= bound[0],
+        tuple_(models.Post.created_at, models.Post.id) <= tuple_(*bound)).order_by(
+        models.Post.created_at, models.Post.id)
+
+
+def validate_range(created_after: Optional[datetime], created_before: Optional[datetime]):
+    if created_after and created_before and created_after >= created_before:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail='created_after must be before created_before.')
+
+
+# votes have no timestamp, so there is no incremental mode: every export is the whole table (or the votes of one
+# user or post) as of the moment the statement starts. with a filter postgres reads the primary key
+# (user_id) or ix_votes_post_id, and a post_id filter only touches that post's hash partition
+def votes_export_statement(user_id: Optional[int], post_id: Optional[int]):
+    statement = select(models.Vote.user_id, models.Vote.post_id)
+    if user_id is not None:
+        statement = statement.filter(models.Vote.user_id == user_id)
+    if post_id is not None:
+        statement = statement.filter(models.Vote.post_id == post_id)
+    return statement
+
+
+# one chunk of the response body per batch of rows
+def format_batch(rows, format: ExportFormat):
+    if format == ExportFormat.ndjson:
+        return b''.join(fast_json.dumps(fast_json.post_votes_dict(row)) + b'\n' for row in rows)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for (title, content, published, id, created_at, user_id,
+         _, email, user_created_at, votes) in rows:
+        writer.writerow((id, title, content, published, created_at.isoformat(),
+                         user_id, email, user_created_at.isoformat(), votes))
+    return buffer.getvalue().encode()
+
+
+def format_votes_batch(rows, format: ExportFormat):
+    if format == ExportFormat.ndjson:
+        return b''.join(fast_json.dumps({'user_id': user_id, 'post_id': post_id}) + b'\n'
+                        for user_id, post_id in rows)
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def csv_header(columns=CSV_HEADER):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(columns)
+    return buffer.getvalue().encode()
+
+
+# X-Next-Cursor is passed back as ?since= by the next run to only get the posts created after this export.
+# a post whose transaction commits after a newer post was exported can be missed, so nightly jobs should
+# leave a small overlap with created_after if they need every row
+def export_response(body, format: ExportFormat, next_cursor: Optional[str], close, filename: str = 'posts'):
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.{format.value}"'}
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+    # the generator closes the connection when it finishes. the background task covers a client that
+    # disconnects before the first chunk (closing twice is harmless)
+    return StreamingResponse(body, media_type=MEDIA_TYPES[format], headers=headers,
+                             background=BackgroundTask(close))
+
+
+@router.get('/posts', description=SINCE_DESCRIPTION)
+def export_posts(request: Request,
+                 format: ExportFormat = ExportFormat.ndjson,
+                 created_after: Optional[datetime] = None,
+                 created_before: Optional[datetime] = None,
+                 user_id: Optional[int] = None,
+                 since: Optional[str] = None,
+                 current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    validate_range(created_after, created_before)
+    filters = export_filters(created_after, created_before, user_id, since)
+
+    # the connection is opened here instead of using get_read_db so it stays open while the body is streamed
+    conn = replicas.read_engine(request).connect()
+    try:
+        bound = conn.execute(export_bound_statement(filters)).first()
+    except Exception:
+        conn.close()
+        raise
+
+    if bound is None:
+        conn.close()
+        return export_response(iter([csv_header()] if format == ExportFormat.csv else []),
+                               format, since, conn.close)
+
+    def body():
+        try:
+            if format == ExportFormat.csv:
+                yield csv_header()
+            result = conn.execution_options(stream_results=True).execute(
+                export_statement(filters, bound))
+            for rows in result.partitions(settings.export_batch_size):
+                yield format_batch(rows, format)
+        finally:
+            conn.close()
+
+    return export_response(body(), format, pagination.encode_cursor(*bound), conn.close)
+
+
+@router.get('/votes')
+def export_votes(request: Request,
+                 format: ExportFormat = ExportFormat.ndjson,
+                 user_id: Optional[int] = None,
+                 post_id: Optional[int] = None,
+                 current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    conn = replicas.read_engine(request).connect()
+
+    def body():
+        try:
+            if format == ExportFormat.csv:
+                yield csv_header(VOTES_CSV_HEADER)
+            result = conn.execution_options(stream_results=True).execute(
+                votes_export_statement(user_id, post_id))
+            for rows in result.partitions(settings.export_batch_size):
+                yield format_votes_batch(rows, format)
+        finally:
+            conn.close()
+
+    return export_response(body(), format, None, conn.close, filename='votes')
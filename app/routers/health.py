@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from .. import database
+from ..config import settings
+from fastapi import Response, status, APIRouter
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+
+# probes for load balancers and orchestrators (kubernetes, etc.).
+# live: the process is working and its connection pool isn't stuck. restart it when this fails.
+# ready: it can serve requests right now (the database answers and it isn't shutting down).
+# stop sending it traffic when this fails
+router = APIRouter(prefix='/health',
+                   tags=['Health'])
+
+# set when the worker got SIGTERM (see server.py) or is shutting down
+draining = threading.Event()
+
+_last_checkout_timeouts = 0
+
+
+# the pool is stuck when every connection is checked out and checkouts have kept timing out since the
+# last probe. that means connections are leaking or the database hangs, and a restart is the way out
+def pool_stuck(snapshot):
+    global _last_checkout_timeouts
+    timed_out = snapshot['checkout_timeouts'] > _last_checkout_timeouts
+    _last_checkout_timeouts = snapshot['checkout_timeouts']
+    exhausted = snapshot['checked_out'] >= snapshot['pool_size'] + settings.db_max_overflow
+    return timed_out and exhausted
+
+
+@router.get('/live')
+def liveness(response: Response):
+    snapshot = database.pool_metrics.snapshot()
+    if pool_stuck(snapshot):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {'status': 'pool stuck', 'pool': snapshot}
+    return {'status': 'ok', 'pool': snapshot}
+
+
+def _select_one():
+    with database.engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+
+
+async def _async_select_one():
+    async with database.async_engine.connect() as conn:
+        await conn.execute(text('SELECT 1'))
+
+
+@router.get('/ready')
+async def readiness(response: Response):
+    if draining.is_set():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {'status': 'draining'}
+
+    try:
+        check = _async_select_one() if settings.db_async else run_in_threadpool(_select_one)
+        await asyncio.wait_for(check, timeout=settings.health_check_timeout_seconds)
+    except asyncio.TimeoutError:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {'status': 'database timeout'}
+    except Exception:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {'status': 'database unavailable'}
+
+    return {'status': 'ok', 'pool': database.pool_metrics.snapshot()}
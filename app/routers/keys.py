@@ -0,0 +1,12 @@
+from .. import token_keys
+from fastapi import APIRouter
+
+
+router = APIRouter(tags=['Authentication'])
+
+
+# public keys for verifying our access tokens without calling this api.
+# clients can cache it and refetch when they see a kid they don't know
+@router.get('/.well-known/jwks.json')
+def get_jwks():
+    return token_keys.jwks()
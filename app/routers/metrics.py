@@ -0,0 +1,46 @@
+from .. import database, utils, profiling, replicas, vote_buffer
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+
+router = APIRouter(prefix='/metrics',
+                   tags=['Metrics'])
+
+
+# everything below in the prometheus text format, for scraping.
+# request metrics are only collected when PROFILING_ENABLED is set
+@router.get('', response_class=PlainTextResponse)
+def prometheus_metrics():
+    lines = profiling.request_metrics.render()
+    lines += profiling.render_gauges('db_pool',
+                                     database.pool_metrics.snapshot())
+    lines += profiling.render_labeled_gauges('db_replica_pool', 'replica', replica_pool_metrics())
+    lines += profiling.render_gauges('password_hash',
+                                     utils.hash_metrics.snapshot())
+    lines += profiling.render_gauges('vote_buffer',
+                                     vote_buffer.vote_buffer_metrics.snapshot())
+    return '\n'.join(lines) + '\n'
+
+
+# current state of the connection pool of this worker process
+@router.get('/pool')
+def pool_metrics():
+    return database.pool_metrics.snapshot()
+
+
+# current state of the connection pool of each read replica, by host:port
+@router.get('/pool/replicas')
+def replica_pool_metrics():
+    return {replica.name: replica.pool_metrics.snapshot() for replica in replicas.replicas}
+
+
+# timings of the password hashing process pool of this worker process
+@router.get('/hashing')
+def hashing_metrics():
+    return utils.hash_metrics.snapshot()
+
+
+# depth and flush timings of the write-behind vote buffer of this worker process
+@router.get('/votes')
+def vote_buffer_metrics():
+    return vote_buffer.vote_buffer_metrics.snapshot()
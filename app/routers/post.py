@@ -1,9 +1,13 @@
-from .. import models, schemas, database, oauth2
+from .. import models, schemas, database, oauth2, pagination, fast_json, trending, replicas
+from ..config import settings
+from ..profiling import timed_serialization
+from ..response_cache import response_cache, serialize
 from sqlalchemy.orm.session import Session
-from fastapi import Response, status, HTTPException, APIRouter
+from fastapi import Request, Response, status, HTTPException, APIRouter
 from fastapi.params import Depends
 from typing import List, Optional
-from sqlalchemy import func
+from sqlalchemy import func, tuple_, select, insert, update, delete, lambda_stmt
+from sqlalchemy.orm import aliased, contains_eager, joinedload
 
 
 # prefix is added to the path for each route
@@ -15,25 +19,218 @@ router = APIRouter(
 
 
 @router.get('/', response_model=List[schemas.PostVotesResponse])
-def get_posts(db: Session = Depends(database.get_db),
+def get_posts(request: Request,
+              db: Session = Depends(replicas.get_read_db),
               limit: int = 50,
               skip: int = 0,
-              search: Optional[str] = ''):
+              search: Optional[str] = '',
+              search_mode: schemas.SearchMode = schemas.SearchMode.title,
+              cursor: Optional[str] = None):
     # cursor.execute('''SELECT * FROM posts
     #                ORDER BY id;''')
     # posts = cursor.fetchall()
 
-    # this creates the sql query that gives us all the information about a post paired with its dynamically calculated number of votes
-    post_votes_query = db.query(models.Post, func.count(models.Vote.post_id).label('votes')).join(
-        models.Vote,
-        models.Vote.post_id == models.Post.id,
-        isouter=True
-    ).group_by(models.Post.id).filter(
-        models.Post.title.contains(search))
+    return posts_page_response(request, db, response_cache.posts_list_key(request),
+                               limit, skip, search, search_mode, cursor)
 
-    post_votes = post_votes_query.limit(limit).offset(skip).all()
 
-    return post_votes
+# posts of the logged in user, newest first
+@router.get('/me', response_model=List[schemas.PostVotesResponse])
+def get_my_posts(request: Request,
+                 db: Session = Depends(replicas.get_read_db),
+                 current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                 limit: int = 50,
+                 skip: int = 0,
+                 search: Optional[str] = '',
+                 search_mode: schemas.SearchMode = schemas.SearchMode.title,
+                 cursor: Optional[str] = None):
+
+    return posts_page_response(request, db, response_cache.posts_list_key(request, current_user.id),
+                               limit, skip, search, search_mode, cursor, user_id=current_user.id)
+
+
+# posts of one author, newest first. served by the (user_id, created_at, id) index
+@router.get('/user/{user_id}', response_model=List[schemas.PostVotesResponse])
+def get_user_posts(user_id: int,
+                   request: Request,
+                   db: Session = Depends(replicas.get_read_db),
+                   limit: int = 50,
+                   skip: int = 0,
+                   search: Optional[str] = '',
+                   search_mode: schemas.SearchMode = schemas.SearchMode.title,
+                   cursor: Optional[str] = None):
+
+    return posts_page_response(request, db, response_cache.posts_list_key(request),
+                               limit, skip, search, search_mode, cursor, user_id=user_id)
+
+
+# most voted posts of the trending window (see trending.py)
+@router.get('/trending', response_model=List[schemas.PostVotesResponse])
+def get_trending_posts(request: Request,
+                       db: Session = Depends(replicas.get_read_db),
+                       limit: int = 50,
+                       skip: int = 0):
+
+    cache_key = response_cache.posts_list_key(request)
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        post_votes = db.execute(trending.page_statement(
+            post_votes_select(), limit, skip)).all()
+        cached = response_cache.set(
+            cache_key, serialize_post_votes(post_votes))
+
+    return cached.to_response(request)
+
+
+# runs (or serves from the cache) one page of a post list
+def posts_page_response(request: Request, db: Session, cache_key: str,
+                        limit: int, skip: int, search: str, search_mode: schemas.SearchMode,
+                        cursor: Optional[str], user_id: Optional[int] = None):
+    # pages are cached as finished JSON, so a hit skips the query and serialization entirely
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        post_votes = db.execute(posts_page_statement(
+            limit, skip, search, search_mode, cursor, user_id)).all()
+        cached = cache_posts_page(cache_key, post_votes, limit, search_mode)
+
+    # returns an empty 304 when the client's If-None-Match matches the cached ETag
+    return cached.to_response(request)
+
+
+# this creates the sql query that gives us all the information about a post paired with its number of votes.
+# the count is stored on the post itself (vote_count) so we don't need to join and group the votes table.
+# joinedload fetches each post's user in the same query. without it serializing PostResponse.user
+# would run one extra SELECT per post on the page.
+# in the fast serialization mode plain columns are selected instead of ORM objects
+def post_votes_select():
+    if settings.serialization_mode == 'fast':
+        return fast_json.post_votes_select()
+    return select(models.Post, models.Post.vote_count.label('votes')).options(
+        joinedload(models.Post.user))
+
+
+# the statement of get_post. a lambda statement is built and compiled once, later calls only bind the new id
+# (see user_by_id_statement in oauth2.py)
+def post_by_id_statement(id: int):
+    if settings.serialization_mode == 'fast':
+        statement = lambda_stmt(lambda: fast_json.post_votes_select())
+    else:
+        statement = lambda_stmt(lambda: select(models.Post, models.Post.vote_count.label('votes')).options(
+            joinedload(models.Post.user)))
+    statement += lambda s: s.where(models.Post.id == id)
+    return statement
+
+
+# serializes (Post, votes) rows (or their column tuples in the fast mode) to JSON bytes.
+# many=False serializes a single PostVotesResponse
+def serialize_post_votes(post_votes, many: bool = True):
+    with timed_serialization():
+        return _serialize_post_votes(post_votes, many)
+
+
+def _serialize_post_votes(post_votes, many: bool):
+    if settings.serialization_mode == 'fast':
+        if many:
+            return fast_json.dumps([fast_json.post_votes_dict(row) for row in post_votes])
+        return fast_json.dumps(fast_json.post_votes_dict(post_votes))
+
+    # rows from db.execute() are tuples, so they are turned into dicts for the response model
+    if many:
+        return serialize(List[schemas.PostVotesResponse], [dict(row._mapping) for row in post_votes])
+    return serialize(schemas.PostVotesResponse, dict(post_votes._mapping))
+
+
+# builds the query for one page of get_posts (shared with the async router).
+# user_id limits the page to the posts of one author
+def posts_page_statement(limit: int, skip: int, search: str,
+                         search_mode: schemas.SearchMode, cursor: Optional[str],
+                         user_id: Optional[int] = None):
+    post_votes_query = post_votes_select()
+
+    if user_id is not None:
+        post_votes_query = post_votes_query.filter(
+            models.Post.user_id == user_id)
+
+    if search and search_mode == schemas.SearchMode.fulltext:
+        if cursor:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='Cursor pagination is not supported for full-text search. Use skip instead.')
+
+        # websearch_to_tsquery accepts free text from users ("quoted phrases", -excluded words) without syntax errors.
+        # the @@ match is answered by the GIN index on search_vector, and ts_rank_cd orders the matches by relevance
+        ts_query = func.websearch_to_tsquery('english', search)
+        rank = func.ts_rank_cd(models.Post.search_vector, ts_query)
+        return post_votes_query.filter(
+            models.Post.search_vector.op('@@')(ts_query)).order_by(
+            rank.desc(), models.Post.id.desc()).limit(limit).offset(skip)
+
+    if search:
+        # substring search on the title. LIKE '%...%' is served by the trigram index on posts.title
+        post_votes_query = post_votes_query.filter(
+            models.Post.title.contains(search))
+
+    # newest posts first. id breaks ties between posts created at the same time so the order is stable between pages.
+    # on the partitioned posts table this reads the newest month's partition first and stops at the limit
+    post_votes_query = post_votes_query.order_by(
+        models.Post.created_at.desc(), models.Post.id.desc())
+
+    if cursor:
+        # keyset pagination: only return posts that sort after the last post the client has seen.
+        # this is a range condition the database can seek to, so every page costs the same no matter how deep it is
+        cursor_created_at, cursor_id = pagination.decode_cursor(cursor)
+        # the plain created_at condition is redundant with the row comparison, but postgres only prunes
+        # partitions on simple conditions. with it the months newer than the cursor are skipped entirely
+        post_votes_query = post_votes_query.filter(
+            models.Post.created_at <= cursor_created_at,
+            tuple_(models.Post.created_at, models.Post.id) < tuple_(cursor_created_at, cursor_id))
+    else:
+        # skip is kept for older clients. the database still has to build and throw away the skipped rows
+        post_votes_query = post_votes_query.offset(skip)
+
+    return post_votes_query.limit(limit)
+
+
+# serializes a page of (Post, votes) rows and stores it in the response cache
+def cache_posts_page(cache_key: str, post_votes, limit: int, search_mode: schemas.SearchMode):
+    headers = {}
+    # a full page means there may be more posts. the body stays a plain list so the cursor for the next page is sent as a header.
+    # (ranked full-text results are paged with skip)
+    if post_votes and len(post_votes) == limit and search_mode != schemas.SearchMode.fulltext:
+        if settings.serialization_mode == 'fast':
+            last_created_at, last_id = fast_json.post_key(post_votes[-1])
+        else:
+            last_created_at, last_id = post_votes[-1].Post.created_at, post_votes[-1].Post.id
+        headers['X-Next-Cursor'] = pagination.encode_cursor(
+            last_created_at, last_id)
+
+    return response_cache.set(cache_key, serialize_post_votes(post_votes), headers)
+
+
+# <-- Single statement writes -->
+# INSERT/UPDATE ... RETURNING is wrapped in a CTE and joined to users, so the written post comes back
+# together with the user that PostResponse serializes in the same statement:
+# WITH changed_post AS (UPDATE posts ... RETURNING *) SELECT ... FROM changed_post JOIN users ...
+# search_vector is left out of RETURNING for the same reason it's deferred on the model
+def returning_post_with_user(statement):
+    changed_post = statement.returning(
+        *(column for column in models.Post.__table__.c if column.key != 'search_vector')).cte('changed_post')
+    post = aliased(models.Post, changed_post)
+    return select(post).join(post.user).options(contains_eager(post.user))
+
+
+# update/delete only touch rows where the post belongs to the current user (the ownership predicate).
+# when nothing matched we look the post up once to tell the client whether it doesn't exist or isn't theirs.
+# this extra query only runs on the error path
+def owner_statement(id: int):
+    return select(models.Post.user_id).where(models.Post.id == id)
+
+
+def write_error(id: int, owner_id, action: str):
+    if owner_id is None:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                             detail=f'Post with id {id} was not found.')
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                         detail=f'Cannot {action} other user\'s posts')
 
 
 # CREATE (requires login)
@@ -41,7 +238,7 @@ def get_posts(db: Session = Depends(database.get_db),
 @router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.PostResponse)
 def create_post(post: schemas.PostCreate,
                 db: Session = Depends(database.get_db),
-                current_user: models.User = Depends(oauth2.get_current_user)):
+                current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
     # never use f-strings for SQL (sql injection vulnerability). use the placeholder syntax instead (%s, %s)
     # cursor.execute('''
@@ -56,12 +253,13 @@ def create_post(post: schemas.PostCreate,
 
     # we set the user_id field of the new post here to be the id of current_user (logged in user)
     # setting the keyword parameters (title=, content=, etc.) by automatically unpacking the dictionary form of the post
-    new_post = models.Post(user_id=current_user.id, **post.dict())
-
-    db.add(new_post)
+    # the insert returns the new row (with its generated id and created_at) and its user in one statement,
+    # so there's no need for db.refresh()
+    new_post = db.execute(returning_post_with_user(
+        insert(models.Post.__table__).values(user_id=current_user.id, **post.dict()))).scalars().first()
     db.commit()
-    # db.refresh() retrieves the newly created post and returns it to the new_post variable
-    db.refresh(new_post)
+    # cached list pages don't have the new post yet
+    response_cache.invalidate_posts()
     return new_post
 
 
@@ -69,8 +267,9 @@ def create_post(post: schemas.PostCreate,
 @router.get('/{id}', response_model=schemas.PostVotesResponse,)
 # fastapi validates and converts (if possible) the data here (id: int). throws error if integer not passed
 def get_post(id: int,
-             db: Session = Depends(database.get_db),
-             current_user: models.User = Depends(oauth2.get_current_user)):
+             request: Request,
+             db: Session = Depends(replicas.get_read_db),
+             current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
     # because the SQL query is a string we must convert id back to a string to pass it to the placeholder
     # cursor.execute('''
     # SELECT * FROM posts ==> db.query(models.Post) the __tablename__ property of the class sets the table the database searches
@@ -78,23 +277,24 @@ def get_post(id: int,
     # ''', (str(id)))
     # post = cursor.fetchone()
 
-    post_votes_query = db.query(models.Post, func.count(models.Vote.post_id).label('votes')).join(
-        models.Vote,
-        models.Vote.post_id == models.Post.id,
-        isouter=True
-    ).group_by(models.Post.id).filter(models.Post.id == id)
-    post = post_votes_query.first()
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Post with id {id} was not found.')
-    return post
+    cache_key = response_cache.post_key(id)
+    cached = response_cache.get(cache_key)
+    if cached is None:
+        post = db.execute(post_by_id_statement(id)).first()
+        if not post:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Post with id {id} was not found.')
+        cached = response_cache.set(
+            cache_key, serialize_post_votes(post, many=False))
+
+    return cached.to_response(request)
 
 
 # DELETE (requires login)
 @router.delete('/{id}')
 def delete_post(id: int,
                 db: Session = Depends(database.get_db),
-                current_user: models.User = Depends(oauth2.get_current_user)):
+                current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
     # cursor.execute(
     #     '''
@@ -109,18 +309,14 @@ def delete_post(id: int,
     #                         detail=f'Post with id {id} was not found.')
     # conn.commit()
 
-    del_query = db.query(models.Post).filter(models.Post.id == id)
-    del_post = del_query.first()
+    # DELETE ... WHERE id = %s AND user_id = %s RETURNING id;
+    del_post = db.execute(delete(models.Post.__table__).where(
+        models.Post.id == id, models.Post.user_id == current_user.id).returning(models.Post.id)).first()
     if not del_post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Post with id {id} was not found.')
-
-    if del_post.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='Cannot delete other user\'s posts')
+        raise write_error(id, db.execute(owner_statement(id)).scalar(), 'delete')
 
-    del_query.delete(synchronize_session=False)
     db.commit()
+    response_cache.invalidate_posts(id)
 
     # http code 204 is used when deleting items. data should not be returned when deleting an item, just the response
     return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -131,7 +327,7 @@ def delete_post(id: int,
 def update_post(id: int,
                 upd_post: schemas.PostCreate,
                 db: Session = Depends(database.get_db),
-                current_user: models.User = Depends(oauth2.get_current_user)):
+                current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
     # cursor.execute(
     #     """
@@ -143,18 +339,15 @@ def update_post(id: int,
     # upd_post = cursor.fetchone()
     # conn.commit()
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
-    # checking if post with that id exists
+    # UPDATE ... WHERE id = %s AND user_id = %s RETURNING *; (joined with the post's user)
+    post = db.execute(returning_post_with_user(
+        update(models.Post.__table__).where(
+            models.Post.id == id, models.Post.user_id == current_user.id).values(**upd_post.dict())
+    )).scalars().first()
+    # no row means the post doesn't exist or belongs to someone else
     if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Post with ID {id} was not found.')
+        raise write_error(id, db.execute(owner_statement(id)).scalar(), 'update')
 
-    if post.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='Cannot update other user\'s posts')
-
-    # .update() takes a python dict for the update data as the first arg
-    post_query.update(upd_post.dict(), synchronize_session=False)
     db.commit()
-    return post_query.first()
+    response_cache.invalidate_posts(id)
+    return post
@@ -1,4 +1,4 @@
-from .. import models, schemas, utils, database, oauth2
+from .. import models, schemas, utils, database, oauth2, replicas
 from sqlalchemy.orm.session import Session
 from fastapi import status, HTTPException, APIRouter
 from fastapi.params import Depends
@@ -16,14 +16,14 @@ def create_user(user: schemas.UserCreate,
                 db: Session = Depends(database.get_db),
                 ):
 
-    email_in_db = db.query(models.User).filter(
-        models.User.email == user.email).first()
+    email_in_db = db.execute(oauth2.user_by_email_statement(
+        user.email)).scalars().first()
     if email_in_db:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail='Email already in use.')
 
-    # hash the password (imported from our utils.py file)
-    hashed_pwd = utils.hash(user.password)
+    # hash the password (imported from our utils.py file). the hashing runs in the password hashing process pool
+    hashed_pwd = utils.run_password_task(utils.hash, user.password)
     # update the user object with the hashed password
     user.password = hashed_pwd
     new_user = models.User(**user.dict())
@@ -33,14 +33,19 @@ def create_user(user: schemas.UserCreate,
     return new_user
 
 
+# the logged in user. the full row comes from oauth2's user cache, so repeated calls skip the database
+@router.get('/me', response_model=schemas.UserOut)
+def get_me(current_user: models.User = Depends(oauth2.get_current_user)):
+    return current_user
+
+
 # READ
 @router.get('/{id}', response_model=schemas.UserOut)
 def get_user(id: int,
-             db: Session = Depends(database.get_db),
-             current_user: models.User = Depends(oauth2.get_current_user)):
+             db: Session = Depends(replicas.get_read_db),
+             current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
-    user_query = db.query(models.User).filter(models.User.id == id)
-    user = user_query.first()
+    user = db.execute(oauth2.user_by_id_statement(id)).scalars().first()
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -1,7 +1,12 @@
-from .. import models, schemas, database, oauth2
+from .. import models, schemas, database, oauth2, trending, vote_buffer
+from ..config import settings
+from ..response_cache import response_cache
 from sqlalchemy.orm.session import Session
+from sqlalchemy import select, update, delete, case, literal, lambda_stmt
+from sqlalchemy.dialects.postgresql import insert
 from fastapi import status, HTTPException, APIRouter
 from fastapi.params import Depends
+from typing import List
 
 
 router = APIRouter(prefix='/vote',
@@ -12,32 +17,161 @@ router = APIRouter(prefix='/vote',
 @router.post('/', status_code=status.HTTP_201_CREATED)
 def vote(vote: schemas.Vote,
          db: Session = Depends(database.get_db),
-         current_user: models.User = Depends(oauth2.get_current_user)):
+         current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
-    post = db.query(models.Post).filter(models.Post.id == vote.post_id).first()
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f'Post with id: {vote.post_id} does not exist')
-
-    vote_query = db.query(models.Vote).filter(
-        models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id)
-
-    vote_found = vote_query.first()
+    # write-behind mode: the vote is written with others in the next batch (see vote_buffer.py)
+    if settings.vote_buffer_enabled:
+        return vote_buffer.submit(current_user.id, vote)
 
     if vote.direction == 1:
-        if vote_found:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
-                                detail=f'User {current_user.id} has already voted on post {vote.post_id}')
-
-        new_vote = models.Vote(user_id=current_user.id, post_id=vote.post_id)
-        db.add(new_vote)
+        # INSERT ... SELECT FROM posts ... ON CONFLICT DO NOTHING RETURNING: the vote is only written when the post
+        # exists and the user hasn't voted on it, in one statement. two concurrent up votes can't both insert,
+        # and the counter is only incremented when this statement wrote the row
+        if not db.execute(insert_votes_statement(current_user.id, [vote.post_id])).first():
+            db.rollback()
+            raise vote_error(db.execute(post_exists_statement(vote.post_id)).first(), vote, current_user.id)
+        # the counter is incremented in the database (vote_count = vote_count + 1) in the same transaction
+        # as the insert, so concurrent votes can't overwrite each other and the count always matches the votes table
+        db.execute(vote_count_statement(vote.post_id, 1))
+        for statement in trending.refresh_statements([vote.post_id]):
+            db.execute(statement)
         db.commit()
+        # the post's vote count changed, so its cached responses are out of date
+        response_cache.invalidate_posts(vote.post_id)
         return {'message': 'successfully add vote'}
     else:
-        if not vote_found:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail='vote does not exist')
-
-        vote_query.delete(synchronize_session=False)
+        # likewise the count is only decremented when this DELETE removed the vote, so a concurrent unvote
+        # can't make it drift below the votes table
+        if not db.execute(remove_vote_statement(vote.post_id, current_user.id)).rowcount:
+            db.rollback()
+            raise vote_error(db.execute(post_exists_statement(vote.post_id)).first(), vote, current_user.id)
+        db.execute(vote_count_statement(vote.post_id, -1))
+        for statement in trending.refresh_statements([vote.post_id]):
+            db.execute(statement)
         db.commit()
+        response_cache.invalidate_posts(vote.post_id)
         return {'message': 'successfully removed vote'}
+
+
+# the vote wrote nothing. the post is only looked up on this error path, to tell the client which check failed
+def vote_error(post_exists, vote: schemas.Vote, user_id: int):
+    if not post_exists:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                             detail=f'Post with id: {vote.post_id} does not exist')
+    if vote.direction == 1:
+        return HTTPException(status_code=status.HTTP_409_CONFLICT,
+                             detail=f'User {user_id} has already voted on post {vote.post_id}')
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                         detail='vote does not exist')
+
+
+# statements of the vote route, shared with the async router. the lookup is a lambda statement that is only
+# built and compiled once (see user_by_id_statement in oauth2.py)
+def post_exists_statement(post_id: int):
+    return lambda_stmt(lambda: select(models.Post.id).where(models.Post.id == post_id))
+
+
+def remove_vote_statement(post_id: int, user_id: int):
+    return delete(models.Vote).where(
+        models.Vote.post_id == post_id, models.Vote.user_id == user_id).execution_options(
+        synchronize_session=False)
+
+
+def vote_count_statement(post_id: int, change: int):
+    return update(models.Post).where(models.Post.id == post_id).values(
+        vote_count=models.Post.vote_count + change).execution_options(synchronize_session=False)
+
+
+# <-- Batch votes -->
+# a batch is applied with a fixed number of set based statements no matter how many votes it has:
+# find the posts that exist, insert all up votes, delete all removed votes, adjust the vote counts, commit.
+# these helpers build the statements and results so the async router can share them
+
+
+# splits a batch into the post ids to vote on and the post ids to remove votes from.
+# a post sent more than once is answered as if its votes ran one after another (see vote_batch_results),
+# which leaves a vote exactly when its last direction is an up vote, so only the last one is written
+def split_vote_batch(votes: List[schemas.Vote]):
+    last = {}
+    for item in votes:
+        last[item.post_id] = item.direction
+    add_ids = [post_id for post_id, direction in last.items() if direction == 1]
+    remove_ids = [post_id for post_id, direction in last.items() if direction != 1]
+    return add_ids, remove_ids
+
+
+def existing_posts_statement(post_ids):
+    return select(models.Post.id).where(models.Post.id.in_(post_ids))
+
+
+# INSERT ... SELECT ... FOR KEY SHARE ON CONFLICT DO NOTHING RETURNING post_id
+# votes that already exist are skipped by the primary key and don't come back in RETURNING.
+# votes.post_id has no foreign key (see models.Vote), so the posts are locked the way a foreign key check would:
+# a concurrent delete of the post waits for this transaction and its trigger then removes the new vote,
+# and a delete that got there first makes the SELECT skip the post
+def insert_votes_statement(user_id: int, post_ids):
+    return insert(models.Vote).from_select(
+        ['user_id', 'post_id'],
+        select(literal(user_id), models.Post.id).where(
+            models.Post.id.in_(post_ids)).with_for_update(read=True, key_share=True)
+    ).on_conflict_do_nothing().returning(models.Vote.post_id)
+
+
+def delete_votes_statement(user_id: int, post_ids):
+    return delete(models.Vote).where(
+        models.Vote.user_id == user_id, models.Vote.post_id.in_(post_ids)
+    ).returning(models.Vote.post_id).execution_options(synchronize_session=False)
+
+
+# one UPDATE for every post whose votes changed: +1 for added votes and -1 for removed ones
+def vote_counts_statement(added, removed):
+    return update(models.Post).where(models.Post.id.in_(added | removed)).values(
+        vote_count=models.Post.vote_count +
+        case((models.Post.id.in_(added), 1), else_=-1)
+    ).execution_options(synchronize_session=False)
+
+
+# the same answers the buffered route gives (vote_buffer.vote_results): every vote gets what the single vote
+# route would have returned had the batch been sent one vote at a time, in order
+def vote_batch_results(votes: List[schemas.Vote], user_id: int, existing, added, removed):
+    directions = {}
+    for item in votes:
+        directions.setdefault((user_id, item.post_id), []).append(item.direction)
+    answers = vote_buffer.vote_results(directions, existing, {(user_id, post_id) for post_id in added},
+                                       {(user_id, post_id) for post_id in removed})
+    answers = {key: iter(results) for key, results in answers.items()}
+
+    results = []
+    for item in votes:
+        code, detail = next(answers[user_id, item.post_id])
+        results.append(schemas.VoteResult(post_id=item.post_id, direction=item.direction,
+                                          status_code=code, detail=detail))
+    return results
+
+
+# cast many votes in one transaction. every vote gets its own result in the same order they were sent
+@router.post('/batch', response_model=List[schemas.VoteResult])
+def vote_batch(batch: schemas.VoteBatch,
+               db: Session = Depends(database.get_db),
+               current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    add_ids, remove_ids = split_vote_batch(batch.votes)
+    existing = set(db.execute(existing_posts_statement(
+        add_ids + remove_ids)).scalars())
+
+    added, removed = set(), set()
+    if add_ids:
+        added = set(db.execute(insert_votes_statement(
+            current_user.id, add_ids)).scalars())
+    if remove_ids:
+        removed = set(db.execute(delete_votes_statement(
+            current_user.id, remove_ids)).scalars())
+    if added or removed:
+        db.execute(vote_counts_statement(added, removed))
+        for statement in trending.refresh_statements(added | removed):
+            db.execute(statement)
+    db.commit()
+    if added or removed:
+        response_cache.invalidate_posts(*(added | removed))
+
+    return vote_batch_results(batch.votes, current_user.id, existing, added, removed)
@@ -1,9 +1,10 @@
 # schemas dictate data types for transmission (request and response)
+from enum import Enum
 from typing import Optional
 from pydantic import BaseModel, EmailStr
 from datetime import datetime
 
-from pydantic.types import conint
+from pydantic.types import conint, conlist
 
 
 # Pydantic data models used for requests and responses
@@ -59,6 +60,14 @@ class PostResponse(PostBase):
 class PostVotesResponse(BaseModel):
     Post: PostResponse
     votes: int
+
+
+# how the search query parameter of GET /posts is matched
+# title: substring match on the post title (original behaviour)
+# fulltext: word match on title and content, ranked by relevance
+class SearchMode(str, Enum):
+    title = 'title'
+    fulltext = 'fulltext'
 # <-- Token Models -->
 
 
@@ -70,9 +79,27 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     user_id: Optional[str] = None
 
+
+# the logged in user as far as the token says. built from the token alone, without a database lookup
+class Principal(BaseModel):
+    id: int
+
 # <-- Vote Models -->
 
 
 class Vote(BaseModel):
     post_id: int
     direction: conint(le=1)
+
+
+# many votes sent in one request. votes on the same post are answered in the order they were sent
+class VoteBatch(BaseModel):
+    votes: conlist(Vote, min_items=1, max_items=500)
+
+
+# the outcome of one vote in a batch. status_code and detail are what the single vote route would have returned
+class VoteResult(BaseModel):
+    post_id: int
+    direction: int
+    status_code: int
+    detail: str
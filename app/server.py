@@ -0,0 +1,127 @@
+# production entry point: gunicorn managing uvicorn workers, configured from Settings.
+#
+#   python -m app.server
+#
+# - one worker per CPU core (SERVER_WORKERS overrides it)
+# - uvloop and httptools when they are installed, asyncio and h11 otherwise
+# - the app is imported once in the master and forked (SERVER_PRELOAD), so workers start ready to serve.
+#   connections can't be shared between processes, so each worker throws away the pools it inherited
+# - on SIGTERM a worker reports not ready on /health/ready for SERVER_DRAIN_SECONDS while still serving,
+#   then stops accepting connections, lets in-flight requests finish (up to SERVER_GRACEFUL_TIMEOUT_SECONDS)
+#   and runs the app's shutdown, which flushes buffered votes and closes the database pools
+# - the memory response cache is per worker, so with more than one worker a write only invalidates the cache of
+#   the worker that served it. RESPONSE_CACHE_BACKEND=redis shares one cache
+import importlib.util
+import logging
+import os
+import sys
+import threading
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn import Server
+from uvicorn.workers import UvicornWorker
+from .config import settings
+from .routers import health
+
+logger = logging.getLogger('app.server')
+
+
+def _installed(module: str):
+    return importlib.util.find_spec(module) is not None
+
+
+def worker_count():
+    if settings.server_workers:
+        return settings.server_workers
+    # the cores this process may run on, which inside a container can be fewer than os.cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return os.cpu_count() or 1
+
+
+# uvicorn's server with a drain period before the normal graceful shutdown
+class DrainingServer(Server):
+    def handle_exit(self, sig, frame):
+        if settings.server_drain_seconds <= 0 or health.draining.is_set():
+            # no drain period, or a second signal: shut down now
+            return super().handle_exit(sig, frame)
+
+        health.draining.set()
+        logger.info('draining for %.1fs before shutting down', settings.server_drain_seconds)
+        timer = threading.Timer(settings.server_drain_seconds, super().handle_exit, (sig, frame))
+        timer.daemon = True
+        timer.start()
+
+
+class Worker(UvicornWorker):
+    CONFIG_KWARGS = {
+        'loop': 'uvloop' if _installed('uvloop') else 'asyncio',
+        'http': 'httptools' if _installed('httptools') else 'h11',
+    }
+
+    # same as UvicornWorker._serve, with DrainingServer
+    async def _serve(self):
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+# forked workers inherit the master's engines. close=False drops the inherited pools without closing
+# connections the master (or a sibling) might still be using, and the worker opens its own
+def post_fork(server, worker):
+    from . import database, replicas
+
+    database.engine.dispose(close=False)
+    if settings.db_async:
+        database.async_engine.sync_engine.dispose(close=False)
+    for replica in replicas.replicas:
+        replica.sync_engine.dispose(close=False)
+
+
+def options():
+    return {
+        'bind': f'{settings.server_host}:{settings.port}',
+        'workers': worker_count(),
+        'worker_class': 'app.server.Worker',
+        'preload_app': settings.server_preload,
+        'keepalive': settings.server_keepalive_seconds,
+        'backlog': settings.server_backlog,
+        'timeout': settings.server_timeout_seconds,
+        # the drain period comes out of the same budget before the workers are killed
+        'graceful_timeout': settings.server_graceful_timeout_seconds + settings.server_drain_seconds,
+        'max_requests': settings.server_max_requests,
+        'max_requests_jitter': settings.server_max_requests_jitter,
+        'post_fork': post_fork,
+    }
+
+
+class Application(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from .main import app
+        return app
+
+
+def main():
+    config = options()
+    if settings.response_cache_backend == 'memory' and config['workers'] > 1:
+        logger.warning('RESPONSE_CACHE_BACKEND=memory with %d workers: a write only invalidates the cache '
+                       'of the worker that served it, the others serve it for up to %ds. '
+                       'set RESPONSE_CACHE_BACKEND=redis to share one cache', config['workers'],
+                       settings.response_cache_ttl_seconds)
+    logger.info('starting %d workers on %s (%s loop, %s http)', config['workers'], config['bind'],
+                Worker.CONFIG_KWARGS['loop'], Worker.CONFIG_KWARGS['http'])
+    Application(config).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from sqlalchemy import event, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from . import models, schemas, pagination
+
+
+# helpers for tests that check how many SQL statements a piece of code runs and how postgres plans them.
+# for the async engine pass async_engine.sync_engine
+
+
+# records every statement sent to the database while the with block runs
+# with QueryCounter(engine) as counter:
+#     client.get('/posts')
+# counter.count, counter.statements
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+# fails when the with block runs more than max_count statements
+@contextmanager
+def assert_max_queries(engine, max_count: int):
+    with QueryCounter(engine) as counter:
+        yield counter
+    if counter.count > max_count:
+        raise AssertionError(f'expected at most {max_count} statements, got {counter.count}:\n'
+                             + '\n'.join(counter.statements))
+
+
+# N+1 guard: calls request(page_size) for each page size and fails if the number of statements changes.
+# an endpoint that lazy loads something per item runs more statements for bigger pages
+# assert_queries_do_not_grow(engine, lambda size: client.get(f'/posts?limit={size}', headers=auth))
+def assert_queries_do_not_grow(engine, request, page_sizes=(1, 10, 50)):
+    counts = {}
+    for size in page_sizes:
+        with QueryCounter(engine) as counter:
+            request(size)
+        counts[size] = counter.count
+    if len(set(counts.values())) > 1:
+        raise AssertionError(
+            f'statement count grows with page size (page size: statements): {counts}')
+    return counts
+
+
+# <-- Query plans -->
+
+# tables that grow with usage. a sequential scan on one of these is a missing index
+LARGE_TABLES = ('posts', 'votes', 'users')
+
+
+# the statements the routers run, with representative parameters
+def router_statements():
+    from . import trending
+    from .routers.post import posts_page_statement, post_votes_select, owner_statement
+    from .routers.vote import (existing_posts_statement, insert_votes_statement,
+                               delete_votes_statement, vote_counts_statement)
+
+    cursor = pagination.encode_cursor(datetime.now(timezone.utc), 1000)
+    return {
+        'get_posts': posts_page_statement(50, 0, '', schemas.SearchMode.title, None),
+        'get_posts deep skip': posts_page_statement(50, 5000, '', schemas.SearchMode.title, None),
+        'get_posts cursor': posts_page_statement(50, 0, '', schemas.SearchMode.title, cursor),
+        'get_posts search': posts_page_statement(50, 0, 'query', schemas.SearchMode.title, None),
+        'get_posts fulltext': posts_page_statement(50, 0, 'query', schemas.SearchMode.fulltext, None),
+        'get_post': select(models.Post).where(models.Post.id == 1),
+        'post owner': owner_statement(1),
+        'posts by author': posts_page_statement(50, 0, '', schemas.SearchMode.title, None, user_id=1),
+        'posts by author cursor': posts_page_statement(50, 0, '', schemas.SearchMode.title, cursor, user_id=1),
+        'trending': trending.page_statement(post_votes_select(), 50, 0),
+        'get_user': select(models.User).where(models.User.id == 1),
+        'login': select(models.User).where(models.User.email == 'someone@example.com'),
+        'vote lookup': select(models.Vote).where(models.Vote.post_id == 1, models.Vote.user_id == 1),
+        'votes of post': select(models.Vote.user_id).where(models.Vote.post_id == 1),
+        'vote batch posts': existing_posts_statement([1, 2, 3]),
+        'vote batch insert': insert_votes_statement(1, [1, 2, 3]),
+        'vote batch delete': delete_votes_statement(1, [1, 2, 3]),
+        'vote batch counts': vote_counts_statement({1, 2}, {3}),
+    }
+
+
+# EXPLAIN (FORMAT JSON) <statement> as a statement sqlalchemy can execute with the statement's own parameters
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    sql = 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+    # compiling an INSERT/UPDATE/DELETE marks the compiler as one, but EXPLAIN only returns the plan as rows
+    compiler.isinsert = compiler.isupdate = compiler.isdelete = False
+    return sql
+
+
+# posts and votes are partitioned, so plans name their partitions (posts_p202610, votes_p3, posts_default)
+def _table_of(relation: str):
+    return relation.split('_p')[0] if relation.startswith(('posts_p', 'votes_p')) else relation.replace('_default', '')
+
+
+def _seq_scans(plan, found):
+    if plan.get('Node Type') == 'Seq Scan' and _table_of(plan.get('Relation Name', '')) in LARGE_TABLES:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        _seq_scans(child, found)
+    return found
+
+
+# runs EXPLAIN on every router statement and returns {name: [tables scanned sequentially]}.
+# on a small test database postgres prefers sequential scans even when an index exists, so seqscans are
+# turned off for the check: a Seq Scan that still shows up means there is no index that can serve the query.
+# EXPLAIN without ANALYZE doesn't run the statements, so the write statements are safe to check
+def find_seq_scans(engine, statements=None):
+    statements = statements if statements is not None else router_statements()
+    problems = {}
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            for name, statement in statements.items():
+                plan = conn.execute(Explain(statement)).scalar()
+                tables = _seq_scans(plan[0]['Plan'], [])
+                if tables:
+                    problems[name] = tables
+    return problems
+
+
+# fails when any router statement needs a sequential scan of a large table
+def assert_no_seq_scans(engine, statements=None):
+    problems = find_seq_scans(engine, statements)
+    if problems:
+        raise AssertionError('sequential scans on large tables: ' + ', '.join(
+            f'{name} ({", ".join(tables)})' for name, tables in problems.items()))
@@ -0,0 +1,64 @@
+# signing and verification keys for the access tokens.
+#
+# with an HMAC ALGORITHM (HS256, the default) tokens are signed and verified with SECRET_KEY, so every
+# service that verifies them needs the secret. with an asymmetric one (ES256, RS256, ...) tokens are signed
+# with JWT_PRIVATE_KEY_FILE and anyone can verify them with the public keys from /.well-known/jwks.json.
+# the id of the signing key (JWT_KEY_ID) goes in the token header as kid. to rotate, sign with a new key
+# and id and list the old public key in JWT_PUBLIC_KEY_FILES until the tokens it signed have expired
+from jose import jwk, jwt, JWTError
+from jose.constants import ALGORITHMS
+from .config import settings
+
+
+ASYMMETRIC = settings.algorithm not in ALGORITHMS.HMAC
+
+
+def _read(path: str):
+    with open(path) as key_file:
+        return key_file.read()
+
+
+# keys are parsed once at import. handing jose a parsed key instead of a PEM string saves parsing it per token
+def load_keys():
+    if not ASYMMETRIC:
+        return None, {}
+    if not settings.jwt_private_key_file:
+        raise RuntimeError(f'JWT_PRIVATE_KEY_FILE is required for {settings.algorithm} tokens.')
+
+    private_key = jwk.construct(_read(settings.jwt_private_key_file), settings.algorithm)
+    public_keys = {kid: jwk.construct(_read(path), settings.algorithm)
+                   for kid, path in settings.jwt_public_key_files.items()}
+    public_keys[settings.jwt_key_id] = private_key.public_key()
+    return private_key, public_keys
+
+
+signing_key, public_keys = load_keys()
+
+
+def encode(claims: dict):
+    if not ASYMMETRIC:
+        return jwt.encode(claims, settings.secret_key, algorithm=settings.algorithm)
+    return jwt.encode(claims, signing_key, algorithm=settings.algorithm,
+                      headers={'kid': settings.jwt_key_id})
+
+
+# checks the signature and exp and returns the claims. raises JWTError for any invalid token
+def decode(token: str):
+    if not ASYMMETRIC:
+        return jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+
+    kid = jwt.get_unverified_header(token).get('kid')
+    key = public_keys.get(kid)
+    if key is None:
+        raise JWTError('Unknown signing key.')
+    return jwt.decode(token, key, algorithms=[settings.algorithm])
+
+
+# the public keys in the JWK Set format. empty for HMAC tokens, the secret is never published
+def jwks():
+    keys = []
+    for kid, key in public_keys.items():
+        jwk_dict = key.to_dict()
+        jwk_dict.update(kid=kid, use='sig', alg=settings.algorithm)
+        keys.append(jwk_dict)
+    return {'keys': keys}
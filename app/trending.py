@@ -0,0 +1,76 @@
+# trending posts: the most voted posts created in the last TRENDING_WINDOW_HOURS.
+#
+# instead of ranking every post of the window on each request, the trending_posts table keeps the top
+# TRENDING_CAPACITY candidates. every vote upserts the voted posts with their new counts and trims the table
+# back to its capacity, so reads only ever sort a few hundred rows.
+# a post that was trimmed comes back as soon as it's voted on again. unvotes can leave the table slightly
+# out of order against posts it doesn't hold, so `python -m app.trending` rebuilds it from scratch
+# (run it from a scheduler, e.g. hourly)
+from datetime import timedelta
+from sqlalchemy import select, delete, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from . import models
+from .config import settings
+
+
+def window_start():
+    return func.now() - timedelta(hours=settings.trending_window_hours)
+
+
+# INSERT ... SELECT the current vote counts of these posts ... ON CONFLICT (post_id) DO UPDATE
+def update_statement(post_ids):
+    statement = insert(models.TrendingPost).from_select(
+        ['post_id', 'votes', 'created_at'],
+        select(models.Post.id, models.Post.vote_count, models.Post.created_at).where(
+            models.Post.id.in_(post_ids), models.Post.created_at >= window_start()))
+    return statement.on_conflict_do_update(
+        index_elements=['post_id'], set_={'votes': statement.excluded.votes})
+
+
+# drops posts that left the window and everything beyond the top TRENDING_CAPACITY
+def prune_statement():
+    keep = select(models.TrendingPost.post_id).order_by(
+        models.TrendingPost.votes.desc(), models.TrendingPost.post_id.desc()
+    ).limit(settings.trending_capacity)
+    return delete(models.TrendingPost).where(or_(
+        models.TrendingPost.created_at < window_start(),
+        models.TrendingPost.post_id.not_in(keep))
+    ).execution_options(synchronize_session=False)
+
+
+# the statements the vote routes run (in their own transaction) after changing vote counts
+def refresh_statements(post_ids):
+    if not settings.trending_enabled:
+        return []
+    return [update_statement(post_ids), prune_statement()]
+
+
+# one page of trending posts. post_votes_select is the same base query the other post lists use
+def page_statement(post_votes_select, limit: int, skip: int):
+    if settings.trending_enabled:
+        post_votes_select = post_votes_select.join(
+            models.TrendingPost, models.TrendingPost.post_id == models.Post.id)
+    return post_votes_select.where(models.Post.created_at >= window_start()).order_by(
+        models.Post.vote_count.desc(), models.Post.id.desc()).limit(limit).offset(skip)
+
+
+# refills the trending table from the posts table
+def rebuild(db):
+    db.execute(delete(models.TrendingPost).execution_options(
+        synchronize_session=False))
+    db.execute(insert(models.TrendingPost).from_select(
+        ['post_id', 'votes', 'created_at'],
+        select(models.Post.id, models.Post.vote_count, models.Post.created_at).where(
+            models.Post.created_at >= window_start()).order_by(
+            models.Post.vote_count.desc(), models.Post.id.desc()).limit(settings.trending_capacity)))
+    db.commit()
+
+
+if __name__ == '__main__':
+    from .database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        rebuild(db)
+    finally:
+        db.close()
@@ -1,4 +1,13 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from fastapi import status, HTTPException
 from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+from .config import settings
+from .metrics import HashMetrics
 
 
 # tells passlib which hashing algorithm to use for password encryption
@@ -12,3 +21,126 @@ def hash(pwd: str):
 # the .verify() method automatically handles comparing the non-hashed hashed passwords
 def verify(plain_pwd, hash_pwd):
     return pwd_context.verify(plain_pwd, hash_pwd)
+
+
+# like verify() but also returns a new hash when the stored one is out of date (passlib's needs_update),
+# e.g. after the bcrypt rounds are raised. returns (is_valid, new_hash or None)
+def verify_and_update(plain_pwd, hash_pwd):
+    return pwd_context.verify_and_update(plain_pwd, hash_pwd)
+
+
+# <-- Password hashing pool -->
+# bcrypt takes 100-300ms of CPU per call. running it in worker processes keeps it off the request threads
+# (and the GIL), and the in-flight limit turns a login burst into quick 503s instead of a queue that starves every route
+
+hash_metrics = HashMetrics()
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_in_flight = 0
+
+
+def _get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        # created on first use so each uvicorn worker process gets its own pool.
+        # forking a worker that already runs threadpool threads can copy a lock some thread holds and deadlock
+        # the child, so the hashing processes are started from a clean forkserver (spawn where there is none)
+        if _hash_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _hash_pool = ProcessPoolExecutor(
+                max_workers=settings.password_hash_workers,
+                mp_context=multiprocessing.get_context(method))
+        return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown(wait=False, cancel_futures=True)
+            _hash_pool = None
+
+
+def _busy_exception():
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail='Server is busy. Please try again shortly.',
+                         headers={'Retry-After': '1'})
+
+
+# runs in the worker process and reports how long the hashing itself took
+def _timed_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _release(future):
+    global _in_flight
+    with _hash_pool_lock:
+        _in_flight -= 1
+
+
+def _submit(fn, *args):
+    global _in_flight
+    with _hash_pool_lock:
+        if _in_flight >= settings.password_hash_workers + settings.password_hash_queue_limit:
+            hash_metrics.record_rejected()
+            raise _busy_exception()
+        _in_flight += 1
+
+    try:
+        future = _get_hash_pool().submit(_timed_call, fn, *args)
+    except Exception:
+        _release(None)
+        raise
+    future.add_done_callback(_release)
+    return future
+
+
+def _record(submitted_at: float, run_time: float):
+    total = time.perf_counter() - submitted_at
+    hash_metrics.record_call(queue_time=max(total - run_time, 0.0),
+                             run_time=run_time)
+
+
+# for sync routes: runs fn (hash, verify or verify_and_update) in the hashing pool and waits for the result
+def run_password_task(fn, *args):
+    if settings.password_hash_workers <= 0:
+        result, run_time = _timed_call(fn, *args)
+        hash_metrics.record_call(queue_time=0.0, run_time=run_time)
+        return result
+
+    submitted_at = time.perf_counter()
+    future = _submit(fn, *args)
+    try:
+        result, run_time = future.result(
+            timeout=settings.password_hash_timeout_seconds)
+    except FutureTimeoutError:
+        future.cancel()
+        hash_metrics.record_timeout()
+        raise _busy_exception()
+
+    _record(submitted_at, run_time)
+    return result
+
+
+# for async routes: same as run_password_task but awaits the result instead of blocking the event loop
+async def run_password_task_async(fn, *args):
+    # without a pool bcrypt still runs off the event loop, in the threadpool like the sync routes
+    if settings.password_hash_workers <= 0:
+        result, run_time = await run_in_threadpool(_timed_call, fn, *args)
+        hash_metrics.record_call(queue_time=0.0, run_time=run_time)
+        return result
+
+    submitted_at = time.perf_counter()
+    future = _submit(fn, *args)
+    try:
+        result, run_time = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                  timeout=settings.password_hash_timeout_seconds)
+    except asyncio.TimeoutError:
+        hash_metrics.record_timeout()
+        raise _busy_exception()
+
+    _record(submitted_at, run_time)
+    return result
@@ -0,0 +1,256 @@
+# write-behind buffer for single votes (VOTE_BUFFER_ENABLED).
+#
+# during a spike most votes land on the same few posts, and committing each one separately makes postgres
+# spend its time on commit fsyncs and waiting for the row lock on posts.vote_count. with the buffer, votes
+# are collected in memory keyed by (user_id, post_id) and a background thread writes them in one
+# transaction: one INSERT for all up votes, one DELETE for all removed votes and one UPDATE that applies
+# the net change of every post's vote_count.
+# if a user votes on the same post more than once before a flush only the net change is written, and each
+# request still gets the answer the unbuffered route would have given it had they run one after another
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from fastapi import status, HTTPException
+from fastapi.responses import JSONResponse
+from sqlalchemy import Integer, column, delete, select, tuple_, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from . import models, schemas, database, trending
+from .config import settings
+from .metrics import VoteBufferMetrics
+from .response_cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# how long a group commit request waits for its flush before giving up with a 503
+WAIT_TIMEOUT_SECONDS = 10
+
+vote_buffer_metrics = VoteBufferMetrics()
+
+
+# <-- Statements -->
+
+def existing_posts_statement(post_ids):
+    return select(models.Post.id).where(models.Post.id.in_(post_ids))
+
+
+# INSERT INTO votes (user_id, post_id) SELECT ... FROM (VALUES ...) JOIN posts FOR KEY SHARE OF posts
+# ON CONFLICT DO NOTHING RETURNING ...
+# the join skips posts deleted since existing_posts_statement ran, and the lock keeps a concurrent delete
+# from leaving orphan votes (see insert_votes_statement in routers/vote.py)
+def insert_votes_statement(pairs):
+    pending = values(column('user_id', Integer), column('post_id', Integer),
+                     name='pending').data(pairs)
+    return pg_insert(models.Vote).from_select(
+        ['user_id', 'post_id'],
+        select(pending.c.user_id, pending.c.post_id).join_from(
+            pending, models.Post, models.Post.id == pending.c.post_id
+        ).with_for_update(read=True, key_share=True, of=models.Post)
+    ).on_conflict_do_nothing().returning(models.Vote.user_id, models.Vote.post_id)
+
+
+def delete_votes_statement(pairs):
+    return delete(models.Vote).where(
+        tuple_(models.Vote.user_id, models.Vote.post_id).in_(pairs)
+    ).returning(models.Vote.user_id, models.Vote.post_id).execution_options(synchronize_session=False)
+
+
+# UPDATE posts SET vote_count = vote_count + deltas.delta FROM (VALUES ...) AS deltas WHERE posts.id = deltas.post_id
+def vote_deltas_statement(deltas):
+    changes = values(column('post_id', Integer), column('delta', Integer),
+                     name='deltas').data(sorted(deltas.items()))
+    return update(models.Post).where(models.Post.id == changes.c.post_id).values(
+        vote_count=models.Post.vote_count + changes.c.delta
+    ).execution_options(synchronize_session=False)
+
+
+# replays the directions one (user_id, post_id) received, in order, starting from whether the vote existed
+# before the batch. returns the (status_code, detail) of each request
+def replay_votes(user_id: int, post_id: int, directions, voted: bool):
+    results = []
+    for direction in directions:
+        if direction == 1:
+            results.append((status.HTTP_409_CONFLICT, f'User {user_id} has already voted on post {post_id}')
+                           if voted else (status.HTTP_201_CREATED, 'successfully add vote'))
+        else:
+            results.append((status.HTTP_201_CREATED, 'successfully removed vote')
+                           if voted else (status.HTTP_404_NOT_FOUND, 'vote does not exist'))
+        voted = direction == 1
+    return results
+
+
+# applies {(user_id, post_id): [directions in the order they arrived]} in one transaction and returns
+# {(user_id, post_id): [(status_code, detail) of each direction]}.
+# after the replay a vote exists exactly when the last direction was an up vote, so only the last one is written
+def apply_votes(db, votes):
+    existing = set(db.execute(existing_posts_statement(
+        {post_id for _, post_id in votes})).scalars())
+    up = [key for key, directions in votes.items() if directions[-1] == 1 and key[1] in existing]
+    down = [key for key, directions in votes.items() if directions[-1] != 1 and key[1] in existing]
+
+    added = set(map(tuple, db.execute(insert_votes_statement(up)))) if up else set()
+    removed = set(map(tuple, db.execute(delete_votes_statement(down)))) if down else set()
+
+    deltas = Counter()
+    for _, post_id in added:
+        deltas[post_id] += 1
+    for _, post_id in removed:
+        deltas[post_id] -= 1
+    deltas = {post_id: delta for post_id, delta in deltas.items() if delta}
+    if deltas:
+        db.execute(vote_deltas_statement(deltas))
+    changed = {post_id for _, post_id in added | removed}
+    for statement in trending.refresh_statements(changed):
+        db.execute(statement)
+    db.commit()
+    if changed:
+        response_cache.invalidate_posts(*changed)
+
+    return vote_results(votes, existing, added, removed)
+
+
+# the answers of every request in {(user_id, post_id): [directions]}, from the posts that exist and the
+# (user_id, post_id) rows the INSERT and DELETE returned
+def vote_results(votes, existing, added, removed):
+    results = {}
+    for (user_id, post_id), directions in votes.items():
+        if post_id not in existing:
+            results[user_id, post_id] = [(status.HTTP_404_NOT_FOUND, f'Post with id: {post_id} does not exist')
+                                         ] * len(directions)
+            continue
+        # the INSERT skips votes that already existed and the DELETE only returns votes that did
+        if directions[-1] == 1:
+            voted = (user_id, post_id) not in added
+        else:
+            voted = (user_id, post_id) in removed
+        results[user_id, post_id] = replay_votes(user_id, post_id, directions, voted)
+    return results
+
+
+# <-- Buffer -->
+
+class VoteBuffer:
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        # (user_id, post_id) -> [(direction, future of the request waiting for it)] in the order they arrived
+        self._pending = {}
+        self._first_added = 0.0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def add(self, user_id: int, post_id: int, direction: int):
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise _busy_exception()
+            if settings.vote_buffer_durability == 'async' and len(self._pending) >= settings.vote_buffer_max_pending:
+                vote_buffer_metrics.record_rejected()
+                raise _busy_exception()
+
+            # started on first use so each uvicorn worker process gets its own flush thread
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vote-buffer', daemon=True)
+                self._thread.start()
+
+            if not self._pending:
+                self._first_added = time.monotonic()
+            self._pending.setdefault((user_id, post_id), []).append((direction, future))
+            vote_buffer_metrics.set_depth(len(self._pending))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_size:
+                self._condition.notify()
+        vote_buffer_metrics.record_buffered()
+        return future
+
+    # flush thread: waits for the first vote, then until the batch is full or flush_interval has passed
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                while not self._closed and len(self._pending) < self.max_size:
+                    remaining = self._first_added + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, {}
+                vote_buffer_metrics.set_depth(0)
+            self._flush(batch)
+
+    # flushes always use the sync engine, they run on the flush thread and not on the event loop
+    def _flush(self, batch):
+        start = time.perf_counter()
+        try:
+            with database.SessionLocal() as db:
+                results = apply_votes(db, {key: [direction for direction, _ in requests]
+                                           for key, requests in batch.items()})
+        except Exception as error:
+            vote_buffer_metrics.record_flush(len(batch), time.perf_counter() - start, failed=True)
+            logger.exception('vote buffer flush of %d votes failed', len(batch))
+            for requests in batch.values():
+                for _, future in requests:
+                    future.set_exception(error)
+            return
+
+        vote_buffer_metrics.record_flush(len(batch), time.perf_counter() - start)
+        for key, requests in batch.items():
+            for (_, future), result in zip(requests, results[key]):
+                future.set_result(result)
+
+    # writes whatever is still buffered and stops the flush thread. called on shutdown
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+vote_buffer = VoteBuffer(max_size=settings.vote_buffer_max_size,
+                         flush_interval=settings.vote_buffer_flush_ms / 1000)
+
+
+def _busy_exception():
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail='Server is busy. Please try again shortly.',
+                         headers={'Retry-After': '1'})
+
+
+def _accepted():
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={'message': 'vote accepted'})
+
+
+# turns the flush result into the same response the unbuffered route gives
+def _response(result):
+    code, detail = result
+    if code != status.HTTP_201_CREATED:
+        raise HTTPException(status_code=code, detail=detail)
+    return {'message': detail}
+
+
+# for the sync vote route
+def submit(user_id: int, vote: schemas.Vote):
+    future = vote_buffer.add(user_id, vote.post_id, vote.direction)
+    if settings.vote_buffer_durability == 'async':
+        return _accepted()
+    try:
+        return _response(future.result(timeout=WAIT_TIMEOUT_SECONDS))
+    except FutureTimeoutError:
+        raise _busy_exception()
+
+
+# for the async vote route. awaits the flush instead of blocking the event loop
+async def submit_async(user_id: int, vote: schemas.Vote):
+    future = vote_buffer.add(user_id, vote.post_id, vote.direction)
+    if settings.vote_buffer_durability == 'async':
+        return _accepted()
+    try:
+        return _response(await asyncio.wait_for(asyncio.wrap_future(future), timeout=WAIT_TIMEOUT_SECONDS))
+    except asyncio.TimeoutError:
+        raise _busy_exception()
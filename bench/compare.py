@@ -0,0 +1,56 @@
+# compares two benchmark result files from bench.run
+#
+#   python -m bench.compare before.json after.json --threshold 10
+#
+# exits with status 1 when any route got slower at p95 (or slower in throughput) by more than
+# --threshold percent, so it can be used as a check in CI
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as result_file:
+        report = json.load(result_file)
+    return {(result['route'], result['concurrency']): result for result in report['results']}
+
+
+def change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def compare(before, after, threshold: float):
+    regressions = []
+    print(f"{'route':<36} {'c':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9} {'stmt/req':>9}")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        p95_change = change(old['p95_ms'], new['p95_ms'])
+        rps_change = change(old['throughput_rps'], new['throughput_rps'])
+        print(f"{key[0]:<36} {key[1]:>4} {change(old['p50_ms'], new['p50_ms']):+8.1f}% {p95_change:+8.1f}% "
+              f"{change(old['p99_ms'], new['p99_ms']):+8.1f}% {rps_change:+8.1f}% "
+              f"{new['statements_per_request'] - old['statements_per_request']:+9.2f}")
+        if p95_change > threshold or -rps_change > threshold:
+            regressions.append(key)
+
+    for route, concurrency in regressions:
+        print(f'REGRESSION: {route} at concurrency {concurrency}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare two benchmark result files.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='allowed slowdown in percent')
+    args = parser.parse_args(argv)
+
+    regressions = compare(load(args.before), load(args.after), args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
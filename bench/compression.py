@@ -0,0 +1,123 @@
+# benchmark of response compression: CPU time against bytes saved for each encoding and level.
+#
+#   python -m bench.compression --posts 50 --levels gzip:1,6,9 br:1,4,11 zstd:1,3,19
+#
+# it needs no database or .env. the payload is a GET /posts page built from fake posts in the same shape
+# as PostVotesResponse (every post repeats its author). brotli and zstd are skipped when their packages
+# (brotli, zstandard) aren't installed
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WORDS = ('query', 'index', 'cache', 'postgres', 'latency', 'vacuum', 'planner', 'replica',
+         'partition', 'cursor', 'token', 'batch', 'stream', 'worker', 'pool', 'commit')
+
+
+def compressors():
+    available = {'gzip': lambda body, level: gzip.compress(body, compresslevel=level, mtime=0)}
+    if brotli is not None:
+        available['br'] = lambda body, level: brotli.compress(body, quality=level)
+    if zstandard is not None:
+        available['zstd'] = lambda body, level: zstandard.ZstdCompressor(level=level).compress(body)
+    return available
+
+
+def decompressors():
+    available = {'gzip': gzip.decompress}
+    if brotli is not None:
+        available['br'] = brotli.decompress
+    if zstandard is not None:
+        available['zstd'] = lambda body: zstandard.ZstdDecompressor().decompress(body)
+    return available
+
+
+def sample_page(posts: int, rng: random.Random):
+    now = datetime.now(timezone.utc)
+    page = []
+    for id in range(posts, 0, -1):
+        user_id = rng.randrange(1, 20)
+        page.append({
+            'Post': {
+                'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(3, 8))),
+                'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(20, 80))),
+                'published': True,
+                'id': id,
+                'created_at': (now - timedelta(minutes=id)).isoformat(),
+                'user_id': user_id,
+                'user': {'id': user_id, 'email': f'user{user_id}@example.com',
+                         'created_at': (now - timedelta(days=user_id)).isoformat()},
+            },
+            'votes': rng.randrange(0, 500),
+        })
+    return json.dumps(page).encode()
+
+
+def time_per_call_us(fn, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def parse_levels(values):
+    levels = {}
+    for value in values:
+        encoding, _, numbers = value.partition(':')
+        levels[encoding] = [int(number) for number in numbers.split(',')]
+    return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark response compression levels.')
+    parser.add_argument('--posts', type=int, default=50, help='posts on the sample page')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--levels', nargs='*', default=['gzip:1,6,9', 'br:1,4,11', 'zstd:1,3,19'])
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    body = sample_page(args.posts, random.Random(0))
+    available, decompress = compressors(), decompressors()
+    results = []
+    for encoding, levels in parse_levels(args.levels).items():
+        if encoding not in available:
+            print(f'skipping {encoding}: its package is not installed')
+            continue
+        for level in levels:
+            compressed = available[encoding](body, level)
+            results.append({
+                'encoding': encoding,
+                'level': level,
+                'bytes': len(compressed),
+                'saved_pct': round((1 - len(compressed) / len(body)) * 100, 1),
+                'compress_us': round(time_per_call_us(lambda: available[encoding](body, level), args.iterations), 1),
+                'decompress_us': round(time_per_call_us(lambda: decompress[encoding](compressed), args.iterations), 1),
+            })
+
+    print(f'page of {args.posts} posts: {len(body)} bytes uncompressed')
+    print(f"{'encoding':<9} {'level':>5} {'bytes':>8} {'saved':>7} {'compress us':>12} {'decompress us':>14} {'us per KB saved':>16}")
+    for result in results:
+        saved_kb = (len(body) - result['bytes']) / 1024
+        per_kb = result['compress_us'] / saved_kb if saved_kb else float('inf')
+        print(f"{result['encoding']:<9} {result['level']:>5} {result['bytes']:>8} {result['saved_pct']:>6}% "
+              f"{result['compress_us']:>12} {result['decompress_us']:>14} {per_kb:>16.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'posts': args.posts, 'uncompressed_bytes': len(body), 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# benchmark every route in-process through ASGI (no network or uvicorn in the way).
+#
+#   python -m bench.run --users 200 --posts 20000 --votes 100000 --concurrency 1,10,50 --output before.json
+#   python -m bench.compare before.json after.json
+#
+# it uses the database configured in .env (run the alembic migrations on it first). add --seed to fill it
+# with fake data, --reset to empty it before seeding. for each route and concurrency level it reports
+# p50/p95/p99 latency, throughput and the number of SQL statements per request as JSON
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import time
+from datetime import datetime, timezone
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+# what the routes need to build valid requests: tokens for the seeded users and which posts they own
+class BenchContext:
+    def __init__(self, user_ids, post_owners, rng):
+        from app import oauth2
+
+        self.rng = rng
+        self.user_ids = user_ids
+        self.post_owners = post_owners
+        self.tokens = {user_id: oauth2.create_access_token(payload={'user_id': user_id})
+                       for user_id in user_ids}
+        self.created_posts = []
+
+    def auth(self, user_id=None):
+        user_id = user_id if user_id is not None else self.rng.choice(
+            self.user_ids)
+        return {'Authorization': f'Bearer {self.tokens[user_id]}'}
+
+    def random_post(self):
+        return self.rng.choice(self.post_owners)
+
+
+# each route is a name, how many requests to send compared to --requests, and a function that
+# builds the i-th request as (method, url, httpx keyword arguments)
+def routes(ctx: BenchContext):
+    from bench.seed import SEED_PASSWORD
+
+    def create_post(i):
+        return 'POST', '/posts/', {'headers': ctx.auth(),
+                                   'json': {'title': f'bench {i}', 'content': 'created by the benchmark'}}
+
+    def update_post(i):
+        post_id, user_id = ctx.random_post()
+        return 'PUT', f'/posts/{post_id}', {'headers': ctx.auth(user_id),
+                                            'json': {'title': f'updated {i}', 'content': 'updated by the benchmark'}}
+
+    def delete_post(i):
+        # only deletes the posts the create_post route made
+        post_id, user_id = ctx.created_posts.pop()
+        return 'DELETE', f'/posts/{post_id}', {'headers': ctx.auth(user_id)}
+
+    def vote(i):
+        return 'POST', '/vote/', {'headers': ctx.auth(),
+                                  'json': {'post_id': ctx.random_post()[0], 'direction': ctx.rng.choice((0, 1))}}
+
+    def vote_batch(i):
+        return 'POST', '/vote/batch', {'headers': ctx.auth(), 'json': {'votes': [
+            {'post_id': ctx.random_post()[0], 'direction': ctx.rng.choice((0, 1))} for _ in range(20)]}}
+
+    return [
+        ('GET /posts', 1.0, lambda i: ('GET', '/posts/', {})),
+        ('GET /posts?skip (deep)', 0.5, lambda i: ('GET', f'/posts/?skip={len(ctx.post_owners) // 2}', {})),
+        ('GET /posts?search', 0.5, lambda i: ('GET', f'/posts/?search={ctx.rng.choice(("query", "index", "cache"))}', {})),
+        ('GET /posts?search_mode=fulltext', 0.5,
+         lambda i: ('GET', f'/posts/?search={ctx.rng.choice(("query", "index", "cache"))}&search_mode=fulltext', {})),
+        ('GET /posts/me', 0.5, lambda i: ('GET', '/posts/me', {'headers': ctx.auth()})),
+        ('GET /posts/user/{user_id}', 0.5, lambda i: ('GET', f'/posts/user/{ctx.rng.choice(ctx.user_ids)}', {})),
+        ('GET /posts/trending', 0.5, lambda i: ('GET', '/posts/trending', {})),
+        # full exports are big, one request streams every post
+        ('GET /export/posts', 0.01, lambda i: ('GET', '/export/posts', {'headers': ctx.auth()})),
+        ('GET /export/posts?format=csv', 0.01, lambda i: ('GET', '/export/posts?format=csv', {'headers': ctx.auth()})),
+        ('GET /export/votes', 0.01, lambda i: ('GET', '/export/votes', {'headers': ctx.auth()})),
+        ('GET /posts/{id}', 1.0, lambda i: ('GET', f'/posts/{ctx.random_post()[0]}', {'headers': ctx.auth()})),
+        ('POST /posts', 0.5, create_post),
+        ('PUT /posts/{id}', 0.5, update_post),
+        ('DELETE /posts/{id}', 0.5, delete_post),
+        ('POST /vote', 1.0, vote),
+        ('POST /vote/batch', 0.2, vote_batch),
+        ('GET /users/me', 1.0, lambda i: ('GET', '/users/me', {'headers': ctx.auth()})),
+        ('GET /users/{id}', 1.0, lambda i: ('GET', f'/users/{ctx.rng.choice(ctx.user_ids)}', {'headers': ctx.auth()})),
+        # bcrypt routes are expensive, so they get fewer requests
+        ('POST /login', 0.05, lambda i: ('POST', '/login', {
+            'data': {'username': f'bench{ctx.rng.randrange(len(ctx.user_ids))}@example.com', 'password': SEED_PASSWORD}})),
+        ('POST /users', 0.05, lambda i: ('POST', '/users/', {
+            'json': {'email': f'new{time.time_ns()}{i}@example.com', 'password': 'bench'}})),
+    ]
+
+
+async def run_route(client, build, total: int, concurrency: int):
+    latencies, status_codes = [], {}
+    next_index = iter(range(total))
+
+    # each worker keeps one request in flight. they share the iterator, so together they send `total` requests
+    async def worker():
+        for i in next_index:
+            method, url, kwargs = build(i)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            status_codes[response.status_code] = status_codes.get(
+                response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return latencies, status_codes, elapsed
+
+
+async def run(args):
+    import httpx
+    from app import database, utils
+    from app.config import settings
+    from app.main import app
+    from app.testing import QueryCounter
+    from bench import seed
+
+    engine = database.async_engine.sync_engine if settings.db_async else database.engine
+
+    if args.reset:
+        seed.reset(engine)
+    if args.seed or args.reset:
+        user_ids, post_owners = seed.seed(
+            engine, args.users, args.posts, args.votes, args.random_seed)
+    else:
+        with engine.connect() as conn:
+            user_ids = [row.id for row in conn.exec_driver_sql(
+                'SELECT id FROM users ORDER BY id LIMIT 1000')]
+            post_owners = [(row.id, row.user_id) for row in conn.exec_driver_sql(
+                'SELECT id, user_id FROM posts ORDER BY id LIMIT 100000')]
+    if not user_ids or not post_owners:
+        raise SystemExit('the database has no users or posts. run with --seed')
+
+    ctx = BenchContext(user_ids, post_owners, random.Random(args.random_seed))
+    results = []
+
+    async with httpx.AsyncClient(app=app, base_url='http://bench') as client:
+        for concurrency in args.concurrency:
+            for name, weight, build in routes(ctx):
+                if args.only and not any(part in name for part in args.only):
+                    continue
+                total = max(int(args.requests * weight), concurrency)
+                if name == 'DELETE /posts/{id}':
+                    total = min(total, len(ctx.created_posts))
+                    if not total:
+                        continue
+
+                with QueryCounter(engine) as counter:
+                    latencies, status_codes, elapsed = await run_route(client, build, total, concurrency)
+
+                if name == 'POST /posts':
+                    # remember the posts the benchmark made so DELETE has something to remove
+                    with engine.connect() as conn:
+                        ctx.created_posts = [(row.id, row.user_id) for row in conn.exec_driver_sql(
+                            "SELECT id, user_id FROM posts WHERE content = 'created by the benchmark'")]
+
+                latencies.sort()
+                result = {
+                    'route': name,
+                    'concurrency': concurrency,
+                    'requests': total,
+                    'status_codes': {str(code): count for code, count in sorted(status_codes.items())},
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p95_ms': percentile(latencies, 95) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'mean_ms': sum(latencies) / len(latencies) * 1000,
+                    'throughput_rps': total / elapsed,
+                    'statements_per_request': counter.count / total,
+                }
+                results.append(result)
+                print(f"{name:<36} c={concurrency:<4} p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms "
+                      f"p99={result['p99_ms']:8.2f}ms {result['throughput_rps']:9.1f} req/s "
+                      f"{result['statements_per_request']:5.2f} stmt/req {result['status_codes']}")
+
+    utils.shutdown_hash_pool()
+
+    return {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'users': len(user_ids),
+            'posts': len(post_owners),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'db_async': settings.db_async,
+            'serialization_mode': settings.serialization_mode,
+            'response_cache_backend': settings.response_cache_backend,
+        },
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route in-process through ASGI.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--votes', type=int, default=50000)
+    parser.add_argument('--seed', action='store_true',
+                        help='add fake users, posts and votes before running')
+    parser.add_argument('--reset', action='store_true',
+                        help='empty the users, posts and votes tables first (implies --seed)')
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route and concurrency level (scaled down for slow routes)')
+    parser.add_argument('--concurrency', default='1,10,50',
+                        type=lambda value: [int(part) for part in value.split(',')])
+    parser.add_argument('--only', nargs='*',
+                        help='only run routes whose name contains one of these')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn the response cache off to measure the routes themselves')
+    parser.add_argument('--output', default='bench_results.json')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # settings are read when the app is imported, so this has to happen before any app import
+    if args.no_cache:
+        os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+
+    report = asyncio.run(run(args))
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# fills the database configured in .env with fake users, posts and votes for the benchmarks.
+# run the alembic migrations on that database first. --reset empties the tables before seeding,
+# so never point this at a database whose data you want to keep
+import random
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert, text
+from app import models, utils
+
+# every seeded user has this password (hashed once, bcrypt is too slow to hash it per user)
+SEED_PASSWORD = 'bench-password'
+
+BATCH_SIZE = 5000
+
+
+def _batches(rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        yield rows[start:start + BATCH_SIZE]
+
+
+def reset(engine):
+    with engine.begin() as conn:
+        conn.execute(
+            text('TRUNCATE votes, trending_posts, posts, users RESTART IDENTITY CASCADE;'))
+
+
+# returns the ids of the users and a list of (post_id, user_id)
+def seed(engine, users: int, posts: int, votes: int, random_seed: int = 0):
+    rng = random.Random(random_seed)
+    password = utils.hash(SEED_PASSWORD)
+    now = datetime.now(timezone.utc)
+
+    with engine.begin() as conn:
+        user_rows = [{'email': f'bench{n}@example.com', 'password': password}
+                     for n in range(users)]
+        user_ids = []
+        for batch in _batches(user_rows):
+            user_ids += [row.id for row in conn.execute(
+                insert(models.User.__table__).values(batch).returning(models.User.id))]
+
+        # posts are spread over the last year so created_at ordering and ranges are realistic
+        post_rows = [{
+            'title': f'bench post {n} ' + ' '.join(rng.choice(WORDS) for _ in range(4)),
+            'content': ' '.join(rng.choice(WORDS) for _ in range(40)),
+            'user_id': rng.choice(user_ids),
+            'created_at': now - timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+        } for n in range(posts)]
+        post_owners = []
+        for batch in _batches(post_rows):
+            post_owners += [(row.id, row.user_id) for row in conn.execute(
+                insert(models.Post.__table__).values(batch).returning(models.Post.id, models.Post.user_id))]
+
+        # distinct (user_id, post_id) pairs
+        votes = min(votes, len(user_ids) * len(post_owners))
+        pairs = set()
+        while len(pairs) < votes:
+            pairs.add((rng.choice(user_ids), rng.choice(post_owners)[0]))
+        vote_rows = [{'user_id': user_id, 'post_id': post_id}
+                     for user_id, post_id in pairs]
+        for batch in _batches(vote_rows):
+            conn.execute(insert(models.Vote.__table__).values(batch))
+
+        # keep the denormalized counters in step with the seeded votes
+        conn.execute(text('''
+        UPDATE posts
+        SET vote_count = counts.votes
+        FROM (SELECT post_id, COUNT(*) AS votes FROM votes GROUP BY post_id) AS counts
+        WHERE posts.id = counts.post_id;
+        '''))
+        conn.execute(text('ANALYZE users; ANALYZE posts; ANALYZE votes;'))
+
+    return user_ids, post_owners
+
+
+WORDS = ('fastapi', 'postgres', 'python', 'index', 'query', 'cursor', 'vote', 'cache', 'latency',
+         'throughput', 'async', 'pool', 'token', 'search', 'ranking', 'feed', 'worker', 'deploy',
+         'benchmark', 'profile', 'memory', 'network', 'disk', 'replica', 'partition', 'vacuum',
+         'the', 'a', 'of', 'and', 'to', 'in', 'is', 'for', 'on', 'with', 'as', 'by', 'at', 'from')
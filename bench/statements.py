@@ -0,0 +1,197 @@
+# microbenchmark of building, caching and planning the hot statements.
+#
+#   python -m bench.statements --iterations 5000
+#   python -m bench.statements --plan         # also measure postgres planning time (needs the database in .env)
+#
+# for each hot query it compares the statement as it was built before (a new select() chain per request)
+# with the lambda statement the routes use now:
+#   build    python time to build the statement object
+#   key      time to compute its cache key, which is all sqlalchemy does per execution on a compiled cache hit
+#   compile  time to compile it to SQL, which is what a cache miss (or query_cache_size=0) costs
+# --plan runs each query through EXPLAIN ANALYZE as a fresh statement and as an EXECUTE of a prepared
+# statement (what asyncpg does with prepared_statement_cache_size) and reports postgres' planning time
+#
+#   python -m bench.statements --partitions 12 60 240   # id-only statements at 12, 60 and 240 monthly partitions
+#
+# posts is partitioned by created_at (see app/partitions.py), so a statement that only knows the post id
+# can't skip any partition: it probes ix_posts_id in every monthly partition and in posts_default. planning
+# and execution time grow with the number of partitions, which is what PARTITION_RETENTION_MONTHS bounds.
+# --partitions adds empty partitions in a transaction that is rolled back, so it needs a seeded database
+# (bench/seed.py) that nothing else is using: creating a partition locks posts until the rollback
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+
+def per_call_us(fn, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+# (name, statement as built before, statement as built now) for each hot query
+def hot_statements():
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload
+    from app import models, oauth2
+    from app.routers import post, vote
+
+    def post_before(id):
+        return select(models.Post, models.Post.vote_count.label('votes')).options(
+            joinedload(models.Post.user)).filter(models.Post.id == id)
+
+    return [
+        ('get_post', post_before, post.post_by_id_statement),
+        ('get_current_user', lambda id: select(models.User).filter(models.User.id == id),
+         oauth2.user_by_id_statement),
+        ('vote: post exists', lambda id: select(models.Post.id).filter(models.Post.id == id),
+         vote.post_exists_statement),
+    ]
+
+
+def bench_python(build, dialect, iterations: int):
+    build(1).compile(dialect=dialect)  # lambda statements run their lambdas on first use
+    counter = iter(range(10 ** 9))
+    return {
+        'build_us': round(per_call_us(lambda: build(next(counter)), iterations), 2),
+        'key_us': round(per_call_us(lambda: build(next(counter))._generate_cache_key(), iterations), 2),
+        'compile_us': round(per_call_us(lambda: build(next(counter)).compile(dialect=dialect), iterations), 2),
+    }
+
+
+def planning_ms(conn, sql, params=None):
+    plan = conn.exec_driver_sql(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}', params).scalar()
+    return plan[0]['Planning Time']
+
+
+# average planning time of the statement sent as new SQL each time, and as EXECUTE of a prepared statement.
+# postgres switches a prepared statement to a generic plan after 5 executions, after that planning is almost free
+def bench_planning(engine, statement, runs: int):
+    from sqlalchemy.dialects import postgresql
+
+    compiled = statement.compile(dialect=postgresql.dialect())
+    sql = str(compiled) % {name: f'${index}' for index, name in enumerate(compiled.positiontup or compiled.params, 1)}
+    params = tuple(compiled.params.values())
+    literal_sql = str(statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+    with engine.connect() as conn:
+        fresh = sum(planning_ms(conn, literal_sql) for _ in range(runs)) / runs
+        conn.exec_driver_sql(f'PREPARE bench_statement AS {sql}')
+        args = ', '.join('%s' for _ in params)
+        prepared = sum(planning_ms(conn, f'EXECUTE bench_statement({args})', params) for _ in range(runs)) / runs
+        conn.exec_driver_sql('DEALLOCATE bench_statement')
+    return {'plan_fresh_ms': round(fresh, 4), 'plan_prepared_ms': round(prepared, 4)}
+
+
+# the statements of get_post, update_post, delete_post and the vote route that look a post up by id alone
+def id_only_statements(post_id: int, user_id: int):
+    from sqlalchemy import delete, update
+    from app import models
+    from app.routers import post, vote
+
+    posts = models.Post.__table__
+    return [
+        ('get_post', post.post_by_id_statement(post_id)),
+        ('post owner', post.owner_statement(post_id)),
+        ('update_post', update(posts).where(posts.c.id == post_id, posts.c.user_id == user_id).values(
+            title='bench').returning(posts.c.id)),
+        ('vote: post exists', vote.post_exists_statement(post_id)),
+        ('vote: count', vote.vote_count_statement(post_id, 1)),
+        ('delete_post', delete(posts).where(posts.c.id == post_id, posts.c.user_id == user_id).returning(
+            posts.c.id)),
+    ]
+
+
+# number of posts partitions (monthly and default) the plan reads
+def partitions_in_plan(plan):
+    name = plan.get('Relation Name', '')
+    found = 1 if name.startswith('posts_p') or name == 'posts_default' else 0
+    return found + sum(partitions_in_plan(child) for child in plan.get('Plans', []))
+
+
+# EXPLAIN ANALYZE of the id-only statements with at least each of the given numbers of monthly partitions.
+# the missing partitions are created far in the future and everything (writes included) is rolled back
+def bench_partitions(engine, partition_counts, runs: int):
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+    from app import models
+    from app.partitions import add_months, create_partition, month_partitions
+
+    results = []
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            post_id, user_id = conn.execute(select(models.Post.id, models.Post.user_id).limit(1)).first()
+            months = len(month_partitions(conn))
+            added = 0
+            for count in sorted(partition_counts):
+                while months + added < count:
+                    create_partition(conn, add_months(datetime(2200, 1, 1, tzinfo=timezone.utc), added))
+                    added += 1
+                for name, statement in id_only_statements(post_id, user_id):
+                    sql = str(statement.compile(dialect=postgresql.dialect(),
+                                                compile_kwargs={'literal_binds': True}))
+                    plans = [conn.exec_driver_sql(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}').scalar()[0]
+                             for _ in range(runs)]
+                    results.append({
+                        'query': name,
+                        'month_partitions': months + added,
+                        'partitions_read': partitions_in_plan(plans[0]['Plan']),
+                        'plan_ms': round(sum(plan['Planning Time'] for plan in plans) / runs, 4),
+                        'execute_ms': round(sum(plan['Execution Time'] for plan in plans) / runs, 4),
+                    })
+        finally:
+            transaction.rollback()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark statement building, caching and planning.')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--plan', action='store_true', help='also measure planning time in the database')
+    parser.add_argument('--plan-runs', type=int, default=20)
+    parser.add_argument('--partitions', type=int, nargs='+', metavar='MONTHS',
+                        help='only measure the id-only statements at these numbers of monthly partitions')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    if args.partitions:
+        from app.database import engine
+
+        results = bench_partitions(engine, args.partitions, args.plan_runs)
+        print(f"{'query':<20} {'months':>7} {'read':>5} {'plan ms':>9} {'execute ms':>11}")
+        for result in results:
+            print(f"{result['query']:<20} {result['month_partitions']:>7} {result['partitions_read']:>5} "
+                  f"{result['plan_ms']:>9} {result['execute_ms']:>11}")
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump({'runs': args.plan_runs, 'partitions': results}, output, indent=2)
+        return
+
+    from sqlalchemy.dialects import postgresql
+    dialect = postgresql.dialect()
+
+    results = []
+    for name, before, after in hot_statements():
+        for variant, build in (('before', before), ('after', after)):
+            result = {'query': name, 'variant': variant, **bench_python(build, dialect, args.iterations)}
+            if args.plan:
+                from app.database import engine
+                result.update(bench_planning(engine, build(1), args.plan_runs))
+            results.append(result)
+
+    print(f"{'query':<20} {'variant':<8} {'build us':>9} {'key us':>9} {'compile us':>11} "
+          f"{'plan ms':>9} {'prepared':>9}")
+    for result in results:
+        print(f"{result['query']:<20} {result['variant']:<8} {result['build_us']:>9} {result['key_us']:>9} "
+              f"{result['compile_us']:>11} {result.get('plan_fresh_ms', '-'):>9} {result.get('plan_prepared_ms', '-'):>9}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'iterations': args.iterations, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
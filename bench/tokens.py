@@ -0,0 +1,81 @@
+# microbenchmark of access token signing and verification for each supported algorithm.
+#
+#   python -m bench.tokens --iterations 5000
+#
+# it needs no database or .env: keys are generated on the fly and python-jose is called directly the
+# way app/token_keys.py calls it. "cached" is a verification served by the token cache in oauth2.py
+# (sha256 of the token + TTLCache lookup) instead of a signature check
+import argparse
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from jose import jwk, jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from app.cache import TTLCache
+
+
+def private_pem(private_key):
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()).decode()
+
+
+# (signing key, verification key) for each algorithm
+def make_keys():
+    keys = {'HS256': ('bench-secret-key', 'bench-secret-key')}
+    for algorithm, private_key in (('ES256', ec.generate_private_key(ec.SECP256R1())),
+                                   ('ES384', ec.generate_private_key(ec.SECP384R1())),
+                                   ('RS256', rsa.generate_private_key(public_exponent=65537, key_size=2048))):
+        signing_key = jwk.construct(private_pem(private_key), algorithm)
+        keys[algorithm] = (signing_key, signing_key.public_key())
+    return keys
+
+
+def per_second(fn, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed, elapsed / iterations * 1e6
+
+
+def bench_algorithm(algorithm, signing_key, verification_key, iterations: int):
+    claims = {'user_id': 1, 'exp': datetime.utcnow() + timedelta(minutes=30)}
+    token = jwt.encode(claims, signing_key, algorithm=algorithm, headers={'kid': 'bench'})
+
+    cache = TTLCache(maxsize=1024, ttl=300)
+    cache.set(hashlib.sha256(token.encode()).digest(), claims)
+
+    results = {'algorithm': algorithm, 'token_bytes': len(token)}
+    for name, fn in (
+            ('sign', lambda: jwt.encode(claims, signing_key, algorithm=algorithm, headers={'kid': 'bench'})),
+            ('verify', lambda: jwt.decode(token, verification_key, algorithms=[algorithm])),
+            ('cached', lambda: cache.get(hashlib.sha256(token.encode()).digest()))):
+        rate, micros = per_second(fn, iterations)
+        results[f'{name}_per_s'] = round(rate)
+        results[f'{name}_us'] = round(micros, 2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark access token signing and verification.')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = [bench_algorithm(algorithm, signing_key, verification_key, args.iterations)
+               for algorithm, (signing_key, verification_key) in make_keys().items()]
+
+    print(f"{'algorithm':<10} {'bytes':>6} {'sign/s':>10} {'verify/s':>10} {'cached/s':>10} {'verify us':>10}")
+    for result in results:
+        print(f"{result['algorithm']:<10} {result['token_bytes']:>6} {result['sign_per_s']:>10} "
+              f"{result['verify_per_s']:>10} {result['cached_per_s']:>10} {result['verify_us']:>10}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'iterations': args.iterations, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# these tests run the app against a real postgres database, which they empty and fill with fake data.
+# they only run when TEST_DB_NAME names that database (migrate it with alembic first). the other DB_*
+# settings still come from .env
+#
+#   TEST_DB_NAME=fastapi_test python -m pytest
+import os
+from datetime import datetime, timezone
+import pytest
+
+TEST_DB_NAME = os.environ.get('TEST_DB_NAME')
+if TEST_DB_NAME:
+    # settings are read when the app is imported, so this has to happen before any app import.
+    # the response cache is turned off so every request reaches the database
+    os.environ['DB_NAME'] = TEST_DB_NAME
+    os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+
+
+# the engine the routes run their statements on
+@pytest.fixture(scope='session')
+def db_engine():
+    if not TEST_DB_NAME:
+        pytest.skip('set TEST_DB_NAME to a migrated postgres database the tests may empty')
+    from app import database
+    from app.config import settings
+
+    return database.async_engine.sync_engine if settings.db_async else database.engine
+
+
+@pytest.fixture(scope='session')
+def seeded(db_engine):
+    from sqlalchemy import insert
+    from app import database, models
+    from bench.seed import reset, seed
+
+    reset(database.engine)
+    user_ids, post_owners = seed(database.engine, users=5, posts=300, votes=500)
+    # seeded posts are spread over a year, so a few recent ones are added for the trending window
+    with database.engine.begin() as conn:
+        conn.execute(insert(models.Post.__table__).values([
+            {'title': f'recent post {n}', 'content': 'created by the tests', 'user_id': user_ids[0],
+             'created_at': datetime.now(timezone.utc), 'vote_count': n} for n in range(60)]))
+    return user_ids, post_owners
+
+
+@pytest.fixture(scope='session')
+def client(seeded):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(scope='session')
+def user_id(seeded):
+    return seeded[0][0]
+
+
+@pytest.fixture(scope='session')
+def auth(user_id):
+    from app import oauth2
+
+    return {'Authorization': f'Bearer {oauth2.create_access_token(payload={"user_id": user_id})}'}
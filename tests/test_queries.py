@@ -0,0 +1,40 @@
+# the app is imported inside the tests, after conftest.py has pointed the settings at TEST_DB_NAME
+import pytest
+
+
+POST_LISTS = ['/posts/', '/posts/me', '/posts/user/{user_id}', '/posts/trending']
+
+
+# N+1 guard: a list that loads something per post runs more statements for a bigger page
+@pytest.mark.parametrize('path', POST_LISTS)
+def test_post_lists_do_not_grow_with_page_size(client, db_engine, auth, user_id, path):
+    from app.testing import assert_queries_do_not_grow
+
+    url = path.format(user_id=user_id)
+    sizes = {}
+
+    def request(size):
+        response = client.get(url, params={'limit': size}, headers=auth)
+        assert response.status_code == 200
+        sizes[size] = len(response.json())
+
+    assert_queries_do_not_grow(db_engine, request, page_sizes=(1, 50))
+    # the pages have to actually differ in size, or the guard proves nothing
+    assert sizes[50] > sizes[1]
+
+
+def test_get_post_runs_one_statement(client, db_engine, auth, seeded):
+    from app.testing import assert_max_queries
+
+    post_id = seeded[1][0][0]
+    with assert_max_queries(db_engine, 1):
+        assert client.get(f'/posts/{post_id}', headers=auth).status_code == 200
+
+
+# every statement the routers run has an index to use on posts and votes. the plans don't depend on the
+# driver, so this uses the sync engine in async mode too
+def test_router_statements_use_indexes(seeded):
+    from app import database
+    from app.testing import assert_no_seq_scans
+
+    assert_no_seq_scans(database.engine)
@@ -0,0 +1,142 @@
+# token buckets, forwarded-for parsing and the concurrency cap, without a server. redis is replaced by
+# fakeredis (its lua support needs the lupa package)
+import asyncio
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    from app import rate_limit
+
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def store(request, clock):
+    from app.rate_limit import MemoryBucketStore, RedisBucketStore
+
+    if request.param == 'memory':
+        return MemoryBucketStore()
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    return RedisBucketStore(fakeredis.FakeRedis())
+
+
+def acquire(store, cost=1):
+    return asyncio.run(store.acquire('ip:1.2.3.4', 2, 4, cost))
+
+
+def test_bucket_starts_full_and_empties(store):
+    assert [acquire(store)[0] for _ in range(5)] == [True, True, True, True, False]
+
+
+def test_retry_after_is_the_time_to_refill_the_cost(store):
+    for _ in range(4):
+        acquire(store)
+    allowed, retry_after = acquire(store, cost=3)
+    assert not allowed
+    assert retry_after == pytest.approx(1.5)
+
+
+def test_bucket_refills_at_rate_up_to_burst(store, clock):
+    for _ in range(4):
+        acquire(store)
+    clock.now += 1
+    assert [acquire(store)[0] for _ in range(3)] == [True, True, False]
+
+    clock.now += 60
+    assert [acquire(store)[0] for _ in range(5)] == [True, True, True, True, False]
+
+
+def test_buckets_are_separate_per_key(store):
+    assert asyncio.run(store.acquire('user:1', 1, 1, 1))[0]
+    assert not asyncio.run(store.acquire('user:1', 1, 1, 1))[0]
+    assert asyncio.run(store.acquire('user:2', 1, 1, 1))[0]
+
+
+def middleware(monkeypatch, store=None, header=None, proxies=(), max_concurrent=0):
+    from app.config import settings
+    from app.rate_limit import MemoryBucketStore, RateLimitMiddleware
+
+    monkeypatch.setattr(settings, 'rate_limit_forwarded_for_header', header)
+    monkeypatch.setattr(settings, 'rate_limit_trusted_proxies', list(proxies))
+    monkeypatch.setattr(settings, 'max_concurrent_requests', max_concurrent)
+
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    return RateLimitMiddleware(app, store if store is not None else MemoryBucketStore())
+
+
+def scope(peer='10.0.0.1', forwarded=None):
+    headers = [(b'x-forwarded-for', forwarded.encode())] if forwarded else []
+    return {'type': 'http', 'method': 'GET', 'path': '/posts/', 'client': (peer, 1234), 'headers': headers}
+
+
+def test_peer_address_without_a_forwarded_header(monkeypatch):
+    limiter = middleware(monkeypatch)
+    assert limiter.client_ip(scope(forwarded='1.1.1.1')) == '10.0.0.1'
+
+
+def test_right_most_forwarded_address_when_every_peer_is_trusted(monkeypatch):
+    limiter = middleware(monkeypatch, header='X-Forwarded-For')
+    assert limiter.client_ip(scope(forwarded='6.6.6.6, 1.1.1.1')) == '1.1.1.1'
+    assert limiter.client_ip(scope()) == '10.0.0.1'
+
+
+def test_trusted_proxies_are_skipped(monkeypatch):
+    limiter = middleware(monkeypatch, header='x-forwarded-for', proxies=['10.0.0.0/8'])
+    # the client made up 6.6.6.6, the proxies appended 1.1.1.1 and their own 10.0.0.2
+    assert limiter.client_ip(scope(forwarded='6.6.6.6, 1.1.1.1, 10.0.0.2')) == '1.1.1.1'
+    # only proxies in the header: the left-most is the closest thing to a client address
+    assert limiter.client_ip(scope(forwarded='10.0.0.3, 10.0.0.2')) == '10.0.0.3'
+    assert limiter.client_ip(scope(forwarded='not an address')) == 'not an address'
+
+
+def test_header_from_an_untrusted_peer_is_ignored(monkeypatch):
+    limiter = middleware(monkeypatch, header='x-forwarded-for', proxies=['10.0.0.0/8'])
+    assert limiter.client_ip(scope(peer='8.8.8.8', forwarded='1.1.1.1')) == '8.8.8.8'
+
+
+# a request waiting on the bucket store already counts against max_concurrent_requests
+def test_requests_waiting_on_the_store_count_as_in_flight(monkeypatch):
+    class SlowStore:
+        def __init__(self):
+            self.release = asyncio.Event()
+
+        async def acquire(self, key, rate, burst, cost):
+            await self.release.wait()
+            return True, 0.0
+
+    async def run():
+        store = SlowStore()
+        limiter = middleware(monkeypatch, store=store, max_concurrent=1)
+        statuses = []
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        first = asyncio.create_task(limiter(scope(), None, send))
+        await asyncio.sleep(0)
+        await limiter(scope(), None, send)
+        store.release.set()
+        await first
+        assert limiter.in_flight == 0
+        return statuses
+
+    assert asyncio.run(run()) == [503, 200]
@@ -0,0 +1,127 @@
+# the response cache against both backends. redis is replaced by fakeredis, so these run without a server
+import pytest
+
+
+class Broken:
+    def __getattr__(self, name):
+        def fail(*args):
+            raise ConnectionError('redis is down')
+        return fail
+
+
+def make_request(path='/posts/', query=b''):
+    from starlette.requests import Request
+
+    return Request({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': [],
+                    'scheme': 'http', 'server': ('testserver', 80)})
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    from app.response_cache import MemoryBackend, RedisBackend
+
+    if request.param == 'memory':
+        return MemoryBackend(maxsize=100, ttl=30)
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisBackend(fakeredis.FakeRedis())
+
+
+@pytest.fixture
+def cache(backend, monkeypatch):
+    from app.config import settings
+    from app.response_cache import ResponseCache
+
+    monkeypatch.setattr(settings, 'compression_precompress', False)
+    monkeypatch.setattr(settings, 'db_replica_urls', [])
+    return ResponseCache(backend, ttl=30)
+
+
+def test_backend_stores_and_counts(backend):
+    assert backend.get('key') is None
+    backend.set('key', b'value', 30)
+    assert backend.get('key') == b'value'
+    backend.delete('key')
+    assert backend.get('key') is None
+
+    assert backend.add('key', b'first', 30)
+    assert not backend.add('key', b'second', 30)
+    assert backend.get('key') == b'first'
+
+    assert backend.get_counter('counter') == 0
+    assert backend.incr('counter') == 1
+    assert backend.incr('counter') == 2
+    assert backend.get_counter('counter') == 2
+
+
+def test_set_then_get(cache):
+    key = cache.post_key(1)
+    cache.set(key, b'{"id": 1}')
+    cached = cache.get(key)
+    assert cached.body == b'{"id": 1}'
+    assert cached.headers['ETag']
+
+
+# a read that started before a write and finishes after it must not be stored under the new version
+def test_set_skips_responses_read_before_a_write(cache):
+    post_key, list_key = cache.post_key(1), cache.posts_list_key(make_request())
+    cache.invalidate_posts(1)
+    cache.set(post_key, b'old post')
+    cache.set(list_key, b'old page')
+
+    assert cache.get(post_key) is None
+    assert cache.get(list_key) is None
+    assert cache.post_key(1) != post_key
+    assert cache.posts_list_key(make_request()) != list_key
+
+
+# a write to one post only drops that post's detail, but every list page
+def test_invalidation_is_per_post_for_details(cache):
+    cache.set(cache.post_key(1), b'post 1')
+    cache.set(cache.post_key(2), b'post 2')
+    list_key = cache.posts_list_key(make_request())
+    cache.set(list_key, b'page')
+
+    cache.invalidate_posts(2)
+
+    assert cache.get(cache.post_key(1)).body == b'post 1'
+    assert cache.get(cache.post_key(2)) is None
+    assert cache.get(cache.posts_list_key(make_request())) is None
+
+
+def test_list_keys_differ_by_query_and_scope(cache):
+    assert cache.posts_list_key(make_request(query=b'limit=5')) != cache.posts_list_key(make_request())
+    assert cache.posts_list_key(make_request(), 1) != cache.posts_list_key(make_request(), 2)
+
+
+# a post whose version was lost falls back to the generation, which is newer than anything stored for it
+def test_lost_version_never_reaches_an_older_entry(cache, backend):
+    old_key = cache.post_key(1)
+    cache.set(old_key, b'old post')
+    cache.invalidate_posts(1)
+    backend.delete('post-version:1')
+    assert cache.post_key(1) != old_key
+
+
+def test_recent_write_on_a_replica_skips_the_detail(cache, monkeypatch):
+    from app.config import settings
+
+    monkeypatch.setattr(settings, 'db_replica_urls', ['postgresql://replica/db'])
+    monkeypatch.setattr(settings, 'read_your_writes_seconds', 5)
+    cache.invalidate_posts(1)
+
+    cache.set(cache.post_key(1), b'maybe stale')
+    cache.set(cache.post_key(2), b'post 2')
+    assert cache.get(cache.post_key(1)) is None
+    assert cache.get(cache.post_key(2)).body == b'post 2'
+
+
+def test_unreachable_backend_is_a_miss(monkeypatch):
+    from app.config import settings
+    from app.response_cache import ResponseCache
+
+    monkeypatch.setattr(settings, 'compression_precompress', False)
+    cache = ResponseCache(Broken())
+    key = cache.post_key(1)
+    assert cache.get(key) is None
+    assert cache.set(key, b'post').body == b'post'
+    cache.invalidate_posts(1)
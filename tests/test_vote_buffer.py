@@ -0,0 +1,78 @@
+# the answers buffered votes get, checked without a database: the rows the INSERT and DELETE would return
+# are worked out from whether the vote existed before the batch
+import pytest
+
+
+USER_ID, POST_ID = 1, 10
+KEY = (USER_ID, POST_ID)
+
+
+def flush(directions, voted_before, post_exists=True):
+    from app.vote_buffer import vote_results
+
+    added, removed = set(), set()
+    if post_exists:
+        # only the last direction is written: ON CONFLICT DO NOTHING skips a vote that exists,
+        # and the DELETE only returns a vote that did
+        if directions[-1] == 1 and not voted_before:
+            added.add(KEY)
+        if directions[-1] != 1 and voted_before:
+            removed.add(KEY)
+    existing = {POST_ID} if post_exists else set()
+    return [code for code, _ in vote_results({KEY: directions}, existing, added, removed)[KEY]]
+
+
+# (directions, answers when there was no vote before the batch, answers when there was)
+SEQUENCES = [
+    ([1], [201], [409]),
+    ([0], [404], [201]),
+    ([1, 1], [201, 409], [409, 409]),
+    ([1, 0], [201, 201], [409, 201]),
+    ([0, 1], [404, 201], [201, 201]),
+    ([0, 0], [404, 404], [201, 404]),
+    ([1, 0, 1], [201, 201, 201], [409, 201, 201]),
+]
+
+
+@pytest.mark.parametrize('directions, without_vote, with_vote', SEQUENCES)
+def test_answers_match_the_requests_applied_in_order(directions, without_vote, with_vote):
+    assert flush(directions, voted_before=False) == without_vote
+    assert flush(directions, voted_before=True) == with_vote
+
+
+@pytest.mark.parametrize('directions', [[1], [1, 1], [1, 0], [0, 1]])
+def test_missing_post_fails_every_request(directions):
+    assert flush(directions, voted_before=False, post_exists=False) == [404] * len(directions)
+
+
+def test_replay_details_match_the_vote_route():
+    from app.vote_buffer import replay_votes
+
+    assert replay_votes(USER_ID, POST_ID, [1, 1, 0, 0], voted=False) == [
+        (201, 'successfully add vote'),
+        (409, f'User {USER_ID} has already voted on post {POST_ID}'),
+        (201, 'successfully removed vote'),
+        (404, 'vote does not exist'),
+    ]
+
+
+# every request for the same vote keeps its own future and gets its own answer, in the order it was sent
+def test_buffer_answers_each_request(monkeypatch):
+    from app import vote_buffer
+
+    batches = []
+
+    def apply_votes(db, votes):
+        batches.append(votes)
+        return {key: [(201, f'request {n}') for n in range(len(directions))] for key, directions in votes.items()}
+
+    monkeypatch.setattr(vote_buffer, 'apply_votes', apply_votes)
+    buffer = vote_buffer.VoteBuffer(max_size=100, flush_interval=60)
+    futures = [buffer.add(USER_ID, POST_ID, direction) for direction in (1, 0, 1)]
+    other = buffer.add(2, POST_ID, 1)
+    buffer.close()
+
+    assert batches == [{KEY: [1, 0, 1], (2, POST_ID): [1]}]
+    assert [future.result(timeout=1) for future in futures] == [(201, 'request 0'), (201, 'request 1'),
+                                                                (201, 'request 2')]
+    assert other.result(timeout=1) == (201, 'request 0')
@@ -0,0 +1,62 @@
+# the single vote route against the test database (see conftest.py)
+from concurrent.futures import ThreadPoolExecutor
+
+
+def create_post(client, auth):
+    response = client.post('/posts/', json={'title': 'vote on me', 'content': 'created by the vote tests'},
+                           headers=auth)
+    assert response.status_code == 201
+    return response.json()['id']
+
+
+def vote_count(client, auth, post_id):
+    return client.get(f'/posts/{post_id}', headers=auth).json()['votes']
+
+
+def vote(client, auth, post_id, direction):
+    return client.post('/vote/', json={'post_id': post_id, 'direction': direction}, headers=auth).status_code
+
+
+def test_vote_answers(client, auth):
+    post_id = create_post(client, auth)
+    assert vote(client, auth, post_id, 1) == 201
+    assert vote(client, auth, post_id, 1) == 409
+    assert vote_count(client, auth, post_id) == 1
+    assert vote(client, auth, post_id, 0) == 201
+    assert vote(client, auth, post_id, 0) == 404
+    assert vote_count(client, auth, post_id) == 0
+
+
+def test_vote_on_missing_post(client, auth):
+    for direction in (0, 1):
+        response = client.post('/vote/', json={'post_id': 10 ** 9, 'direction': direction}, headers=auth)
+        assert response.status_code == 404
+        assert response.json()['detail'] == f'Post with id: {10 ** 9} does not exist'
+
+
+# the same up vote sent many times at once is written once, the rest get a 409 instead of a 500
+def test_concurrent_up_votes_count_once(client, auth):
+    post_id = create_post(client, auth)
+    with ThreadPoolExecutor(8) as pool:
+        statuses = list(pool.map(lambda _: vote(client, auth, post_id, 1), range(8)))
+    assert sorted(statuses) == [201] + [409] * 7
+    assert vote_count(client, auth, post_id) == 1
+
+
+def vote_batch(client, auth, votes):
+    response = client.post('/vote/batch', headers=auth, json={'votes': [
+        {'post_id': post_id, 'direction': direction} for post_id, direction in votes]})
+    assert response.status_code == 200
+    return [result['status_code'] for result in response.json()]
+
+
+# a post sent more than once in a batch gets the answers the single vote route would give, in order
+def test_batch_answers_repeated_posts_in_order(client, auth):
+    first, second = create_post(client, auth), create_post(client, auth)
+    assert vote_batch(client, auth, [(first, 1), (second, 1), (first, 0), (second, 1), (10 ** 9, 1)]) == [
+        201, 201, 201, 409, 404]
+    assert vote_count(client, auth, first) == 0
+    assert vote_count(client, auth, second) == 1
+
+    assert vote_batch(client, auth, [(second, 1), (second, 0), (second, 1), (first, 0)]) == [409, 201, 201, 404]
+    assert vote_count(client, auth, second) == 1